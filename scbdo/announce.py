@@ -23,6 +23,7 @@ import scbdo
 from scbdo import unt4
 from scbdo import tod
 from scbdo import strops
+from scbdo import uscbnet
 
 import os
 import sys
@@ -35,14 +36,64 @@ USCBSRV_HOST='localhost'
 USCBSRV_PORT=6667
 USCBSRV_CHANNEL='#announce'
 USCBSRV_SRVNICK='uscbsrv'
+USCBSRV_TRANSPORT='irc'	# or 'relay' for a uscbnet relay server
+USCBSRV_MCAST=''	# optional relay multicast group addr:port
 USCBSRV_CLTNICK='tran_'+str(random.randint(100,999))
 
 FONTSIZE=20     # font size in pixels
 MOTD=''         # Message of the day
+REFRESH=25	# maximum text buffer updates per second
+
+# Keepalive ping interval, reconnect and channel rejoin delays in seconds
+PING_INTERVAL=30.0
+RECONNECT_WAIT=2.0
+REJOIN_WAIT=2.0
 
 # Config filename
 CONFIGFILE='track_announce.ini'
 
+class textgrid(object):
+    """In-memory copy of the announce terminal text."""
+    def __init__(self, width=SCB_W, height=SCB_H):
+        self.width = width
+        self.height = height
+        self.clear()
+
+    def clear(self):
+        """Blank all lines."""
+        self.lines = [' ' * self.width] * self.height
+
+    def put(self, m):
+        """Write the text of unt4 message m at its position."""
+        if m.yy is not None and 0 <= m.yy < self.height and m.xx < self.width:
+            text = m.text
+            if m.erl:
+                text += ' ' * (self.width - (m.xx + len(text)))
+            l = self.lines[m.yy]
+            self.lines[m.yy] = (l[0:m.xx] + text
+                                  + l[m.xx + len(text):])[0:self.width]
+
+def writelines(buffer, lines, shown):
+    """Copy changed lines to a text buffer, return count written.
+
+    shown is the list of lines currently in the buffer and is
+    updated to match lines. All changes are made in one user action.
+
+    """
+    changed = [i for i in range(len(lines)) if lines[i] != shown[i]]
+    if len(changed) > 0:
+        buffer.begin_user_action()
+        for i in changed:
+            st = buffer.get_iter_at_line(i)
+            en = st.copy()
+            if not en.ends_line():
+                en.forward_to_line_end()
+            buffer.delete(st, en)
+            buffer.insert(st, lines[i])
+            shown[i] = lines[i]
+        buffer.end_user_action()
+    return len(changed)
+
 class uscbio(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
@@ -50,9 +101,11 @@ class uscbio(threading.Thread):
         self.cb = None
         self.ih = irclib.IRC()
         self.ic = self.ih.server()
-        self.np = tod.tod('now')+tod.tod('30')
-        self.hasconnnected = False
-        self.rdbuf = ''
+        self.il = irclib
+        self.np = time.time() + PING_INTERVAL
+        self.nj = 0.0	# earliest time for next channel join
+        self.rdbuf = unt4.unt4buf()
+        self.batch = []	# messages received in the current wakeup
         self.doreconnect = False
         self.chanstatus = False
         self.host = USCBSRV_HOST
@@ -60,15 +113,37 @@ class uscbio(threading.Thread):
         self.channel = USCBSRV_CHANNEL
         self.cltnick = USCBSRV_CLTNICK
         self.srvnick = USCBSRV_SRVNICK
-        self._curpace = 0.0
+
+    def set_transport(self, transport='irc', mcast=''):
+        """Select the irc or relay transport, call before start()."""
+        if transport == 'relay':
+            group = None
+            if mcast != '':
+                group = uscbnet.mkmcast(mcast)
+            self.ih = uscbnet.netirc('sub', group)
+            self.il = uscbnet
+        else:
+            self.ih = irclib.IRC()
+            self.il = irclib
+        self.ic = self.ih.server()
 
     def setcb(self, cb):
-        """Register the message callback function."""
+        """Register the message callback function.
+
+        The callback is called in the main thread with a list of
+        all the unt4 messages received in one wakeup of the io thread.
+
+        """
         self.cb = cb
 
     def exit(self, msg=None):
         """Request thread termination."""
         self.running = False
+        try:
+            if self.ic.is_connected():
+                self.ic.ping(self.cltnick)	# reply wakes io thread
+        except Exception:
+            pass
 
     def irc_event_cb(self, c, e):
         """Collect and log all IRC events (debug)."""
@@ -93,20 +168,17 @@ class uscbio(threading.Thread):
 
     def unt_msg_cb(self, c, e):
         """Handle a message packet."""
-        su = irclib.nm_to_n(e.source()).lower()
+        su = self.il.nm_to_n(e.source()).lower()
         tg = e.target().lower()
         if su == self.srvnick and tg == self.channel:
-            self._pacing(0.0)
             # Have a 'broadcast' packet ... append and then search
-            self.rdbuf += unt4.decode(''.join(e.arguments()))
-            #print ('rdbuf = ' + repr(self.rdbuf))
-            idx = self.rdbuf.find(chr(unt4.EOT))
-            while idx >= 0:
-                msgtxt = self.rdbuf[0:idx+1]
-                self.rdbuf = self.rdbuf[idx+1:]
-                if self.cb is not None:
-                    glib.idle_add(self.cb, unt4.unt4(unt4str=msgtxt))
-                idx = self.rdbuf.find(chr(unt4.EOT))
+            self.rdbuf.feed(unt4.decode(''.join(e.arguments())))
+            self.batch.extend(self.rdbuf.messages())
+
+    def welcome_cb(self, c, e):
+        """Join channel once the server has accepted the connection."""
+        self.nj = 0.0
+        self._rejoin()
 
     def set_port(self, host=None, port=None, channel=None,
                        cltnick=None, srvnick=None):
@@ -136,17 +208,10 @@ class uscbio(threading.Thread):
         return self.chanstatus
 
     def _rejoin(self):
-        self.ic.join(self.channel)
-
-    def _pacing(self, delay=None):
-        """Adjust internal pacing delay."""
-        if delay is None:
-            self._curpace += 0.1
-            if self._curpace > 1.5:
-                self._curpace = 1.5
-        else:
-            self._curpace = delay
-        return self._curpace
+        now = time.time()
+        if now >= self.nj:
+            self.nj = now + REJOIN_WAIT
+            self.ic.join(self.channel)
 
     def run(self):
         """Called via threading.Thread.start()."""
@@ -157,36 +222,33 @@ class uscbio(threading.Thread):
         self.ic.add_global_handler('part', self.channel_part_cb, -10)
         self.ic.add_global_handler('kick', self.channel_part_cb, -10)
         self.ic.add_global_handler('nicknameinuse', self.nicknameinuse_cb, -10)
+        self.ic.add_global_handler('welcome', self.welcome_cb, -10)
         #self.ic.add_global_handler('all_events', self.irc_event_cb, 0)
         while self.running:
             try:
-                self.ih.process_once(0)
                 if not self.ic.is_connected() or self.doreconnect:
                     self.doreconnect = False
                     self.chanstatus = False
-                    time.sleep(2)
+                    self.rdbuf = unt4.unt4buf()
+                    time.sleep(RECONNECT_WAIT)
                     self._reconnect()
-                    # skip over preliminary connect chatter ready to 
-                    # poll channel status - avoids double channel join
-                    if self.hasconnnected:
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(1)
-                    else:
-                        self.hasconnnected = True
-                if not self.in_channel():
-                    time.sleep(2)
+                    self.nj = time.time() + REJOIN_WAIT
+                elif not self.in_channel():
                     self._rejoin()
-                now = tod.tod('now')
+
+                # block on the server socket until data or next ping
+                now = time.time()
                 if now > self.np:
-                    self.ic.ctcp('PING', self.cltnick, str(int(time.time())))
-                    self.np = now + tod.tod('30')
-                time.sleep(self._pacing())
+                    self.ic.ctcp('PING', self.cltnick, str(int(now)))
+                    self.np = now + PING_INTERVAL
+                wait = self.np - now
+                if not self.in_channel():
+                    wait = min(wait, max(self.nj - now, 0.0) + 0.1)
+                self.ih.process_once(wait)
+                if len(self.batch) > 0:
+                    if self.cb is not None:
+                        glib.idle_add(self.cb, self.batch)
+                    self.batch = []
             except Exception as e:
                 # TODO : FIX HERE?
                 print ('Exception from uscbio: ' + str(e))
@@ -200,6 +262,8 @@ class announce(object):
                                         'channel':USCBSRV_CHANNEL,
                                         'srvnick':USCBSRV_SRVNICK,
                                         'cltnick':USCBSRV_CLTNICK,
+                                        'transport':USCBSRV_TRANSPORT,
+                                        'mcast':USCBSRV_MCAST,
                                         'fontsize':str(FONTSIZE),
                                         'fullscreen':'Yes',
                                         'motd':MOTD})
@@ -224,6 +288,8 @@ class announce(object):
         ncltnick =cr.get('uscbsrv', 'cltnick')
         nsrvnick = cr.get('uscbsrv', 'srvnick')
         self.io.set_port(nhost, nport, nchannel, ncltnick, nsrvnick)
+        self.io.set_transport(cr.get('uscbsrv', 'transport'),
+                              cr.get('uscbsrv', 'mcast'))
 
     def intro(self):
         m = unt4.unt4()
@@ -257,16 +323,22 @@ class announce(object):
         self.running = False
         gtk.main_quit()
     
-    def clear(self):
-        """Re-set all lines and draw a 'welcome'."""
-        ntxt = ''
-        for i in range(0,SCB_H-1):
-            ntxt += ''.ljust(SCB_W) + '\n'
-        ntxt += ''.ljust(SCB_W)
-        self.buffer.set_text(ntxt)
+    def reset(self):
+        """Re-set all grid lines and put the 'welcome'."""
+        self.grid.clear()
         if self.motd != '':
             m = unt4.unt4(yy=0, xx=0, text=self.motd, erl=True)
-            self.msg_cb(m)
+            self.grid.put(m)
+
+    def clear(self):
+        """Re-set all lines and draw a 'welcome'."""
+        self.reset()
+        self.queue_flush()
+
+    def redraw(self):
+        """Replace the whole text buffer with the current grid."""
+        self.buffer.set_text('\n'.join(self.grid.lines))
+        self.shown = list(self.grid.lines)
         
     def delayed_cursor(self):
         """Remove the mouse cursor from the text area."""
@@ -277,19 +349,40 @@ class announce(object):
         self.clear()
         return False
 
+    def flush_cb(self):
+        """Write grid changes to the text buffer."""
+        self.flushid = None
+        self.lastflush = time.time()
+        writelines(self.buffer, self.grid.lines, self.shown)
+        return False
+
+    def queue_flush(self):
+        """Request a text buffer update, at most REFRESH per second."""
+        if self.flushid is None:
+            delay = self.lastflush + 1.0 / REFRESH - time.time()
+            if delay > 0:
+                self.flushid = glib.timeout_add(int(1000 * delay) + 1,
+                                                self.flush_cb)
+            else:
+                self.flush_cb()
+
+    def apply(self, m):
+        """Apply message packet to the grid."""
+        if m.erp:
+            self.reset()
+        self.grid.put(m)
+
+    def msgs_cb(self, msgs):
+        """Handle a batch of message packets in main thread."""
+        for m in msgs:
+            self.apply(m)
+        self.queue_flush()
+        return False
+
     def msg_cb(self, m):
         """Handle message packet in main thread."""
-        if m.erp:
-            self.clear()
-        if m.yy is not None:
-            if m.erl:
-                m.text += ' '* (SCB_W - (m.xx + len(m.text)))
-                
-            j = self.buffer.get_iter_at_line_offset(m.yy, m.xx)
-            k = self.buffer.get_iter_at_line_offset(m.yy,
-                                                    m.xx + len(m.text))
-            self.buffer.delete(j, k)
-            self.buffer.insert(j, m.text)
+        self.apply(m)
+        self.queue_flush()
         return False
 
     def view_size_allocate_cb(self, widget, alloc, data=None):
@@ -307,12 +400,16 @@ class announce(object):
         
     def __init__(self):
         self.io = uscbio()
-        self.io.setcb(self.msg_cb)
+        self.io.setcb(self.msgs_cb)
         self.started = False
         self.running = True
         self.rscount = 0
         self.fh = 0
         self.motd = ''
+        self.grid = textgrid()
+        self.shown = []
+        self.flushid = None
+        self.lastflush = 0.0
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'announce.ui'))
         self.window = b.get_object('window')
@@ -322,7 +419,7 @@ class announce(object):
         self.view.modify_fg(gtk.STATE_NORMAL, gtk.gdk.Color('#001'))
         self.view.modify_bg(gtk.STATE_NORMAL, gtk.gdk.Color('#001'))
         self.view.modify_text(gtk.STATE_NORMAL, gtk.gdk.Color('#eef'))
-        self.clear() # compulsory clear -> fills all lines
+        self.redraw() # compulsory redraw -> fills all lines
         self.intro()
         glib.timeout_add_seconds(5,self.delayed_cursor)
         b.connect_signals(self)
@@ -341,5 +438,69 @@ def main():
         raise
 
 if __name__ == '__main__':
+    # Replay benchmark: per packet buffer edits against grid updates
+    if len(sys.argv) > 1 and sys.argv[1] == '-b':
+        msgs = []
+        if len(sys.argv) > 2:
+            # recorded UNT4 streams
+            for fname in sys.argv[2:]:
+                ub = unt4.unt4buf()
+                with open(fname, 'rb') as f:
+                    ub.feed(f.read())
+                msgs.extend(ub.messages())
+        else:
+            # a meet with result repaints and a running clock
+            for ev in range(40):
+                msgs.append(unt4.unt4(erp=True))
+                msgs.append(unt4.unt4(yy=0, xx=0, erl=True,
+                                      text='Event ' + str(ev)))
+                for r in range(25):
+                    for ln in range(2, 22):
+                        msgs.append(unt4.unt4(yy=ln, xx=0, erl=True,
+                                    text='{0:3d}. Rider {1} lap {2}'.format(
+                                           ln, ev, r)))
+                    msgs.append(unt4.unt4(yy=SCB_H-1, xx=SCB_W-8,
+                                    text='{0:02d}:{1:02d}.0'.format(ev, r)))
+        blank = '\n'.join([' ' * SCB_W] * SCB_H)
+
+        # legacy: one set of buffer edits per packet
+        lb = gtk.TextBuffer()
+        lb.set_text(blank)
+        st = time.time()
+        for m in msgs:
+            if m.erp:
+                lb.set_text(blank)
+            if m.yy is not None:
+                text = m.text
+                if m.erl:
+                    text += ' '* (SCB_W - (m.xx + len(text)))
+                j = lb.get_iter_at_line_offset(m.yy, m.xx)
+                k = lb.get_iter_at_line_offset(m.yy, m.xx + len(text))
+                lb.delete(j, k)
+                lb.insert(j, text)
+        lt = time.time() - st
+
+        # grid: apply each tick of packets, then write changed lines
+        gb = gtk.TextBuffer()
+        gb.set_text(blank)
+        g = textgrid()
+        shown = list(g.lines)
+        tick = 64
+        nl = 0
+        st = time.time()
+        for i in range(0, len(msgs), tick):
+            for m in msgs[i:i+tick]:
+                if m.erp:
+                    g.clear()
+                g.put(m)
+            nl += writelines(gb, g.lines, shown)
+        gt = time.time() - st
+        assert (lb.get_text(lb.get_start_iter(), lb.get_end_iter())
+                == gb.get_text(gb.get_start_iter(), gb.get_end_iter()))
+        print('Packets: {0:6d}'.format(len(msgs)))
+        print('  legacy: {0:0.3f} s, {1:6d} buffer edits'.format(lt,
+                                                                 len(msgs)))
+        print('  grid:   {0:0.3f} s, {1:6d} line writes'.format(gt, nl))
+        sys.exit(0)
     main()
 
@@ -96,10 +96,22 @@ class eventdb(object):
         self.model.clear()
 
     def load(self, csvfile=None):
-        """Load events from supplied CSV file."""
+        """Load events from supplied CSV file.
+
+        Rows are read and checked in one pass, then appended to the
+        model with the view detached. Duplicate and invalid event
+        numbers are reported in a single summary.
+
+        """
         theopenevent = None
         if os.path.isfile(csvfile):
             self.log.debug('Loading events from %s', csvfile)
+            seen = set()
+            for r in self.model:
+                seen.add(r[COL_EVNO])
+            newrows = []
+            dupcnt = 0
+            badcnt = 0
             with open(csvfile, 'rb') as f:
                 cr = csv.reader(f)
                 for row in cr:
@@ -115,13 +127,26 @@ class eventdb(object):
                                     else:
                                         if ir[i] == 'True':
                                             theopenevent = nr[COL_EVNO]
-                            if self.getevent(num) is None:
-                                self.model.append(nr)
+                            if num not in seen:
+                                seen.add(num)
+                                newrows.append(nr)
                             else:
-                                self.log.warn('Duplicate event #: %s', num)
+                                self.log.debug('Duplicate event #: %s', num)
+                                dupcnt += 1
                         else:
-                            self.log.warn('Invalid event #: %s', num)
-            self.log.debug('Load events done.')
+                            self.log.debug('Invalid event #: %s', num)
+                            badcnt += 1
+            if len(newrows) > 0:
+                if self.view is not None:
+                    self.view.set_model(None)
+                for nr in newrows:
+                    self.model.append(nr)
+                if self.view is not None:
+                    self.view.set_model(self.model)
+            if dupcnt > 0 or badcnt > 0:
+                self.log.warn('Ignored %d duplicate and %d invalid event #.',
+                              dupcnt, badcnt)
+            self.log.debug('Load events done: %d added.', len(newrows))
         return self.getevent(theopenevent)
 
     def save(self, csvfile=None):
@@ -0,0 +1,685 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless track event models.
+
+This module provides event classes which load, save and compute
+results from a track event config without gtk. They implement the
+subset of the race interface used by batch operations:
+
+  loadconfig()		read and recalculate the saved event
+  saveconfig()		write the event back to its snapshot
+  get_startlist()	space separated list of starters
+  result_gen()		generate [bib, rank, time] result vectors
+
+Each model keeps its riders as a list of plain vectors:
+
+  [bib, first, last, club, info, place, time, row]
+
+where place is None, an integer place or a string such as 'dnf',
+time is None or a tod, and row is the rider's saved config row,
+written back unchanged by saveconfig().
+
+Models follow the load and ranking rules of the interactive
+handlers, and the points score comparators are shared with ps. The
+function parity() compares a handler's results with a model loaded
+from the handler's saved config; run this module with -p <meetdir>
+to check every event in a meet (requires gtk).
+
+"""
+
+import os
+import logging
+
+from scbdo import tod
+from scbdo import strops
+from scbdo import snapshot
+from scbdo import resultcache
+
+# Rider vector columns
+COL_BIB = 0
+COL_FIRST = 1
+COL_LAST = 2
+COL_CLUB = 3
+COL_INFO = 4
+COL_PLACE = 5
+COL_TIME = 6
+COL_ROW = 7
+
+# Event types by model
+ITTT_TYPES = ['flying 200', 'flying lap', 'indiv tt', 'indiv pursuit',
+              'pursuit race', 'team pursuit', 'team pursuit race']
+PS_TYPES = ['points', 'madison']
+OMNIUM_TYPES = ['omnium', 'aggregate']
+
+# Default points for the first four places in a sprint
+SPRINT_POINTS = [5, 3, 2, 1]
+
+def mkevent(configpath, evno='', etype='', series='', meet=None):
+    """Return a headless event model of the correct type."""
+    if etype in ITTT_TYPES:
+        return ittt(configpath, evno, etype, series, meet)
+    elif etype in PS_TYPES:
+        return ps(configpath, evno, etype, series, meet)
+    elif etype in OMNIUM_TYPES:
+        return omnium(configpath, evno, etype, series, meet)
+    else:
+        return race(configpath, evno, etype, series, meet)
+
+# Point score sorting, on an aux table with columns:
+#  0 INDEX		Index in rider model
+#  1 BIB		Rider's bib
+#  2 INRACE		Bool rider still in race?
+#  3 LAPS		Rider's laps up/down
+#  4 TOTAL		Total points scored
+#  5 FINAL		Rider's place in final sprint (-1 for unplaced)
+
+def sortpoints(x, y):
+    """Point score sort: inrace / points / final sprint."""
+    if x[2] != y[2]:	# compare inrace
+        if x[2]:
+            return -1
+        else:
+            return 1
+    else:			# defer to points
+        return sortpointsonly(x, y)
+
+def sortpointsonly(x, y):
+    """Sort on points then final sprint place."""
+    if x[4] > y[4]:
+        return -1
+    elif x[4] < y[4]:
+        return 1
+    else:		# defer to last sprint
+        if x[5] == y[5]:
+            return 0	# places same - or both unplaced
+        else:
+            xp = x[5]
+            if xp < 0: xp = 9999
+            yp = y[5]
+            if yp < 0: yp = 9999
+            return cmp(xp, yp)
+
+def sortmadison(x, y):
+    """Madison sort: inrace / laps / points / final sprint."""
+    if x[2] != y[2]:	# compare inrace
+        if x[2]:
+            return -1
+        else:
+            return 1
+    else:			# defer to distance (laps)
+        if x[3] > y[3]:
+            return -1
+        elif x[3] < y[3]:
+            return 1
+        else:		# defer to points / final sprint
+            return sortpointsonly(x, y)
+
+def parity(handler):
+    """Return result vectors where handler and its saved config differ.
+
+    A model of the same type is loaded from the handler's config and
+    each vector from handler.result_gen() is compared with the model.
+    The return value is a list of (handler vector, model vector), with
+    None for a vector missing from either side.
+
+    """
+    m = mkevent(handler.configpath, handler.evno, handler.evtype,
+                handler.series, handler.meet)
+    m.loadconfig()
+    ret = []
+    for (hv, mv) in map(None, list(handler.result_gen()),
+                              list(m.result_gen())):
+        if hv != mv:
+            ret.append((hv, mv))
+    return ret
+
+class event(object):
+    """Headless event model base class."""
+    section = 'race'		# event properties section
+    ridersection = 'riders'	# rider rows section
+
+    def __init__(self, configpath, evno='', etype='', series='', meet=None):
+        """Constructor.
+
+        Parameters:
+
+          configpath -- event config file
+          evno -- event number
+          etype -- event type string from the event db
+          series -- rider number series
+          meet -- optional meet providing get_distance() and results
+
+        """
+        self.configpath = configpath
+        self.evno = evno
+        self.evtype = etype
+        self.series = series
+        self.meet = meet
+        self.log = logging.getLogger('scbdo.eventmodel')
+        self.log.setLevel(logging.DEBUG)
+        self.readonly = False
+        self.onestart = False
+        self.riders = []
+        self.ridx = {}		# bib -> rider vector
+        self.cr = None		# config as last loaded
+
+    def defaults(self):
+        """Return config defaults for this event type."""
+        return {'startlist':''}
+
+    def sections(self):
+        """Return the list of config sections for this event type."""
+        return [self.section, self.ridersection]
+
+    def readconfig(self):
+        """Return the event config with defaults and sections."""
+        cr = snapshot.config(self.defaults())
+        for s in self.sections():
+            cr.add_section(s)
+        if os.path.isfile(self.configpath):
+            cr.read(self.configpath)
+        return cr
+
+    def getrider(self, bib):
+        """Return the rider vector for bib or None."""
+        return self.ridx.get(bib)
+
+    def swap(self, idx, r):
+        """Exchange rider r with the rider at idx, as ListStore.swap."""
+        i = 0
+        while self.riders[i] is not r:
+            i += 1
+        self.riders[i] = self.riders[idx]
+        self.riders[idx] = r
+
+    def addrider(self, bib, row=None):
+        """Append a rider vector for bib and return it."""
+        nr = [bib, '', '', '', '', None, None, []]
+        if row is not None:
+            for i in range(0, 3):	# firstname, lastname, club
+                if len(row) > i:
+                    nr[i+1] = row[i].strip()
+            nr[COL_ROW] = row
+        self.riders.append(nr)
+        self.ridx[bib] = nr
+        return nr
+
+    def loadconfig(self):
+        """Load event config from disk and compute results."""
+        cr = self.readconfig()
+        self.cr = cr
+        self.riders = []
+        self.ridx = {}
+        self.onestart = False
+        for bib in cr.get(self.section, 'startlist').split():
+            row = None
+            if cr.has_option(self.ridersection, bib):
+                row = cr.getrow(self.ridersection, bib)
+            self.loadrider(self.addrider(bib, row))
+        self.recalculate()
+
+    def loadrider(self, nr):
+        """Extract type specific values from a saved rider row."""
+        pass
+
+    def recalculate(self):
+        """Compute places from the loaded rider data."""
+        pass
+
+    def saveconfig(self):
+        """Write the loaded config back with current riders."""
+        if self.cr is None:
+            self.log.error('Attempt to save unloaded event.')
+            return
+        cw = snapshot.config()
+        for s in self.cr.sections():
+            if s == 'results':
+                continue
+            cw.add_section(s)
+            if s == self.ridersection:
+                for r in self.riders:
+                    cw.setrow(s, r[COL_BIB], r[COL_ROW])
+            else:
+                for o in self.cr.options(s):
+                    cw.set(s, o, self.cr.get(s, o))
+        cw.set(self.section, 'startlist', self.get_startlist())
+        resultcache.dumpresults(cw, self.result_gen())
+        cw.save(self.configpath)
+
+    def get_startlist(self):
+        """Return a list of bibs in the rider model."""
+        return ' '.join([r[COL_BIB] for r in self.riders])
+
+    def result_gen(self):
+        """Generator function to export a final result."""
+        for r in self.riders:
+            yield [r[COL_BIB], r[COL_PLACE], r[COL_TIME]]
+
+class race(event):
+    """Scratch, handicap, keirin and similar races."""
+
+    def defaults(self):
+        """Return config defaults for this event type."""
+        deftimetype = 'start/finish'
+        defdistance = ''
+        defdistunits = 'laps'
+        if self.evtype in ['sprint', 'keirin']:
+            deftimetype = '200m'
+            defdistunits = 'metres'
+            defdistance = '200'
+        return {'startlist':'',
+                'ctrl_places':'',
+                'start':'',
+                'lstart':'',
+                'finish':'',
+                'distance':defdistance,
+                'distunits':defdistunits,
+                'topn_places':'0',
+                'topn_event':'',
+                'showinfo':'Yes',
+                'timetype':deftimetype}
+
+    def recalculate(self):
+        """Transfer places from the control place list."""
+        places = strops.reformat_placelist(self.cr.get('race', 'ctrl_places'))
+        placeset = set()
+        place = 1
+        count = 0
+        for placegroup in places.split():
+            for bib in placegroup.split('-'):
+                if bib not in placeset:
+                    placeset.add(bib)
+                    r = self.getrider(bib)
+                    if r is not None:
+                        r[COL_PLACE] = place
+                        self.swap(count, r)
+                        count += 1
+            place = count + 1
+        if count > 0:
+            self.onestart = True
+        for r in self.riders:
+            dnf = len(r[COL_ROW]) > 4 and r[COL_ROW][4].strip() != ''
+            if len(r[COL_ROW]) > 3:
+                r[COL_INFO] = r[COL_ROW][3].strip()
+            if not self.onestart:
+                r[COL_PLACE] = None
+            elif dnf:
+                r[COL_PLACE] = 'dnf'	# only handle did not finish for now
+
+class ittt(event):
+    """Flying 200, time trial and pursuit events."""
+
+    def defaults(self):
+        """Return config defaults for this event type."""
+        defdistance = ''
+        defdistunits = 'metres'
+        if self.evtype == 'flying 200':
+            defdistance = '200'
+        elif self.evtype == 'flying lap':
+            defdistance = '1'
+            defdistunits = 'laps'
+        return {'startlist':'',
+                'start':'',
+                'lstart':'',
+                'fsbib':'',
+                'fsstat':'idle',
+                'bsbib':'',
+                'bsstat':'idle',
+                'showinfo':'Yes',
+                'distance':defdistance,
+                'distunits':defdistunits}
+
+    def loadrider(self, nr):
+        """Extract comment and times from a saved rider row."""
+        row = nr[COL_ROW]
+        if len(row) > 3:
+            nr[COL_INFO] = row[3]
+        st = None
+        ft = None
+        if len(row) > 6:
+            st = tod.str2tod(row[6])
+        if len(row) > 7:
+            ft = tod.str2tod(row[7])
+        if st is not None:
+            self.onestart = True
+        if ft is not None:
+            if st is None:
+                st = tod.tod(0)
+            nr[COL_TIME] = (ft - st).truncate(3)
+
+    def recalculate(self):
+        """Rank riders on elapsed time or comment."""
+        if tod.str2tod(self.cr.get('race', 'start')) is not None:
+            for stat in ['fsstat', 'bsstat']:	# handler re-joins timer
+                if self.cr.get('race', stat) == 'running':
+                    self.onestart = True
+        results = tod.todlist('FIN')
+        for r in self.riders:
+            if r[COL_TIME] is not None:
+                results.insert(r[COL_TIME], r[COL_BIB])
+            else:
+                results.insert(r[COL_INFO] or None, r[COL_BIB])
+        count = 0
+        place = 1
+        lt = None
+        for t in results:
+            if lt is not None:
+                if lt != t:
+                    place = count + 1
+                if t > tod.FAKETIMES['max']:
+                    place = 'dnf'
+            r = self.getrider(t.refid)
+            if self.onestart:
+                r[COL_PLACE] = place
+            self.swap(count, r)
+            count += 1
+            lt = t
+        if not self.onestart:
+            for r in self.riders:
+                r[COL_TIME] = None
+
+class ps(event):
+    """Point score and Madison races."""
+    ridersection = 'points'
+
+    def defaults(self):
+        """Return config defaults for this event type."""
+        defscoretype = 'points'
+        if self.evtype == 'madison':
+            defscoretype = 'madison'
+        return {'startlist':'',
+                'start':'',
+                'lstart':'',
+                'finish':'',
+                'sprintlaps':'',
+                'distance':'',
+                'distunits':'laps',
+                'masterslaps':'No',
+                'showinfo':'Yes',
+                'scoring':defscoretype}
+
+    def sections(self):
+        """Return the list of config sections for this event type."""
+        return ['race', 'sprintplaces', 'sprintpoints', 'points']
+
+    def lappoints(self):
+        """Return the points awarded for a lap gained."""
+        if strops.confopt_bool(self.cr.get('race', 'masterslaps')):
+            dist = None
+            if self.meet is not None:
+                dist = self.meet.get_distance(
+                         strops.confopt_dist(self.cr.get('race', 'distance')),
+                         strops.confopt_distunits(
+                             self.cr.get('race', 'distunits')))
+            if dist is not None and dist < 20000:
+                return 10
+        return 20
+
+    def recalculate(self):
+        """Total sprint and lap points, then rank riders."""
+        cr = self.cr
+        madison = cr.get('race', 'scoring').lower() == 'madison'
+        lappoints = self.lappoints()
+        sprintpoints = dict(cr.items('sprintpoints'))
+        aux = {}	# bib -> [inrace, laps, points, final, stpts]
+        for r in self.riders:
+            row = r[COL_ROW]
+            inrace = True
+            laps = 0
+            stpts = 0
+            if len(row) > 3:
+                inrace = not (row[3].lower() == 'no')
+            if len(row) > 5:
+                try:
+                    laps = int(row[5])
+                except ValueError:
+                    pass
+            if len(row) > 6:
+                r[COL_INFO] = row[6]
+            if len(row) > 7 and row[7].isdigit():
+                stpts = int(row[7])
+            aux[r[COL_BIB]] = [inrace, laps, 0, -1, stpts]
+
+        # transfer sprint places into points
+        for sid in strops.reformat_biblist(cr.get('race',
+                                                  'sprintlaps')).split():
+            points = SPRINT_POINTS
+            if sid in sprintpoints:
+                sp = sprintpoints[sid].split()
+                if all([p.isdigit() for p in sp]):	# empty for no points
+                    points = [int(p) for p in sp]
+            placestr = ''
+            if cr.has_option('sprintplaces', sid):
+                placestr = strops.reformat_placelist(cr.get('sprintplaces',
+                                                            sid))
+                if len(placestr) > 0:
+                    self.onestart = True
+            placeset = set()
+            place = 0
+            count = 0
+            for placegroup in placestr.split():
+                for bib in placegroup.split('-'):
+                    if bib not in placeset:
+                        placeset.add(bib)
+                        if bib in aux:
+                            if place < len(points):
+                                aux[bib][2] += points[place]
+                            if sid == '0':
+                                aux[bib][3] = place
+                            count += 1
+                place = count
+            if count > 0:
+                self.onestart = True
+
+        # rank on totals
+        auxtbl = []
+        idx = 0
+        for r in self.riders:
+            (inrace, laps, points, final, stpts) = aux[r[COL_BIB]]
+            total = stpts + points
+            if not madison:
+                total += lappoints * laps
+            auxtbl.append([idx, r[COL_BIB], inrace, laps, total, final])
+            idx += 1
+        cmpf = sortpoints
+        if madison:
+            cmpf = sortmadison
+        auxtbl.sort(cmpf)
+        self.riders = [self.riders[a[0]] for a in auxtbl]
+        place = 0
+        idx = 0
+        for (r, a) in zip(self.riders, auxtbl):
+            if a[2]:
+                if idx == 0 or cmpf(auxtbl[idx - 1], a) != 0:
+                    place = idx + 1
+                idx += 1
+                rank = place
+            else:
+                rank = 'dnf'	# ps only handle did not finish
+            if not self.onestart:
+                rank = None
+            r[COL_PLACE] = rank
+
+class omnium(event):
+    """Omnium and aggregate events."""
+
+    def defaults(self):
+        """Return config defaults for this event type."""
+        return {'startlist':'',
+                'showinfo':'Yes',
+                'events':'',
+                'evnicks':''}
+
+    def recalculate(self):
+        """Aggregate constituent event results from the meet cache."""
+        if self.meet is None or not hasattr(self.meet, 'results'):
+            for r in self.riders:	# not available, use saved results
+                r[COL_PLACE] = None
+            saved = resultcache.loadresults(self.configpath)
+            if saved is not None:
+                for (bib, rank, time) in saved:
+                    r = self.getrider(bib)
+                    if r is not None:
+                        r[COL_PLACE] = rank
+            return
+        total = {}
+        ttime = {}
+        rescount = {}
+        dnf = set()
+        for r in self.riders:
+            total[r[COL_BIB]] = 0
+            ttime[r[COL_BIB]] = tod.tod(0)
+        for eno in strops.reformat_bibserlist(
+                        self.cr.get('race', 'events')).split():
+            if eno == self.evno:
+                continue
+            for (bib, rank, time) in self.meet.results.get(eno):
+                if bib in total and rank is not None and bib not in dnf:
+                    if type(rank) is int:
+                        total[bib] += rank
+                        rescount[bib] = rescount.get(bib, 0) + 1
+                    elif rank in ['dsq', 'dnf', 'dns']:
+                        dnf.add(bib)
+                    if type(time) is tod.tod:
+                        ttime[bib] = ttime[bib] + time
+
+        # order: results count / in then dnf / points / time / bib
+        def omkey(r):
+            bib = r[COL_BIB]
+            return (-rescount.get(bib, 0), bib in dnf, total[bib],
+                    ttime[bib].ticks, bib)
+        self.riders.sort(key=omkey)
+        for r in self.riders:
+            r[COL_TIME] = None
+            r[COL_PLACE] = None
+            if r[COL_BIB] in dnf:
+                r[COL_PLACE] = 'dnf'
+        idx = 0
+        place = 0
+        lp = 0
+        lt = tod.tod(0)
+        for r in self.riders:
+            bib = r[COL_BIB]
+            if total[bib] != lp or ttime[bib] > lt:
+                place = idx + 1
+            if bib in dnf:
+                break		# riders after the first dnf are not placed
+            if place > 0:
+                r[COL_PLACE] = place
+            idx += 1
+            lp = total[bib]
+            lt = ttime[bib]
+
+if __name__ == "__main__":
+    """Time headless loading of all events in a track meet directory."""
+    import sys
+    import time
+    import tempfile
+    import shutil
+
+    if len(sys.argv) > 2 and sys.argv[1] == '-p':
+        # compare each handler in a meet with its model
+        from scbdo import trackmeet
+        app = trackmeet.trackmeet(os.path.realpath(sys.argv[2]))
+        app.loadconfig()
+        bad = 0
+        for eh in app.edb:
+            h = trackmeet.mkhandler(app, eh, False)
+            h.loadconfig()
+            for (hv, mv) in parity(h):
+                print('Event {0}: {1!r} != {2!r}'.format(h.evno, hv, mv))
+                bad += 1
+        app.journal.close()
+        print('Mismatched result vectors: {0}'.format(bad))
+        sys.exit(bad > 0)
+
+    class fakemeet(object):
+        """Minimal meet for the benchmark."""
+        def __init__(self, path):
+            self.configpath = path
+            self.results = resultcache.resultcache(self)
+            self.types = {}
+        def event_configpath(self, evno):
+            if self.types.get(evno) in OMNIUM_TYPES:
+                return os.path.join(self.configpath, 'event_' + evno)
+            return os.path.join(self.configpath, 'event_' + evno + '.ini')
+        def get_event(self, evno, ui=False):
+            return mkevent(self.event_configpath(evno), evno,
+                           self.types.get(evno, ''), '', self)
+        def get_distance(self, count=None, units='metres'):
+            return None
+
+    count = 24
+    evcount = 60
+    loops = 5
+    if len(sys.argv) > 1:
+        evcount = int(sys.argv[1])
+    tmp = tempfile.mkdtemp()
+    meet = fakemeet(tmp)
+    typecycle = ['scratch', 'points', 'indiv pursuit', 'keirin',
+                 'madison', 'flying 200', 'omnium']
+    bibs = [str(i) for i in range(1, count + 1)]
+    events = []
+    for i in range(1, evcount + 1):
+        evno = str(i)
+        etype = typecycle[i % len(typecycle)]
+        meet.types[evno] = etype
+        events.append(evno)
+        cw = snapshot.config()
+        cw.add_section('race')
+        cw.set('race', 'startlist', ' '.join(bibs))
+        if etype in OMNIUM_TYPES:
+            cw.set('race', 'events', ' '.join(events[-7:-1]))
+        elif etype in PS_TYPES:
+            cw.set('race', 'sprintlaps', '40 30 20 10 0')
+            cw.add_section('sprintplaces')
+            for s in ['40', '30', '20', '10', '0']:
+                cw.set('sprintplaces', s, ' '.join(bibs[int(s)//10::3]))
+            cw.add_section('points')
+            for b in bibs:
+                cw.setrow('points', b, ['First', 'Last', 'Club', 'Yes',
+                                         '0', '0', '', '0'])
+        elif etype in ITTT_TYPES:
+            cw.add_section('riders')
+            for b in bibs:
+                cw.setrow('riders', b, ['First', 'Last', 'Club', '', '',
+                   '', '10:00:00.000', '10:04:{0:02d}.123'.format(int(b))])
+        else:
+            cw.set('race', 'ctrl_places', ' '.join(reversed(bibs)))
+            cw.add_section('riders')
+            for b in bibs:
+                cw.setrow('riders', b, ['First', 'Last', 'Club', '', '', ''])
+        cw.save(meet.event_configpath(evno))
+
+    st = time.time()
+    for l in range(loops):
+        meet.results.clear()
+        for evno in events:
+            e = meet.get_event(evno)
+            e.loadconfig()
+            res = list(e.result_gen())
+    et = (time.time() - st) / loops
+    st = time.time()
+    for evno in events:
+        e = meet.get_event(evno)
+        e.loadconfig()
+        e.saveconfig()
+    swt = time.time() - st
+    shutil.rmtree(tmp)
+    print('Events: {0}, riders: {1}'.format(evcount, count))
+    print('  load+results: {0:0.1f} ms per meet'.format(1000.0 * et))
+    print('  load+save:    {0:0.1f} ms per meet'.format(1000.0 * swt))
@@ -0,0 +1,399 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Background meet results export.
+
+This module provides a thread class 'exporter' which writes a csv
+result file for each event of a track meet from its saved config,
+followed by an index file listing every exported event.
+
+Events are read with the headless models in eventmodel, by a small
+pool of worker threads. The index records a digest of each event's
+saved config, and an event whose digest matches the previous export
+is not written again. Aggregate events depend on the other events
+in the meet, including other aggregates, so their digest includes
+the digests of all events.
+
+Omnium and aggregate configs do not keep rider names, so the caller
+may pass a copy of the rider names taken from the meet's rider db
+which is used for riders without a name in the event config.
+
+The exporter does not touch gtk. Progress is reported through the
+optional callbacks:
+
+  progress(count, total, evno, status)	after each event
+  done(written, skipped, failed)	once the index is written
+
+which are called from the exporter threads. The caller is expected
+to pass them on to the main loop with glib.idle_add.
+
+"""
+
+import os
+import csv
+import Queue
+import hashlib
+import logging
+import threading
+import StringIO
+
+from scbdo import snapshot
+from scbdo import resultcache
+from scbdo import eventmodel
+
+# Export directory and index file names
+EXPORTDIR = 'export'
+INDEXFILE = 'index.csv'
+
+# Worker threads writing event files
+WORKERS = 4
+
+# Event status strings passed to progress callback
+STATUS_WRITTEN = 'written'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+# Index columns
+IDX_EVNO = 0
+IDX_PREFIX = 1
+IDX_INFO = 2
+IDX_TYPE = 3
+IDX_FILE = 4
+IDX_DIGEST = 5
+
+def event_filename(evno):
+    """Return the export file name for event evno."""
+    return 'event_' + evno + '.csv'
+
+def read_index(path):
+    """Return a dict of evno -> (filename, digest) from an index file."""
+    ret = {}
+    try:
+        with open(path, 'rb') as f:
+            for row in csv.reader(f):
+                if len(row) > IDX_DIGEST and row[IDX_EVNO] != 'evno':
+                    ret[row[IDX_EVNO]] = (row[IDX_FILE], row[IDX_DIGEST])
+    except (IOError, csv.Error):
+        pass
+    return ret
+
+def file_digest(path):
+    """Return the hex sha1 of the content of path, or '' if missing."""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return ''
+
+class lockedcache(resultcache.resultcache):
+    """Result cache shared by the export workers."""
+
+    def __init__(self, meet):
+        resultcache.resultcache.__init__(self, meet)
+        self.__lock = threading.RLock()	# re-entered by nested aggregates
+
+    def get(self, evno):
+        """Return the list of result vectors for event evno."""
+        with self.__lock:
+            return resultcache.resultcache.get(self, evno)
+
+class exportmeet(object):
+    """Meet stand-in for event models read by the exporter.
+
+    Holds a copy of the event list taken from the meet, so the
+    workers never read the gtk event model.
+
+    """
+    def __init__(self, events, get_distance=None):
+        """Constructor.
+
+        Parameters:
+
+          events -- list of (evno, prefix, info, type, series, configpath)
+          get_distance -- optional meet distance conversion function
+
+        """
+        self.events = {}
+        for ev in events:
+            self.events[ev[0]] = ev
+        self.distfn = get_distance
+        self.results = lockedcache(self)
+
+    def event_configpath(self, evno):
+        """Return the saved config path for evno or None."""
+        ev = self.events.get(evno)
+        if ev is None:
+            return None
+        return ev[5]
+
+    def get_event(self, evno, ui=False):
+        """Return a headless event model for evno or None."""
+        ev = self.events.get(evno)
+        if ev is None:
+            return None
+        return eventmodel.mkevent(ev[5], ev[0], ev[3], ev[4], self)
+
+    def get_distance(self, count=None, units='metres'):
+        """Convert race distance units to metres."""
+        if self.distfn is not None:
+            return self.distfn(count, units)
+        return None
+
+class exporter(threading.Thread):
+    """Meet export thread."""
+
+    def __init__(self, path, events, get_distance=None, workers=WORKERS,
+                       progress=None, done=None, riders=None):
+        """Constructor.
+
+        Parameters:
+
+          path -- export directory
+          events -- list of (evno, prefix, info, type, series, configpath)
+          get_distance -- optional meet distance conversion function
+          workers -- number of event writer threads
+          progress -- optional callback after each event
+          done -- optional callback when the export is complete
+          riders -- optional dict of (bib, series) -> (first, last, club)
+
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = logging.getLogger('scbdo.export')
+        self.log.setLevel(logging.DEBUG)
+        self.path = path
+        self.events = events
+        self.meet = exportmeet(events, get_distance)
+        self.riders = {}
+        if riders is not None:
+            self.riders = riders
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.done = done
+        self.__lock = threading.Lock()
+        self.__queue = Queue.Queue()
+        self.__count = 0
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.failures = set()	# evno of events not exported
+        self.digests = {}	# evno -> config digest of this export
+
+    def event_digests(self):
+        """Compute the config digest for each event."""
+        alldigests = []
+        for ev in self.events:
+            (evno, prefix, info, etype, series, configpath) = ev
+            d = hashlib.sha1('\n'.join([evno, prefix, info, etype, series,
+                                        file_digest(configpath)]))
+            self.digests[evno] = d.hexdigest()
+            alldigests.append(self.digests[evno])
+        allev = hashlib.sha1(''.join(alldigests)).hexdigest()
+        for ev in self.events:
+            if ev[3] in eventmodel.OMNIUM_TYPES:
+                self.digests[ev[0]] = hashlib.sha1(self.digests[ev[0]]
+                                                   + allev).hexdigest()
+
+    def write_event(self, ev):
+        """Write the result file for ev, return True if written."""
+        (evno, prefix, info, etype, series, configpath) = ev
+        e = self.meet.get_event(evno)
+        e.loadconfig()
+        buf = StringIO.StringIO()
+        cw = csv.writer(buf)
+        df = ''
+        if (e.cr.has_option(e.section, 'distance')
+              and e.cr.get(e.section, 'distance') != ''):
+            dist = self.meet.get_distance(e.cr.get(e.section, 'distance'),
+                                          e.cr.get(e.section, 'distunits'))
+            if dist:
+                df = str(dist) + 'm'
+        cw.writerow(['Event ' + evno, ' '.join([prefix, info]).strip(),
+                     etype, df])
+        for r in e.riders:
+            names = r[eventmodel.COL_FIRST:eventmodel.COL_CLUB+1]
+            if names == ['', '', '']:
+                names = self.riders.get((r[eventmodel.COL_BIB], series),
+                                        names)
+            rank = r[eventmodel.COL_PLACE]
+            plstr = ''
+            if type(rank) is int:
+                plstr = str(rank) + '.'
+            elif rank is not None:
+                plstr = rank
+            tstr = ''
+            if r[eventmodel.COL_TIME] is not None:
+                tstr = r[eventmodel.COL_TIME].rawtime(3)
+            cw.writerow([plstr, r[eventmodel.COL_BIB], names[0], names[1],
+                         names[2], r[eventmodel.COL_INFO], tstr])
+        snapshot.writefile(os.path.join(self.path, event_filename(evno)),
+                           buf.getvalue())
+        return True
+
+    def report(self, evno, status):
+        """Update counts and call the progress callback."""
+        with self.__lock:
+            self.__count += 1
+            if status == STATUS_WRITTEN:
+                self.written += 1
+            elif status == STATUS_SKIPPED:
+                self.skipped += 1
+            else:
+                self.failed += 1
+                self.failures.add(evno)
+            count = self.__count
+        if self.progress is not None:
+            self.progress(count, len(self.events), evno, status)
+
+    def worker(self, previous):
+        """Worker thread main loop, write queued events."""
+        while True:
+            ev = self.__queue.get()
+            if ev is None:
+                break
+            evno = ev[0]
+            status = STATUS_FAILED
+            try:
+                ofile = event_filename(evno)
+                if (previous.get(evno) == (ofile, self.digests[evno])
+                      and os.path.isfile(os.path.join(self.path, ofile))):
+                    status = STATUS_SKIPPED
+                elif self.write_event(ev):
+                    status = STATUS_WRITTEN
+            except Exception, e:
+                self.log.error('Error exporting event ' + repr(evno)
+                               + ': ' + repr(e))
+            self.report(evno, status)
+
+    def write_index(self):
+        """Write the index file for all exported events."""
+        buf = StringIO.StringIO()
+        cw = csv.writer(buf)
+        cw.writerow(['evno', 'prefix', 'info', 'type', 'file', 'digest'])
+        for (evno, prefix, info, etype, series, configpath) in self.events:
+            if (evno not in self.failures and os.path.isfile(
+                     os.path.join(self.path, event_filename(evno)))):
+                cw.writerow([evno, prefix, info, etype,
+                             event_filename(evno), self.digests[evno]])
+        snapshot.writefile(os.path.join(self.path, INDEXFILE),
+                           buf.getvalue())
+
+    def run(self):
+        """Called via threading.Thread.start()."""
+        self.log.debug('Starting export to ' + repr(self.path))
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            previous = read_index(os.path.join(self.path, INDEXFILE))
+            self.event_digests()
+            for ev in self.events:
+                self.__queue.put(ev)
+            pool = []
+            for i in range(min(self.workers, len(self.events))):
+                t = threading.Thread(target=self.worker, args=(previous,))
+                t.daemon = True
+                pool.append(t)
+                self.__queue.put(None)
+                t.start()
+            for t in pool:
+                t.join()
+            self.write_index()
+        except (OSError, IOError), e:
+            self.log.error('Export failed: ' + repr(e))
+        self.log.info('Exported {0} events, {1} unchanged, {2} failed.'.format(
+                        self.written, self.skipped, self.failed))
+        if self.done is not None:
+            self.done(self.written, self.skipped, self.failed)
+
+if __name__ == "__main__":
+    """Time a full and an unchanged export of a 60 event meet."""
+    import sys
+    import time
+    import shutil
+    import tempfile
+
+    evcount = 60
+    count = 24
+    if len(sys.argv) > 1:
+        evcount = int(sys.argv[1])
+    tmp = tempfile.mkdtemp()
+    bibs = [str(i) for i in range(1, count + 1)]
+    riders = dict([((b, ''), ('First', 'Last ' + b, 'Club')) for b in bibs])
+    events = []
+    typecycle = ['scratch', 'points', 'indiv pursuit', 'omnium']
+    for i in range(1, evcount + 1):
+        evno = str(i)
+        etype = typecycle[i % len(typecycle)]
+        cfile = os.path.join(tmp, 'event_' + evno + '.ini')
+        cw = snapshot.config()
+        cw.add_section('race')
+        cw.set('race', 'startlist', ' '.join(bibs))
+        if etype == 'omnium':
+            cw.set('race', 'events', ' '.join([str(j)
+                                       for j in range(max(1, i - 3), i)]))
+        elif etype == 'points':
+            cw.set('race', 'sprintlaps', '20 10 0')
+            cw.add_section('sprintplaces')
+            for s in ['20', '10', '0']:
+                cw.set('sprintplaces', s, ' '.join(bibs[int(s)//10::2]))
+        elif etype == 'indiv pursuit':
+            cw.add_section('riders')
+            for b in bibs:
+                cw.setrow('riders', b, ['First', 'Last', 'Club', '', '',
+                   '', '10:00:00.000', '10:04:{0:02d}.123'.format(int(b))])
+        else:
+            cw.set('race', 'ctrl_places', ' '.join(reversed(bibs)))
+        cw.save(cfile)
+        events.append((evno, 'Event', etype.title(), etype, '', cfile))
+
+    def progress(count, total, evno, status):
+        pass
+
+    def timed():
+        x = exporter(os.path.join(tmp, EXPORTDIR), events, progress=progress,
+                     riders=riders)
+        st = time.time()
+        x.start()
+        x.join()
+        return (time.time() - st, x)
+
+    (ft, x) = timed()
+    assert x.written == evcount
+    (ut, x) = timed()
+    assert x.skipped == evcount
+    cw = snapshot.config()
+    cw.read(events[0][5])
+    cw.set('race', 'ctrl_places', ' '.join(bibs))
+    cw.save(events[0][5])
+    (ct, x) = timed()
+    omcount = len([e for e in events if e[3] == 'omnium'])
+    assert x.written == 1 + omcount
+    # an edit to an omnium rewrites every omnium
+    cw = snapshot.config()
+    cw.read(events[2][5])
+    cw.set('race', 'showinfo', 'No')
+    cw.save(events[2][5])
+    (ot, x) = timed()
+    assert x.written == omcount
+    with open(os.path.join(tmp, EXPORTDIR, event_filename('3')), 'rb') as f:
+        row = list(csv.reader(f))[1]
+    assert row[2:5] == ['First', 'Last ' + row[1], 'Club']
+    shutil.rmtree(tmp)
+    print('Events: {0}, riders: {1}, workers: {2}'.format(evcount, count,
+                                                          WORKERS))
+    print('     full: {0:0.1f} ms'.format(1000.0 * ft))
+    print('unchanged: {0:0.1f} ms'.format(1000.0 * ut))
+    print('  one edit: {0:0.1f} ms'.format(1000.0 * ct))
@@ -714,12 +714,7 @@ class f200(object):
 
     def getrider(self, bib):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def addrider(self, bib=''):
         """Add specified rider to race model."""
@@ -768,12 +763,7 @@ class f200(object):
             
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def settimes(self, iter, st=None, ft=None, splits=None,
                              doplaces=True, comment=None):
@@ -1209,6 +1199,7 @@ class f200(object):
                                     gobject.TYPE_PYOBJECT, # 6 Start
                                     gobject.TYPE_PYOBJECT, # 7 100
                                     gobject.TYPE_PYOBJECT) # 8 Finish
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'f200.ui'))
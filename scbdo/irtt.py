@@ -30,7 +30,6 @@ import pango
 import os
 import logging
 import csv
-import ConfigParser
 
 import scbdo
 from scbdo import timy
@@ -41,6 +40,8 @@ from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
 from scbdo import timerpane
+from scbdo import journal
+from scbdo import snapshot
 
 
 # rider commands
@@ -52,6 +53,9 @@ RIDER_COMMMANDS = {'dns':'Did not start',
                    'fin':'Final places',
                    'com':'Add comment' }
 
+# applied trigger journal, appended to configpath
+JOURNALEXT = '.jnl'
+
 # startlist model columns
 COL_BIB = 0
 COL_SERIES = 1
@@ -196,10 +200,11 @@ class irtt(object):
         # failsafe defaults -> dual timer, C0 start, PA/PB
         # type specific overrides
 
-        cr = ConfigParser.ConfigParser({'startlist':'',
-					'start':'',
-                                        'lstart':''
-                                       })
+        cr = snapshot.config({'startlist':'',
+                              'start':'',
+                              'lstart':'',
+                              'journal':''
+                             })
         cr.add_section('race')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -218,7 +223,7 @@ class irtt(object):
             if cr.has_option('riders', rs):
                 # bbb.sss = comment,wall_start,timy_start,finish,place
                 nr = self.getrider(r, s)
-                ril = csv.reader([cr.get('riders', rs)]).next()
+                ril = cr.getrow('riders', rs)
                 lr = len(ril)
                 if lr > 0:
                     nr[COL_COMMENT] = ril[0]
@@ -236,12 +241,19 @@ class irtt(object):
         self.set_syncstart(tod.str2tod(cr.get('race', 'start')),
                            tod.str2tod(cr.get('race', 'lstart')))
 
+        # apply journal records saved after the config snapshot
+        if not self.readonly:
+            self.journal.open(self.configpath + JOURNALEXT)
+        jcount = cr.get('race', 'journal')
+        if jcount.isdigit():
+            self.replay_journal(int(jcount))
+
     def saveconfig(self):
         """Save race to disk."""
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
 
         # save basic race properties
         cw.add_section('race')
@@ -254,6 +266,7 @@ class irtt(object):
         cw.set('race', 'start', tstr)
         cw.set('race', 'lstart', lstr)
         cw.set('race', 'startlist', self.get_startlist())
+        cw.set('race', 'journal', str(self.journal.sync()))
 
         # save out all starters
         cw.add_section('riders')
@@ -270,11 +283,10 @@ class irtt(object):
                 if r[COL_TODFINISH] is not None:
                     tft = r[COL_TODFINISH].rawtime()
                 slice = [r[COL_COMMENT], wst, tst, tft, r[COL_PLACE]]
-                cw.set('riders', strops.bibser2bibstr(r[COL_BIB], r[COL_SERIES]),
-                    ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+                cw.setrow('riders', strops.bibser2bibstr(r[COL_BIB],
+                                                         r[COL_SERIES]), slice)
         self.log.debug('Saving race config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def get_ridercmds(self):
         """Return a dict of rider bib commands for container ui."""
@@ -295,6 +307,7 @@ class irtt(object):
         #self.meet.menu_race_properties.set_sensitive(False)
         if not self.readonly:
             self.saveconfig()
+        self.journal.close()
         self.meet.edb.editevent(self.event, winopen=False)
         self.winopen = False
 
@@ -368,6 +381,8 @@ class irtt(object):
                 series = self.fl.serent.get_text()
                 i = self.getiter(bib, series)
                 if i is not None:
+                    self.journal_trig(t, 'C1',
+                                      strops.bibser2bibstr(bib, series))
                     self.settimes(i, tst=self.riders.get_value(i,
                                                 COL_TODSTART), tft=t)
                     self.fl.tofinish()
@@ -388,6 +403,7 @@ class irtt(object):
                     self.log.error('Missing rider at finish')
                     self.sl.toidle()
         elif self.timerstat == 'armstart':
+            self.journal_trig(t, 'C1')
             self.set_syncstart(t)
 
     def start_trig(self, t):
@@ -395,9 +411,12 @@ class irtt(object):
         if self.timerstat == 'running':
             # check lane to apply pulse.
             if self.sl.getstatus() == 'armstart':
-                i = self.getiter(self.sl.bibent.get_text(),
-                                 self.sl.serent.get_text())
+                bib = self.sl.bibent.get_text()
+                series = self.sl.serent.get_text()
+                i = self.getiter(bib, series)
                 if i is not None:
+                    self.journal_trig(t, 'C0',
+                                      strops.bibser2bibstr(bib, series))
                     self.settimes(i, tst=t)
                     self.sl.torunning()
                 else:
@@ -405,22 +424,50 @@ class irtt(object):
                     self.sl.toidle()
             pass
         elif self.timerstat == 'armstart':
+            self.journal_trig(t, 'C0')
             self.set_syncstart(t, tod.tod('now'))
 
+    def journal_trig(self, t, chan, bibstr=''):
+        """Record an applied trigger to the event journal."""
+        self.journal.append(tod.mktod(t.ticks, t.index, chan, bibstr),
+                            journal.SRC_EVENT)
+
+    def replay_journal(self, start=0):
+        """Re-apply event journal records after start."""
+        cnt = 0
+        for (t, src) in journal.replay(self.configpath + JOURNALEXT, start):
+            cnt += 1
+            if t.refid == '':
+                if self.start is None:
+                    self.set_syncstart(t)
+                continue
+            (bib, series) = strops.bibstr2bibser(t.refid)
+            i = self.getiter(bib, series)
+            if i is None:
+                self.log.warn('Journal rider not in startlist: ' + t.refid)
+            elif t.chan == 'C0':
+                self.settimes(i, tst=t, doplaces=False)
+            else:
+                self.settimes(i, tst=self.riders.get_value(i, COL_TODSTART),
+                              tft=t, doplaces=False)
+        if cnt > 0:
+            self.placexfer()
+            self.log.info('Replayed ' + str(cnt) + ' journal records.')
+
     def add_starter(self, bibid):
         self.recent_starts[bibid]=tod.tod('now')
         return False	# run once only
 
     def on_start(self, curoft):
         for i in self.unstarters:
-            if curoft + tod.tod('10') == self.unstarters[i]:
+            if curoft + tod.const('10') == self.unstarters[i]:
                 self.log.info('about to load rider ' + i)
                 (bib, series) = strops.bibstr2bibser(i)
                 #!!! TODO -> use bib.ser ?
                 self.sl.setrider(bib, series)
                 self.sl.toarmstart()
                 self.meet.timer.arm(0)
-                self.start_unload = self.unstarters[i] + tod.tod('10')
+                self.start_unload = self.unstarters[i] + tod.const('10')
                 glib.timeout_add_seconds(180, self.add_starter, i)
                 break
 
@@ -431,7 +478,7 @@ class irtt(object):
         if self.timerstat == 'running':
             nowoft = (tod.tod('now') - self.lstart).truncate(0)
             if self.sl.getstatus() == 'idle':
-                if nowoft.timeval % 10 == tod.tod('0'):	# every ten.
+                if nowoft.ticks % (10 * tod.TICKS) == 0:	# every ten.
                     self.on_start(nowoft)
             else:
                 if nowoft == self.start_unload:
@@ -464,6 +511,7 @@ class irtt(object):
         while e is not None:
             self.rfid_trig(e)
             e = self.meet.rfu.response()
+        self.journal.poll()
         return True
 
     def clearplaces(self):
@@ -473,12 +521,7 @@ class irtt(object):
 
     def getrider(self, bib, series=''):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib and r[COL_SERIES] == series:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib, series)
 
     def addrider(self, bib='', series=''):
         """Add specified rider to race model."""
@@ -536,14 +579,7 @@ class irtt(object):
             
     def getiter(self, bib, series=''):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i,
-                     COL_BIB) == bib and self.riders.get_value(i,
-                     COL_SERIES) == series:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib, series)
 
     def unstart(self, bib='', series='', wst=None):
         """Register a rider as not yet started."""
@@ -728,6 +764,7 @@ class irtt(object):
         self.unstarters = {}
         self.curfintod = None
         self.recent_starts = {}
+        self.journal = journal.journal()	# opened in loadconfig
 
         self.riders = gtk.ListStore(gobject.TYPE_STRING,   # 0 bib
                                     gobject.TYPE_STRING,   # 1 series
@@ -738,6 +775,7 @@ class irtt(object):
                                     gobject.TYPE_PYOBJECT, # 6 tstart
                                     gobject.TYPE_PYOBJECT, # 7 finish
                                     gobject.TYPE_STRING)   # 8 place
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB, COL_SERIES)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'irtt.ui'))
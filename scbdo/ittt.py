@@ -34,7 +34,6 @@ import pango
 import os
 import logging
 import csv
-import ConfigParser
 
 import scbdo
 from scbdo import timy
@@ -45,6 +44,8 @@ from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
 from scbdo import timerpane
+from scbdo import snapshot
+from scbdo import resultcache
 
 # startlist model columns
 COL_BIB = 0
@@ -211,21 +212,21 @@ class ittt(object):
         else:
             self.teampursuit = False
 
-        cr = ConfigParser.ConfigParser({'startlist':'',
-					'start':'',
-                                        'lstart':'',
-                                        'fsbib':'',
-                                        'fsstat':'idle',
-                                        'bsbib':'',
-                                        'bsstat':'idle',
-                                        'showinfo':'Yes',
-                                        'distance':defdistance,
-					'distunits':defdistunits,
-                                        'chan_S':defchans,
-                                        'chan_A':defchana,
-                                        'chan_B':defchanb,
-                                        'autoarm':defautoarm,
-                                        'timetype':deftimetype})
+        cr = snapshot.config({'startlist':'',
+                              'start':'',
+                              'lstart':'',
+                              'fsbib':'',
+                              'fsstat':'idle',
+                              'bsbib':'',
+                              'bsstat':'idle',
+                              'showinfo':'Yes',
+                              'distance':defdistance,
+                              'distunits':defdistunits,
+                              'chan_S':defchans,
+                              'chan_A':defchana,
+                              'chan_B':defchanb,
+                              'autoarm':defautoarm,
+                              'timetype':deftimetype})
         cr.add_section('race')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -251,7 +252,7 @@ class ittt(object):
             ft = None
             sp = []
             if cr.has_option('riders', r):
-                ril = csv.reader([cr.get('riders', r)]).next()
+                ril = cr.getrow('riders', r)
                 for i in range(0,3):	# firstname, lastname, club
                     if len(ril) > i:	# assigned directlt, but...
                         nr[i+1] = ril[i].strip()
@@ -318,7 +319,7 @@ class ittt(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('race')
 
         # save basic race properties
@@ -359,11 +360,10 @@ class ittt(object):
                     slice.append(t.rawtime())
                 else:
                     slice.append('')
-            cw.set('riders', r[COL_BIB],
-                ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+            cw.setrow('riders', r[COL_BIB], slice)
+        resultcache.dumpresults(cw, self.result_gen())
         self.log.debug('Saving race config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def get_startlist(self):
         """Return a list of bibs in the rider model."""
@@ -765,12 +765,7 @@ class ittt(object):
 
     def getrider(self, bib):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def addrider(self, bib=''):
         """Add specified rider to race model."""
@@ -819,12 +814,7 @@ class ittt(object):
             
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def settimes(self, iter, st=None, ft=None, splits=None,
                              doplaces=True, comment=None):
@@ -1271,6 +1261,7 @@ class ittt(object):
                                     gobject.TYPE_PYOBJECT, # 7 Start
                                     gobject.TYPE_PYOBJECT, # 8 Finish
                                     gobject.TYPE_PYOBJECT) # 9 Lap Splits(0,n)
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'ittt.ui'))
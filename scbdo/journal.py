@@ -0,0 +1,215 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Append-only journal of timing impulses and RFID sightings.
+
+This module provides a class 'journal' which appends tod objects to
+a binary file as fixed size records:
+
+	ticks	8 bytes		tod ticks, network order
+	index	4 bytes		tod index, nul padded
+	chan	3 bytes		tod channel, nul padded
+	source	1 byte		one of the SRC_ constants
+	refid	16 bytes	tod refid, nul padded
+
+Records are collected in memory and written out with a single write
+and fsync once SYNC_COUNT records are waiting or SYNC_WAIT seconds
+have passed since the last sync. A partial record left at the end
+of the file by a crash is discarded when the journal is re-opened.
+
+Event modules store the record count of their journal with each
+saved config and replay the records after that count with replay()
+when the config is loaded again.
+
+"""
+
+import os
+import time
+import struct
+import threading
+
+from scbdo import tod
+
+# Record layout
+RECORD = struct.Struct('!q4s3sB16s')
+RECLEN = RECORD.size
+
+# Record sources
+SRC_UNKNOWN = 0
+SRC_TIMY = 1
+SRC_RFID = 2
+SRC_EVENT = 3
+
+# Sync limits
+SYNC_COUNT = 64
+SYNC_WAIT = 0.5
+
+# Records read per block on replay
+READCOUNT = 4096
+
+def pack(t, source=SRC_UNKNOWN):
+    """Return the journal record for tod t."""
+    return RECORD.pack(t.ticks, t.index, t.chan, source, t.refid)
+
+def unpack(rec, oft=0):
+    """Return (tod, source) for the record at oft in rec."""
+    (ticks, index, chan, source, refid) = RECORD.unpack_from(rec, oft)
+    return (tod.mktod(ticks, index.rstrip('\0'), chan.rstrip('\0'),
+                      refid.rstrip('\0')), source)
+
+def replay(path, start=0):
+    """Generate (tod, source) for each record after the first start."""
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(start * RECLEN)
+        while True:
+            buf = f.read(READCOUNT * RECLEN)
+            cnt = len(buf) // RECLEN
+            for i in xrange(cnt):
+                yield unpack(buf, i * RECLEN)
+            if cnt < READCOUNT:
+                break
+
+class journal(object):
+    """Append-only binary journal file.
+
+    A journal may be shared between threads, all methods take
+    the journal lock.
+
+    """
+    def __init__(self, path=None, synccount=SYNC_COUNT, syncwait=SYNC_WAIT):
+        """Constructor.
+
+        Parameters:
+
+          path -- journal file to open for append
+          synccount -- records to collect before sync
+          syncwait -- longest time in seconds a record waits for sync
+
+        """
+        self.__lock = threading.Lock()
+        self.__f = None
+        self.__buf = bytearray()
+        self.path = None
+        self.synccount = synccount
+        self.syncwait = syncwait
+        self.count = 0		# records in journal, including unsynced
+        self.pending = 0	# records not yet synced
+        self.lastsync = 0.0
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        """Open path for append, discarding any torn trailing record."""
+        self.close()
+        with self.__lock:
+            f = open(path, 'ab')
+            size = os.fstat(f.fileno()).st_size
+            if size % RECLEN != 0:
+                size -= size % RECLEN
+                f.truncate(size)
+            self.__f = f
+            self.path = path
+            self.count = size // RECLEN
+            self.pending = 0
+            self.lastsync = time.time()
+
+    def __sync(self, now):
+        """Write and fsync pending records, lock must be held."""
+        if self.pending > 0 and self.__f is not None:
+            self.__f.write(self.__buf)
+            self.__f.flush()
+            os.fsync(self.__f.fileno())
+            del self.__buf[:]
+            self.pending = 0
+        self.lastsync = now
+
+    def append(self, t, source=SRC_UNKNOWN):
+        """Append tod t to the journal."""
+        with self.__lock:
+            if self.__f is None:
+                return
+            self.__buf.extend(pack(t, source))
+            self.count += 1
+            self.pending += 1
+            now = time.time()
+            if (self.pending >= self.synccount
+                  or now - self.lastsync >= self.syncwait):
+                self.__sync(now)
+
+    def poll(self):
+        """Sync pending records older than the sync wait."""
+        with self.__lock:
+            now = time.time()
+            if self.pending > 0 and now - self.lastsync >= self.syncwait:
+                self.__sync(now)
+
+    def sync(self):
+        """Write out all pending records and return the record count."""
+        with self.__lock:
+            self.__sync(time.time())
+            return self.count
+
+    def close(self):
+        """Sync and close the journal file."""
+        with self.__lock:
+            if self.__f is not None:
+                self.__sync(time.time())
+                self.__f.close()
+                self.__f = None
+
+if __name__ == "__main__":
+    """Append throughput and recovery time for a large journal."""
+    import sys
+    import random
+    import tempfile
+    count = 200000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    tags = ['{0:06x}'.format(random.randint(0, 0xffffff))
+               for i in range(200)]
+    tods = [tod.mktod(36000 * tod.TICKS + i * 7000, '', 'C1',
+                      random.choice(tags)) for i in range(count)]
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'event.jnl')
+    j = journal(path)
+    st = time.time()
+    for t in tods:
+        j.append(t, SRC_RFID)
+    j.close()
+    at = time.time() - st
+    size = os.path.getsize(path)
+
+    # crash leaves a torn record, which is dropped on open
+    with open(path, 'ab') as f:
+        f.write('torn')
+    j = journal(path)
+    assert j.count == count
+    j.close()
+
+    st = time.time()
+    seen = {}
+    for (t, src) in replay(path):
+        seen.setdefault(t.refid, []).append(t)
+    rt = time.time() - st
+    assert sum([len(v) for v in seen.values()]) == count
+    assert seen[tods[-1].refid][-1] == tods[-1]
+    os.unlink(path)
+    os.rmdir(tmp)
+    print('Records: {0:7d}, {1:8d} bytes'.format(count, size))
+    print('  append: {0:0.3f} s, {1:8.0f} rec/s'.format(at, count / at))
+    print('  replay: {0:0.3f} s, {1:8.0f} rec/s'.format(rt, count / rt))
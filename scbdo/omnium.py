@@ -31,7 +31,6 @@ Notes:
 import os
 import logging
 import csv
-import ConfigParser
 import gtk
 import glib
 import gobject
@@ -43,6 +42,8 @@ from scbdo import uiutil
 from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
+from scbdo import snapshot
+from scbdo import resultcache
 
 # Model columns
 COL_BIB = 0
@@ -72,10 +73,10 @@ class omnium(object):
     def loadconfig(self):
         """Load race config from disk."""
         self.riders.clear()
-        cr = ConfigParser.ConfigParser({'startlist':'',
-                                        'showinfo':'Yes',
-                                        'events':'',
-                                        'evnicks':''})
+        cr = snapshot.config({'startlist':'',
+                              'showinfo':'Yes',
+                              'events':'',
+                              'evnicks':''})
         cr.add_section('race')
         cr.add_section('riders') # no need fr omnium??
 
@@ -106,7 +107,7 @@ class omnium(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('race')
         cw.set('race', 'startlist', self.get_startlist())
         cw.set('race', 'events', self.events)
@@ -115,9 +116,9 @@ class omnium(object):
             cw.set('race', 'showinfo', 'Yes')
         else:
             cw.set('race', 'showinfo', 'No')
+        resultcache.dumpresults(cw, self.result_gen())
         self.log.debug('Saving race config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def result_gen(self):
         """Generator function to export a final result."""
@@ -177,12 +178,7 @@ class omnium(object):
 
     def getrider(self, bib):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r         ## DANGER- Leaky ref
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def delrider(self, bib):
         """Remove the specified rider from the model."""
@@ -192,12 +188,7 @@ class omnium(object):
 
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def clearplaces(self):
         """Zero internal model for recalculate."""
@@ -237,9 +228,7 @@ class omnium(object):
         ecnt = 0
         for eno in self.events.split():
             if eno != self.evno:
-                r = self.meet.get_event(eno, False)
-                r.loadconfig()
-                for res in r.result_gen():
+                for res in self.meet.results.get(eno):
                     bib = res[0]
                     lr = self.getrider(bib)
                     if lr is not None:
@@ -488,6 +477,7 @@ class omnium(object):
                                     gobject.TYPE_PYOBJECT, # 6 time total
                                     gobject.TYPE_STRING, # 7 place
                                     gobject.TYPE_PYOBJECT) # event points
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'omnium.ui'))
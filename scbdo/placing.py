@@ -0,0 +1,353 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental result engine for road mass start events.
+
+This module provides a class 'placing' which computes places, bunch
+times and result order for a road race independently of any gtk
+model. The caller supplies a snapshot of rider vectors in current
+display order and receives back the minimal set of row updates and
+row moves required to bring the display into result order.
+
+Results are computed in three steps:
+
+ - assign places from the official place list
+ - order riders on in race, place, finish time and laps
+ - compute bunch times on the 1.12s time gap rule, then re-order
+   riders on in race, place and bunch time (or comment and bib for
+   riders no longer in the race)
+
+The bunch time computation carries state from rider to rider, so
+the engine caches the state at each position of the rough order.
+On each recalculation only the riders from the first changed
+position up to the point where the state matches the cached state
+again are recomputed.
+
+"""
+
+import bisect
+
+from scbdo import tod
+
+# Rider vector columns
+COL_BIB = 0
+COL_INRACE = 1
+COL_PLACE = 2
+COL_RFTIME = 3
+COL_LAPS = 4
+COL_MBUNCH = 5
+COL_CBUNCH = 6
+COL_COMMENT = 7
+
+# Bunch time gap
+BUNCH_GAP = tod.const('1.12')
+
+# Reorder threshold: above this fraction of moved rows, re-order in one go
+MOVE_LIMIT = 0.25
+
+def placemap(places=''):
+    """Return a map of bib to place string and list of duplicates."""
+    ret = {}
+    dups = []
+    idx = 0
+    for placegroup in places.split():
+        curplace = idx + 1
+        for bib in placegroup.split('-'):
+            if bib not in ret:
+                ret[bib] = str(curplace)
+                idx += 1
+            else:
+                dups.append(bib)
+    return (ret, dups)
+
+def tickof(t=None):
+    """Return the tick value of t or None."""
+    if t is not None:
+        return t.ticks
+    return None
+
+def bibkey(bib):
+    """Return a sort key for bib matching the legacy rider bib sorter."""
+    if bib.isdigit():
+        return (0, int(bib))
+    return (1, bib)
+
+def roughkey(r, place):
+    """Return the sort key for the first pass order."""
+    # inrace -> place -> rftime -> laps
+    rt = r[COL_RFTIME]
+    return (not r[COL_INRACE],
+            place == '', place != '' and int(place) or 0,
+            rt is None, rt is not None and rt.ticks or 0,
+            -r[COL_LAPS])
+
+def resultkey(r, place, vb):
+    """Return the sort key for the final result order."""
+    # inrace -> place -> vbunch   OR   not inrace -> comment -> bib
+    if r[COL_INRACE]:
+        return (0, place == '', place != '' and int(place) or 0,
+                vb is None, vb is not None and vb.ticks or 0)
+    else:
+        return (1, r[COL_COMMENT], bibkey(r[COL_BIB]))
+
+def rowmoves(order):
+    """Return a minimal list of (row, after) moves for the new order.
+
+    Rows on a longest increasing subsequence of the new order keep
+    their relative positions, every other row is moved to follow its
+    predecessor in the new order, or to the top when after is None.
+
+    """
+    # patience sort for longest increasing subsequence
+    tails = []
+    tidx = []
+    prev = [None] * len(order)
+    for i, row in enumerate(order):
+        j = bisect.bisect_left(tails, row)
+        if j > 0:
+            prev[i] = tidx[j - 1]
+        if j == len(tails):
+            tails.append(row)
+            tidx.append(i)
+        else:
+            tails[j] = row
+            tidx[j] = i
+    keep = set()
+    i = tidx and tidx[-1] or None
+    while i is not None:
+        keep.add(i)
+        i = prev[i]
+    ret = []
+    for i, row in enumerate(order):
+        if i not in keep:
+            after = None
+            if i > 0:
+                after = order[i - 1]
+            ret.append((row, after))
+    return ret
+
+class placing(object):
+    """Incremental place and bunch time engine."""
+
+    def __init__(self, gap=BUNCH_GAP):
+        self.gap = gap
+        self.recomputed = 0	# count of bunch time steps computed
+        self.clear()
+
+    def clear(self):
+        """Discard cached bunch state."""
+        self.__start = None
+        self.__inputs = []	# rough order bunch inputs
+        self.__state = [(None, None, None)]	# (ft, lt, bt) prior to
+						# each position and at end
+        self.__output = []	# computed cbunch per position
+
+    def __bunchinput(self, r, place):
+        """Return the comparable bunch inputs for a rider."""
+        return (r[COL_BIB], r[COL_INRACE], place != '',
+                tickof(r[COL_MBUNCH]), tickof(r[COL_RFTIME]))
+
+    def __bunchstep(self, r, place, start, ft, lt, bt):
+        """Compute bunch time for one rider, return cbunch and state."""
+        cb = r[COL_CBUNCH]	# not in race: leave untouched
+        if r[COL_INRACE]:
+            if r[COL_MBUNCH] is not None:
+                bt = r[COL_MBUNCH]	# override with manual bunch
+                cb = bt
+            elif r[COL_RFTIME] is not None:
+                # establish elapsed, but allow subsequent override
+                et = r[COL_RFTIME] - start
+
+                # establish bunch time
+                if ft is None:
+                    ft = et.truncate(0)	# compute first time
+                    bt = ft
+                else:
+                    if et < lt or et - lt < self.gap:
+                        pass	# same time
+                    else:
+                        bt = et.truncate(0)
+                cb = bt
+                lt = et
+            else:
+                # empty rftime with non-empty rank implies no time gap
+                if place != '':
+                    cb = bt	# use current bunch time
+                else:
+                    cb = None
+        return (cb, ft, lt, bt)
+
+    def __bunch(self, rough, places, start):
+        """Update cached bunch times from the first changed position."""
+        inputs = [self.__bunchinput(r, places[i]) for (i, r) in rough]
+        if tickof(start) != tickof(self.__start):
+            self.clear()
+        self.__start = start
+        oin = self.__inputs
+        nl = len(inputs)
+        ol = len(oin)
+
+        # locate first and last changed positions
+        first = 0
+        ml = min(nl, ol)
+        while first < ml and inputs[first] == oin[first]:
+            first += 1
+        if first == nl and nl == ol:
+            return self.__output	# no change
+        tail = 0
+        while (tail < ml - first
+               and inputs[nl - tail - 1] == oin[ol - tail - 1]):
+            tail += 1
+        shift = ol - nl
+
+        state = self.__state[0:first]
+        output = self.__output[0:first]
+        (ft, lt, bt) = self.__state[first]
+        i = first
+        while True:
+            if i >= nl - tail:
+                # unchanged suffix: stop once state matches the cache
+                cs = self.__state[i + shift]
+                if (tickof(cs[0]) == tickof(ft)
+                      and tickof(cs[1]) == tickof(lt)
+                      and tickof(cs[2]) == tickof(bt)):
+                    state.extend(self.__state[i + shift:])
+                    output.extend(self.__output[i + shift:])
+                    break
+            state.append((ft, lt, bt))
+            if i == nl:
+                break
+            (idx, r) = rough[i]
+            (cb, ft, lt, bt) = self.__bunchstep(r, places[idx], start,
+                                                ft, lt, bt)
+            output.append(cb)
+            self.recomputed += 1
+            i += 1
+        self.__inputs = inputs
+        self.__state = state
+        self.__output = output
+        return output
+
+    def recalculate(self, riders, places='', start=None):
+        """Recalculate result for the supplied rider vectors.
+
+        riders is a list of rider vectors in current display order.
+        Returns a tuple (updates, order, dups) where updates is a
+        list of (row, place, cbunch) for rows that have changed,
+        order is the new display order as a list of rows, or None
+        if no re-order is required and dups is a list of bibs
+        repeated in the place list.
+
+        """
+        (pmap, dups) = placemap(places)
+        nplaces = [pmap.get(r[COL_BIB], '') for r in riders]
+
+        # rough order on in race, place, rftime and laps
+        rough = [(i, r) for (i, r) in enumerate(riders)]
+        rough.sort(key=lambda ir: roughkey(ir[1], nplaces[ir[0]]))
+
+        # bunch times, only when the race has started
+        ncbunch = [r[COL_CBUNCH] for r in riders]
+        if start is not None:
+            output = self.__bunch(rough, nplaces, start)
+            for (pos, (i, r)) in enumerate(rough):
+                if r[COL_INRACE]:
+                    ncbunch[i] = output[pos]
+        else:
+            self.clear()
+
+        # collect changed rows
+        updates = []
+        for (i, r) in enumerate(riders):
+            if (nplaces[i] != r[COL_PLACE]
+                  or tickof(ncbunch[i]) != tickof(r[COL_CBUNCH])
+                  or (ncbunch[i] is None) != (r[COL_CBUNCH] is None)):
+                updates.append((i, nplaces[i], ncbunch[i]))
+
+        # final order on in race, place and bunch time
+        order = [i for (i, r) in rough]
+        vbk = {}
+        for i in order:
+            r = riders[i]
+            vb = r[COL_MBUNCH]
+            if vb is None:
+                vb = ncbunch[i]
+            vbk[i] = resultkey(r, nplaces[i], vb)
+        order.sort(key=vbk.get)
+        if order == range(len(riders)):
+            order = None
+        return (updates, order, dups)
+
+if __name__ == "__main__":
+    """Compare incremental and full recalculation on a large field."""
+    import random
+    import time
+    random.seed(1)
+    count = 300
+    edits = 50
+    st = tod.tod('10:00:00')
+    riders = []
+    t = st + tod.tod('3:01:00')
+    for i in range(1, count + 1):
+        t = t + tod.tod('0.{0:02d}'.format(random.randint(5, 99)))
+        if random.random() < 0.02:
+            t = t + tod.tod(random.randint(2, 30))
+        riders.append([str(i), True, '', t, 12, None, None, ''])
+    random.shuffle(riders)
+
+    def apply(eng, riders, places):
+        """Run one recalculation and apply results to the rider list."""
+        (updates, order, dups) = eng.recalculate(riders, places, st)
+        for (i, pl, cb) in updates:
+            riders[i][COL_PLACE] = pl
+            riders[i][COL_CBUNCH] = cb
+        moves = 0
+        if order is not None:
+            moves = len(rowmoves(order))
+            riders[:] = [riders[i] for i in order]
+        return (len(updates), moves)
+
+    def run(incremental):
+        random.seed(2)
+        rv = [list(r) for r in riders]
+        eng = placing()
+        apply(eng, rv, '')
+        places = []
+        nupd = 0
+        nmov = 0
+        start = time.time()
+        for e in range(edits):
+            # alternately place a finisher and move a bunch time
+            if e % 2 == 0:
+                places.append(rv[random.randint(len(places),
+                                                count - 1)][COL_BIB])
+            else:
+                r = rv[random.randint(len(places), count - 1)]
+                r[COL_MBUNCH] = (r[COL_RFTIME] - st).truncate(0)
+            if not incremental:
+                eng.clear()
+            (u, m) = apply(eng, rv, ' '.join(places))
+            nupd += u
+            nmov += m
+        return (time.time() - start, eng.recomputed, nupd, nmov, rv)
+
+    (ft, fr, fu, fm, fv) = run(False)
+    (it, ir, iu, im, iv) = run(True)
+    assert [r[COL_BIB] for r in fv] == [r[COL_BIB] for r in iv]
+    print('Riders: ' + str(count) + ', edits: ' + str(edits))
+    print('  full: {0:7.3f} s, {1:6d} bunch steps'.format(ft, fr))
+    print('  incr: {0:7.3f} s, {1:6d} bunch steps'.format(it, ir))
+    print('  view: {0:6d} row updates, {1:6d} row moves'.format(iu, im))
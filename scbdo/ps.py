@@ -31,7 +31,6 @@ import os
 import logging
 import csv
 import decimal
-import ConfigParser
 
 import scbdo
 from scbdo import timy
@@ -41,6 +40,9 @@ from scbdo import uiutil
 from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
+from scbdo import snapshot
+from scbdo import resultcache
+from scbdo import eventmodel
 
 # Model columns
 SPRINT_COL_ID = 0
@@ -103,16 +105,16 @@ class ps(object):
         if self.evtype == 'madison':
             defscoretype = 'madison'
             defmasterslaps = 'No'
-        cr = ConfigParser.ConfigParser({'startlist':'',
-					'start':'',
-                                        'lstart':'',
-                                        'finish':'',
-                                        'sprintlaps':'',
-                                        'distance':'',
-                                        'distunits':'laps',
-                                        'masterslaps':defmasterslaps,
-                                        'showinfo':'Yes',
-                                        'scoring':defscoretype})
+        cr = snapshot.config({'startlist':'',
+                              'start':'',
+                              'lstart':'',
+                              'finish':'',
+                              'sprintlaps':'',
+                              'distance':'',
+                              'distunits':'laps',
+                              'masterslaps':defmasterslaps,
+                              'showinfo':'Yes',
+                              'scoring':defscoretype})
         cr.add_section('race')
         cr.add_section('sprintplaces')
         cr.add_section('sprintpoints')
@@ -126,7 +128,7 @@ class ps(object):
         for r in cr.get('race', 'startlist').split():
             nr=[r, '', '', '', True, 0, 0, 0, '', -1, '', 0]
             if cr.has_option('points', r):
-                ril = csv.reader([cr.get('points', r)]).next()
+                ril = cr.getrow('points', r)
                 for i in range(0,3):
                     if len(ril) > i:
                         nr[i+1] = ril[i].strip()
@@ -220,7 +222,7 @@ class ps(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('race')
         if self.start is not None:
             cw.set('race', 'start', self.start.rawtime())
@@ -264,11 +266,10 @@ class ps(object):
             slice = [r[RES_COL_FIRST], r[RES_COL_LAST], r[RES_COL_CLUB], 
                      bf, str(r[RES_COL_POINTS]), str(r[RES_COL_LAPS]),
                      str(r[RES_COL_INFO]), str(r[RES_COL_STPTS])]
-            cw.set('points', r[RES_COL_BIB], 
-                ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+            cw.setrow('points', r[RES_COL_BIB], slice)
+        resultcache.dumpresults(cw, self.result_gen())
         self.log.debug('Saving points config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def result_gen(self):
         """Generator function to export a final result."""
@@ -351,21 +352,11 @@ class ps(object):
 
     def getrider(self, bib):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[RES_COL_BIB] == bib:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, RES_COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def addrider(self, bib=''):
         """Add specified rider to race model."""
@@ -1133,58 +1124,6 @@ class ps(object):
             r[RES_COL_TOTAL] = r[RES_COL_STPTS] + r[RES_COL_POINTS] + (self.lappoints
                                   * r[RES_COL_LAPS])
 
-    # Sorting performed in-place on aux table with cols:
-    #  0 INDEX		Index in main model
-    #  1 BIB		Rider's bib
-    #  2 INRACE		Bool rider still in race?
-    #  3 LAPS		Rider's laps up/down
-    #  4 TOTAL		Total points scored
-    #  5 FINAL		Rider's place in final sprint (-1 for unplaced)
-
-    # Point score sorting:
-    # inrace / points / final sprint
-    def sortpoints(self, x, y):
-        if x[2] != y[2]:	# compare inrace
-            if x[2]:
-                return -1
-            else:
-                return 1
-        else:			# defer to points
-            return self.sortpointsonly(x, y)
-                        
-    def sortpointsonly(self, x, y):
-        if x[4] > y[4]:
-            return -1
-        elif x[4] < y[4]:
-            return 1
-        else:		# defer to last sprint
-            if x[5] == y[5]:
-                #self.log.warn('Sort could not split riders.')
-                return 0	# places same - or both unplaced
-            else:
-                xp = x[5]
-                if xp < 0: xp = 9999
-                yp = y[5]
-                if yp < 0: yp = 9999
-                return cmp(xp, yp)
-        self.log.error('Sort comparison did not match any paths.')
-
-    # Madison score sorting:
-    # inrace / laps / points / final sprint
-    def sortmadison(self, x, y):
-        if x[2] != y[2]:	# compare inrace
-            if x[2]:
-                return -1
-            else:
-                return 1
-        else:			# defer to distance (laps)
-            if x[3] > y[3]:
-                return -1
-            elif x[3] < y[3]:
-                return 1
-            else:		# defer to points / final sprint
-                return self.sortpointsonly(x, y)
-
     # result recalculation
     def recalculate(self):
         self.zeropoints()
@@ -1207,9 +1146,9 @@ class ps(object):
                            r[RES_COL_FINAL] ])
             idx += 1
         if self.scoring == 'madison':
-            auxtbl.sort(self.sortmadison)
+            auxtbl.sort(eventmodel.sortmadison)
         else:
-            auxtbl.sort(self.sortpoints)
+            auxtbl.sort(eventmodel.sortpoints)
         self.riders.reorder([a[0] for a in auxtbl])
         place = 0
         idx = 0
@@ -1219,10 +1158,12 @@ class ps(object):
                     place = 1
                 else:
                     if self.scoring == 'madison':
-                        if self.sortmadison(auxtbl[idx - 1], auxtbl[idx]) != 0:
+                        if eventmodel.sortmadison(auxtbl[idx - 1],
+                                        auxtbl[idx]) != 0:
                             place = idx + 1
                     else:
-                        if self.sortpoints(auxtbl[idx - 1], auxtbl[idx]) != 0:
+                        if eventmodel.sortpoints(auxtbl[idx - 1],
+                                        auxtbl[idx]) != 0:
                             place = idx + 1
                 r[RES_COL_PLACE] = str(place)
                 idx += 1
@@ -1354,6 +1295,7 @@ class ps(object):
                                     gobject.TYPE_INT, # FINAL = 9
                                     gobject.TYPE_STRING, # INFO = 10
                                     gobject.TYPE_INT) # STPTS = 11
+        self.ridx = uiutil.rowindex(self.riders, RES_COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'ps.ui'))
@@ -57,7 +57,6 @@ import gobject
 import pango
 import decimal
 import logging
-import ConfigParser
 import csv
 import os
 
@@ -68,6 +67,8 @@ from scbdo import eventdb
 from scbdo import scbwin
 from scbdo import uiutil
 from scbdo import strops
+from scbdo import snapshot
+from scbdo import resultcache
 
 # race model column constants
 COL_BIB = 0
@@ -108,21 +109,11 @@ class race(object):
 
     def getrider(self, bib):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r		## DANGER- Leaky ref
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def addrider(self, bib=''):
         """Add specified rider to race model."""
@@ -196,17 +187,17 @@ class race(object):
             deftimetype = '200m'
             defdistunits = 'metres'
             defdistance = '200'
-        cr = ConfigParser.ConfigParser({'startlist':'',
-                                        'ctrl_places':'',
-                                        'start':'',
-                                        'lstart':'',
-                                        'finish':'',
-					'distance':defdistance,
-					'distunits':defdistunits,
-                                        'topn_places':'0',
-                                        'topn_event':'',
-                                        'showinfo':'Yes',
-                                        'timetype':deftimetype})
+        cr = snapshot.config({'startlist':'',
+                              'ctrl_places':'',
+                              'start':'',
+                              'lstart':'',
+                              'finish':'',
+                              'distance':defdistance,
+                              'distunits':defdistunits,
+                              'topn_places':'0',
+                              'topn_event':'',
+                              'showinfo':'Yes',
+                              'timetype':deftimetype})
         cr.add_section('race')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -216,7 +207,7 @@ class race(object):
         for r in cr.get('race', 'startlist').split():
             nr=[r, '', '', '', '', False, '']
             if cr.has_option('riders', r):
-                ril = csv.reader([cr.get('riders', r)]).next()
+                ril = cr.getrow('riders', r)
                 for i in range(0,6):
                     if len(ril) > i:
                         nr[i+1] = ril[i].strip()
@@ -380,7 +371,7 @@ class race(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('race')
         if self.start is not None:
             cw.set('race', 'start', self.start.rawtime())
@@ -407,11 +398,10 @@ class race(object):
                 bf='True'
             slice = [r[COL_FIRSTNAME], r[COL_LASTNAME],
                      r[COL_CLUB], r[COL_INFO], bf, r[COL_PLACE]]
-            cw.set('riders', r[COL_BIB], 
-                ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+            cw.setrow('riders', r[COL_BIB], slice)
+        resultcache.dumpresults(cw, self.result_gen())
         self.log.debug('Saving race config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
         # to a topn transfer if flag set - and then clear it
         if self.topn_transfer:
@@ -922,6 +912,7 @@ class race(object):
                                     gobject.TYPE_STRING, # 4 xtra info
                                     gobject.TYPE_BOOLEAN,# 5 DNF/DNS
                                     gobject.TYPE_STRING) # 6 placing
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'race.ui'))
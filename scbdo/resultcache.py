@@ -0,0 +1,268 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached event results for aggregates.
+
+Track event handlers write the vectors produced by result_gen() into
+a 'results' section of their saved config with dumpresults(). The
+class 'resultcache' reads those vectors back without constructing a
+race object, and keeps them in memory until the event's config file
+changes on disk.
+
+A result vector is the list [bib, rank, time] where rank is None,
+an integer place or a string such as 'dnf', and time is None or a
+tod object. Configs saved before the results section was added are
+loaded once through the full race handler.
+
+Omnium and aggregate configs list their constituent events in the
+option 'events'. Their saved vectors may be stale, so they are always
+recalculated through the handler, and their cache entry is also keyed
+on the cache entries of the constituent events.
+
+"""
+
+import os
+import logging
+
+from scbdo import tod
+from scbdo import strops
+from scbdo import snapshot
+
+def dumpresults(cw, results):
+    """Write result vectors into the 'results' section of cw."""
+    row = []
+    for (bib, rank, time) in results:
+        rs = ''
+        if rank is not None:
+            rs = str(rank)
+        ts = ''
+        if time is not None:
+            ts = str(time.ticks)
+        row.extend([bib, rs, ts])
+    cw.add_section('results')
+    cw.setrow('results', 'vectors', row)
+
+def loadresults(path):
+    """Return result vectors saved in path, or None if not available."""
+    cr = snapshot.config()
+    if len(cr.read(path)) == 0:
+        return None
+    return readresults(cr)
+
+def readresults(cr):
+    """Return result vectors saved in config cr, or None."""
+    if not cr.has_option('results', 'vectors'):
+        return None
+    row = cr.getrow('results', 'vectors')
+    ret = []
+    for i in xrange(0, len(row) - 2, 3):
+        rank = row[i+1]
+        if rank == '':
+            rank = None
+        elif rank.isdigit():
+            rank = int(rank)
+        time = row[i+2]
+        if time == '':
+            time = None
+        else:
+            time = tod.mktod(int(time))
+        ret.append([row[i], rank, time])
+    return ret
+
+class resultcache(object):
+    """Meet level cache of event result vectors."""
+
+    def __init__(self, meet):
+        """Constructor.
+
+        Parameters:
+
+          meet -- meet providing event_configpath() and get_event()
+
+        """
+        self.meet = meet
+        self.log = logging.getLogger('scbdo.resultcache')
+        self.log.setLevel(logging.DEBUG)
+        self.loads = 0		# count of result vectors read from disk
+        self.__cache = {}	# evno -> (stamp, result vectors)
+        self.__files = {}	# evno -> (file stamp, events, saved vectors)
+        self.__active = set()	# events being read, to break cycles
+
+    def clear(self, evno=None):
+        """Drop cached results for evno, or all events."""
+        if evno is None:
+            self.__cache.clear()
+            self.__files.clear()
+        else:
+            self.__cache.pop(evno, None)
+            self.__files.pop(evno, None)
+
+    def __readfile(self, evno, path):
+        """Return (file stamp, events, saved vectors) for evno."""
+        fstamp = None
+        try:
+            st = os.stat(path)
+            fstamp = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            pass
+        ret = self.__files.get(evno)
+        if ret is None or ret[0] != fstamp:
+            events = []
+            saved = None
+            cr = snapshot.config()
+            if fstamp is not None and len(cr.read(path)) > 0:
+                saved = readresults(cr)
+                if cr.has_option('race', 'events'):
+                    events = [e for e in strops.reformat_bibserlist(
+                                 cr.get('race', 'events')).split()
+                                if e != evno]
+            ret = (fstamp, events, saved)
+            self.__files[evno] = ret
+        return ret
+
+    def stamp(self, evno):
+        """Return the cache stamp of the current results for evno."""
+        self.get(evno)
+        ent = self.__cache.get(evno)
+        if ent is not None:
+            return ent[0]
+        return None
+
+    def get(self, evno):
+        """Return the list of result vectors for event evno."""
+        path = self.meet.event_configpath(evno)
+        if path is None:
+            self.log.error('Result for missing event: ' + repr(evno))
+            return []
+        if evno in self.__active:
+            self.log.error('Circular aggregate event: ' + repr(evno))
+            return []
+        self.__active.add(evno)
+        try:
+            (fstamp, events, saved) = self.__readfile(evno, path)
+            stamp = (fstamp, tuple([self.stamp(e) for e in events]))
+            if evno in self.__cache:
+                (ostamp, ret) = self.__cache[evno]
+                if ostamp == stamp:
+                    return ret
+            ret = None
+            if len(events) == 0:
+                ret = saved
+            if ret is None:
+                # aggregate or no saved vectors, use the event handler
+                self.log.debug('Loading results via handler for event '
+                               + repr(evno))
+                r = self.meet.get_event(evno, False)
+                ret = []
+                if r is not None:
+                    r.loadconfig()
+                    ret = [list(res) for res in r.result_gen()]
+            self.loads += 1
+            self.__cache[evno] = (stamp, ret)
+            return ret
+        finally:
+            self.__active.discard(evno)
+
+if __name__ == "__main__":
+    """Time cold and cached result reads for a six event omnium."""
+    import sys
+    import time
+    import tempfile
+    from scbdo import eventmodel
+
+    class fakemeet(object):
+        def __init__(self, path):
+            self.configpath = path
+        def event_configpath(self, evno):
+            return os.path.join(self.configpath, 'event_' + evno + '.ini')
+        def get_event(self, evno, ui=False):
+            return None
+
+    class aggmeet(fakemeet):
+        def __init__(self, path):
+            fakemeet.__init__(self, path)
+            self.results = resultcache(self)
+            self.types = {}
+        def get_event(self, evno, ui=False):
+            return eventmodel.mkevent(self.event_configpath(evno), evno,
+                                      self.types.get(evno, ''), '', self)
+        def get_distance(self, count=None, units='metres'):
+            return None
+
+    count = 40
+    events = ['1', '2', '3', '4', '5', '6']
+    loops = 200
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    tmp = tempfile.mkdtemp()
+    meet = fakemeet(tmp)
+    for evno in events:
+        cw = snapshot.config()
+        cw.add_section('race')
+        cw.set('race', 'startlist', ' '.join(map(str, range(count))))
+        cw.add_section('riders')
+        for i in range(count):
+            cw.setrow('riders', str(i), ['First', 'Last', 'Club', '', '',
+                                         str(i + 1)])
+        dumpresults(cw, [[str(i), i + 1, tod.tod('1:0' + evno + '.123')]
+                            for i in range(count)])
+        cw.save(meet.event_configpath(evno))
+
+    rc = resultcache(meet)
+    st = time.time()
+    for i in range(loops):
+        rc.clear()
+        for evno in events:
+            rc.get(evno)
+    ct = (time.time() - st) / loops
+    st = time.time()
+    for i in range(loops):
+        for evno in events:
+            res = rc.get(evno)
+    ht = (time.time() - st) / loops
+    assert res[3] == ['3', 4, tod.tod('1:06.123')]
+    for evno in events:
+        os.unlink(meet.event_configpath(evno))
+
+    # aggregate 9 over omnium 8 over scratch 7: changing 7 updates 9
+    agg = aggmeet(tmp)
+    agg.types = {'7':'scratch', '8':'omnium', '9':'aggregate'}
+    bibs = ['1', '2', '3']
+    def saveevent(evno, key, value):
+        cw = snapshot.config()
+        cw.add_section('race')
+        cw.set('race', 'startlist', ' '.join(bibs))
+        cw.set('race', key, value)
+        cw.add_section('riders')
+        for b in bibs:
+            cw.setrow('riders', b, ['First', 'Last', 'Club', '', '', ''])
+        cw.save(agg.event_configpath(evno))
+        e = agg.get_event(evno)
+        e.loadconfig()
+        e.saveconfig()
+    saveevent('7', 'ctrl_places', ' '.join(bibs))
+    saveevent('8', 'events', '7')
+    saveevent('9', 'events', '8')
+    assert [r[0] for r in agg.results.get('9')] == bibs
+    saveevent('7', 'ctrl_places', ' '.join(reversed(bibs)))
+    # saved vectors in 8 and 9 are now stale
+    assert [r[0] for r in agg.results.get('9')] == list(reversed(bibs))
+    for evno in ['7', '8', '9']:
+        os.unlink(agg.event_configpath(evno))
+    os.rmdir(tmp)
+    print('Events: {0}, riders: {1}'.format(len(events), count))
+    print('  cold: {0:0.3f} ms per recalculate'.format(1000.0 * ct))
+    print('   hit: {0:0.3f} ms per recalculate'.format(1000.0 * ht))
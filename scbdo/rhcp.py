@@ -30,7 +30,6 @@ import pango
 import os
 import logging
 import csv
-import ConfigParser
 
 import scbdo
 from scbdo import timy
@@ -40,6 +39,7 @@ from scbdo import uiutil
 from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
+from scbdo import snapshot
 
 # startlist model columns
 COL_BIB = 0
@@ -110,12 +110,11 @@ class rhcp(object):
 
         # defaults
         # +type specific overrides
-        cr = ConfigParser.ConfigParser({'startlist':'',
-					'start':'',
-                                        'lstart':'',
-                                        'places':'',
-                                        'limit':''
-                                       })
+        cr = snapshot.config({'startlist':'',
+                              'start':'',
+                              'lstart':'',
+                              'places':'',
+                              'limit':''})
         cr.add_section('race')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -130,7 +129,7 @@ class rhcp(object):
             if cr.has_option('riders', rs):
                 # bbb.sss = comment,inrace,hcap,finish,mbunch
                 nr = self.getrider(r, s)
-                ril = csv.reader([cr.get('riders', rs)]).next()
+                ril = cr.getrow('riders', rs)
                 lr = len(ril)
                 if lr > 0:
                     nr[COL_COMMENT] = ril[0]
@@ -165,7 +164,7 @@ class rhcp(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
 
         # save basic race properties
         cw.add_section('race')
@@ -195,11 +194,10 @@ class rhcp(object):
                 #if r[COL_TODFINISH] is not None:
                     #tft = r[COL_TODFINISH].rawtime()
                 slice = [r[COL_COMMENT], wst, tst, tft, r[COL_PLACE]]
-                cw.set('riders', strops.bibser2bibstr(r[COL_BIB], r[COL_SERIES]),
-                    ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+                cw.setrow('riders', strops.bibser2bibstr(r[COL_BIB],
+                                                      r[COL_SERIES]), slice)
         self.log.debug('Saving race config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def get_startlist(self):
         """Return a list of bibs in the rider model as b.s."""
@@ -319,12 +317,7 @@ class rhcp(object):
 
     def getrider(self, bib, series=''):
         """Return temporary reference to model row."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib and r[COL_SERIES] == series:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib, series)
 
     def addrider(self, bib='', series=''):
         """Add specified rider to race model."""
@@ -348,14 +341,7 @@ class rhcp(object):
 
     def getiter(self, bib, series=''):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i,
-                     COL_BIB) == bib and self.riders.get_value(i,
-                     COL_SERIES) == series:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib, series)
 
     def time_context_menu(self, widget, event, data=None):
         """Popup menu for result list."""
@@ -481,6 +467,7 @@ class rhcp(object):
                                     gobject.TYPE_PYOBJECT, # 8 c-bunch
                                     gobject.TYPE_PYOBJECT, # 9 m-bunch
                                     gobject.TYPE_STRING)   # 10 place
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB, COL_SERIES)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'rhcp.ui'))
@@ -72,9 +72,21 @@ class riderdb(object):
         self.model.clear()
 
     def load(self, csvfile=None):
-        """Load riders from supplied CSV file."""
+        """Load riders from supplied CSV file.
+
+        Rows are read and checked in one pass, then appended to the
+        model with the view detached and index updates suspended.
+        Duplicate and invalid numbers are reported in a single summary.
+
+        """
         if os.path.isfile(csvfile):
             self.log.debug('Loading riders from %s', csvfile)
+            seen = set()
+            for r in self.model:
+                seen.add((r[COL_BIB], r[COL_SERIES]))
+            newrows = []
+            dupcnt = 0
+            badcnt = 0
             with open(csvfile, 'rb') as f:
                 cr = csv.reader(f)
                 for row in cr:
@@ -86,13 +98,38 @@ class riderdb(object):
                             for i in range(1,7):
                                 if len(ir) > i:
                                     nr[i] = ir[i].strip()
-                            if self.getrider(bib, nr[COL_SERIES]) is None:
-                                self.model.append(nr)
+                            key = (bib, nr[COL_SERIES])
+                            if key not in seen:
+                                seen.add(key)
+                                newrows.append(nr)
                             else:
-                                self.log.warn('Duplicate No.: %s', bib)
+                                self.log.debug('Duplicate No.: %s', bib)
+                                dupcnt += 1
                         else:
-                            self.log.warn('Invalid No.: %s', bib)
-            self.log.debug('Load riders done.')
+                            self.log.debug('Invalid No.: %s', bib)
+                            badcnt += 1
+            self.__bulkappend(newrows)
+            if dupcnt > 0 or badcnt > 0:
+                self.log.warn('Ignored %d duplicate and %d invalid No.',
+                              dupcnt, badcnt)
+            self.log.debug('Load riders done: %d added.', len(newrows))
+
+    def __bulkappend(self, rows):
+        """Append rows to the model with view and indexes detached."""
+        if len(rows) > 0:
+            if self.view is not None:
+                self.view.set_model(None)
+            self.__bibidx.block()
+            self.__refidx.block()
+            try:
+                for nr in rows:
+                    self.model.append(nr)
+            finally:
+                self.__bibidx.unblock()
+                self.__refidx.unblock()
+                self.__catidx = None
+                if self.view is not None:
+                    self.view.set_model(self.model)
 
     def save(self, csvfile=None):
         """Save current model to supplied CSV file."""
@@ -186,16 +223,7 @@ class riderdb(object):
 
     def getrider(self, bib, series=''):
         """Return a reference to the row with the given bib and series."""
-        ret = None
-        i = self.model.get_iter_first()
-        while i is not None:
-            if (self.model.get_value(i, COL_BIB) == bib
-                and self.model.get_value(i, COL_SERIES) == series):
-                ret = gtk.TreeRowReference(self.model,
-                                           self.model.get_path(i))
-                break
-            i = self.model.iter_next(i)
-        return ret
+        return self.__bibidx.getref(bib, series)
 
     def nextriderno(self):
         """Try and return a new unique rider number string."""
@@ -207,44 +235,28 @@ class riderdb(object):
 
     def getrefid(self, refid):
         """Return a reference to the row with the given refid."""
-        ret = None
-        ck = refid.lower()
-        i = self.model.get_iter_first()
-        while i is not None:
-            if self.model.get_value(i, COL_REFID).lower() == ck:
-                ret = gtk.TreeRowReference(self.model,
-                                           self.model.get_path(i))
-                break
-            i = self.model.iter_next(i)
-        return ret
+        return self.__refidx.getref(refid)
         
     def getbibs(self, cat, series=''):
         """Return a list of refs to riders in the given cat and series."""
-        ret = []
-        i = self.model.get_iter_first()
-        while i is not None:
-            if (self.model.get_value(i, COL_CAT) == cat
-               and self.model.get_value(i, COL_SERIES) == series):
-                ret.append(gtk.TreeRowReference(self.model,
-                                           self.model.get_path(i)))
-            i = self.model.iter_next(i)
-        return ret
+        return list(self.__getcats().get((cat, series), []))
 
     def listseries(self):
         """Return a list of all the series in the rider db."""
         ret = []
-        for row in self.model:
-            if row[COL_SERIES] not in ret:
-                ret.append(row[COL_SERIES])
+        self.__getcats()
+        for (cat, series) in self.__catkeys:
+            if series not in ret:
+                ret.append(series)
         return ret
 
     def listcats(self, series=None):
         """Return a list of all the categories in the specified series."""
         ret = []
-        for row in self.model:
-            if row[COL_CAT] not in ret and (
-                    series is None or row[COL_SERIES] == series):
-                ret.append(row[COL_CAT])
+        self.__getcats()
+        for (cat, cs) in self.__catkeys:
+            if cat not in ret and (series is None or cs == series):
+                ret.append(cat)
         return ret
 
     def getvalue(self, ref, col):
@@ -427,6 +439,27 @@ class riderdb(object):
         else:   # this is crap - but don't know the type
             self.editwasempty = False
 
+    def __getcats(self):
+        """Return the (cat, series) index, rebuilding if required."""
+        if self.__catidx is None:
+            self.__catidx = {}
+            keys = []
+            i = self.model.get_iter_first()
+            while i is not None:
+                key = self.model.get(i, COL_CAT, COL_SERIES)
+                if key not in self.__catidx:
+                    self.__catidx[key] = []
+                    keys.append(key)
+                self.__catidx[key].append(gtk.TreeRowReference(self.model,
+                                                 self.model.get_path(i)))
+                i = self.model.iter_next(i)
+            self.__catkeys = keys
+        return self.__catidx
+
+    def __row_changed_cb(self, model, path, iter=None, data=None):
+        """Mark category index stale on any change to the model."""
+        self.__catidx = None
+
     def __filtercol(self, model, iter, data=None):
         return bool(self.model.get_value(iter, data))
 
@@ -457,6 +490,15 @@ class riderdb(object):
         self.postedit = None
         self.editwasempty = False
 
+        # lookup indexes, maintained from model signals
+        self.__bibidx = uiutil.rowindex(self.model, COL_BIB, COL_SERIES)
+        self.__refidx = uiutil.rowindex(self.model, COL_REFID,
+                                        keyfunc=lambda k: (k[0].lower(),))
+        self.__catidx = None	# (cat, series) -> [refs], built on demand
+        self.__catkeys = []
+        for sig in ['row-inserted', 'row-changed', 'row-deleted']:
+            self.model.connect(sig, self.__row_changed_cb)
+
 if __name__ == "__main__":
     import sys
     import pygtk
@@ -464,6 +506,38 @@ if __name__ == "__main__":
     
     rdb = riderdb()
 
+    # Import and lookup benchmark on a synthetic entry list
+    if len(sys.argv) == 2 and sys.argv[1] == '-b':
+        import tempfile
+        import time
+        count = 10000
+        reads = 20000
+        (fd, csvfile) = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            cw = csv.writer(f)
+            cw.writerow(['No.', 'First Name', 'Last Name', 'Club',
+                         'Category', 'Series(optional)', 'Refid'])
+            for i in range(1, count + 1):
+                cw.writerow([str(i), 'First', 'Last', 'Club', 'A', '',
+                             '{0:06x}'.format(i * 7919)])
+            cw.writerow(['1', 'Duplicate', 'Rider'])
+            cw.writerow(['x-1', 'Invalid', 'Rider'])
+        st = time.time()
+        rdb.load(csvfile)
+        et = time.time() - st
+        os.unlink(csvfile)
+        print('import: ' + str(count) + ' rows in {0:0.3f} s'.format(et))
+        tags = ['{0:06X}'.format((i % count + 1) * 7919)
+                  for i in range(reads)]
+        st = time.time()
+        for t in tags:
+            r = rdb.getrefid(t)
+            rdb.getrider(rdb.getvalue(r, COL_BIB))
+        et = time.time() - st
+        print('lookup: ' + str(reads) + ' tag reads at '
+                + '{0:0.2f} us/read'.format(1e6 * et / reads))
+        sys.exit(0)
+
     # Check cmd line
     filename = 'riders.csv'
     if len(sys.argv) == 2:
@@ -34,13 +34,15 @@ import pango
 import os
 import logging
 import csv
-import ConfigParser
 
 import scbdo
 from scbdo import tod
 from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
+from scbdo import placing
+from scbdo import journal
+from scbdo import snapshot
 from scbdo import printops
 from scbdo import uiutil
 
@@ -87,6 +89,9 @@ key_undo = 'Z'
 # config version string
 EVENT_ID = 'roadrace-1.0'
 
+# rfid and start trigger journal, appended to configpath
+JOURNALEXT = '.jnl'
+
 ## !! NOTE this function will break with py3+ -> change to < > comps
 def sort_bib(x, y):
     """Rider bib sorter."""
@@ -105,15 +110,16 @@ class rms(object):
         """Load event config from disk."""
         self.riders.clear()
         self.resettimer()
-        cr = ConfigParser.ConfigParser({'start':'',
-                                        'lstart':'',
-                                        'id':EVENT_ID,
-                                        'finish':'',
-                                        'finished':'No',
-                                        'places':'',
-                                        'comment':'',
-                                        'resort':'No',
-                                        'startlist':''})
+        cr = snapshot.config({'start':'',
+                              'lstart':'',
+                              'id':EVENT_ID,
+                              'finish':'',
+                              'finished':'No',
+                              'places':'',
+                              'comment':'',
+                              'resort':'No',
+                              'journal':'',
+                              'startlist':''})
         cr.add_section('event')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -128,7 +134,7 @@ class rms(object):
             if cr.has_option('riders', r):
                 nr = self.getrider(r)
                 # bib = comment,in,laps,rftod,mbunch,rfseen...
-                ril = csv.reader([cr.get('riders', r)]).next()
+                ril = cr.getrow('riders', r)
                 lr = len(ril)
                 if lr > 0:
                     nr[COL_COMMENT] = ril[0]
@@ -154,6 +160,13 @@ class rms(object):
         self.comment = cr.get('event', 'comment').splitlines()
         if cr.get('event', 'finished') == 'Yes':
             self.set_finished()
+
+        # apply journal records saved after the config snapshot
+        if not self.readonly:
+            self.journal.open(self.configpath + JOURNALEXT)
+        jcount = cr.get('event', 'journal')
+        if jcount.isdigit():
+            self.replay_journal(int(jcount))
         self.recalculate()
 
         # After load complete - check config and report. This ensures
@@ -199,7 +212,7 @@ class rms(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('event')
         if self.start is not None:
             cw.set('event', 'start', self.start.rawtime())
@@ -231,12 +244,11 @@ class rms(object):
             for t in r[COL_RFSEEN]:
                 if t is not None:
                     slice.append(t.rawtime(2))
-            cw.set('riders', r[COL_BIB],
-                    ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+            cw.setrow('riders', r[COL_BIB], slice)
+        cw.set('event', 'journal', str(self.journal.sync()))
         cw.set('event', 'id', EVENT_ID)
         self.log.debug('Saving config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def show(self):
         """Show event container."""
@@ -585,21 +597,11 @@ class rms(object):
 
     def getrider(self, bib):
         """Return reference to selected rider no."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def delrider(self, bib=''):
         """Remove the specified rider from the model."""
@@ -764,17 +766,36 @@ class rms(object):
         self.log.debug('Event shutdown: ' + msg)
         if not self.readonly:
             self.saveconfig()
+        self.journal.close()
         self.meet.edb.editevent(self.event, winopen=False)
         self.winopen = False
 
     def starttrig(self, e):
         """Process a 'start' trigger signal."""
         if self.timerstat == 'armstart':
+            self.journal.append(e, journal.SRC_EVENT)
             self.set_start(e, tod.tod('now'))
             self.meet.scb.set_start(self.start)
 
-    def rfidtrig(self, e):
+    def replay_journal(self, start=0):
+        """Re-apply event journal records after start."""
+        cnt = 0
+        announce = self.live_announce
+        self.live_announce = False
+        for (e, src) in journal.replay(self.configpath + JOURNALEXT, start):
+            if e.refid != 'trig':
+                self.rfidtrig(e, replay=True)
+            elif self.start is None:
+                self.set_start(e)
+            cnt += 1
+        self.live_announce = announce
+        if cnt > 0:
+            self.log.info('Replayed ' + str(cnt) + ' journal records.')
+
+    def rfidtrig(self, e, replay=False):
         """Process rfid event."""
+        if not replay:
+            self.journal.append(e, journal.SRC_RFID)
         r = self.meet.rdb.getrefid(e.refid)
         if r is None:
             self.log.info('Unknown tag: ' + e.refid + '@' + e.rawtime(1))
@@ -813,7 +834,7 @@ class rms(object):
         ct = et.truncate(0)
         if self.scratch_start is None:
             if self.last_scratch is None:
-                self.last_scratch = tod.tod('0')
+                self.last_scratch = tod.ZERO
             self.scratch_start = ct
             self.scratch_last = et
             self.scratch_count = 1
@@ -828,7 +849,7 @@ class rms(object):
                 (self.scratch_start - self.last_scratch).rawtime(0).rjust(7)]))
         else:
             self.scratch_tot += 1
-            if et < self.scratch_last or et - self.scratch_last < tod.tod('1.12'): # same bunch
+            if et < self.scratch_last or et - self.scratch_last < tod.const('1.12'): # same bunch
                 self.scratch_count += 1
                 self.meet.scratch_log(' '.join([
                     str(self.scratch_tot).ljust(3),
@@ -887,7 +908,7 @@ class rms(object):
                                 + ' - Final Result')
         placeset = set()
         idx = 0
-        st = tod.tod('0')
+        st = tod.ZERO
         if self.start is not None:
             st = self.start
         # result is sent in final units, not absolutes
@@ -983,6 +1004,7 @@ class rms(object):
             else:
                 self.starttrig(e)
             e = self.meet.rfu.response()
+        self.journal.poll()
         if self.finish is None and self.start is not None:
             self.set_elapsed()
         return True
@@ -1102,83 +1124,6 @@ class rms(object):
         for r in self.riders:
             r[COL_PLACE] = ''
             
-    def sortrough(self, x, y):
-        # aux cols: ind, bib, in, place, rftime, laps
-        #             0    1   2      3       4     5
-        if x[2] != y[2]:		# in the race?
-            if x[2]:
-                return -1
-            else:
-                return 1
-        else:
-            if x[3] != y[3]:		# places not same?
-                if y[3] == '':
-                    return -1
-                elif x[3] == '':
-                    return 1
-                if int(x[3]) < int(y[3]):
-                    return -1
-                else:
-                    return 1
-            else:
-                if x[4] == y[4]:	# same time?
-                    if x[5] == y[5]:	# same laps?
-                        return 0
-                    else:
-                        if x[5] > y[5]:
-                            return -1
-                        else:
-                            return 1
-                else:
-                    if y[4] is None:
-                        return -1
-                    elif x[4] is None:
-                        return 1
-                    elif x[4] < y[4]:
-                        return -1
-                    else:
-                        return 1
-        return 0
-
-    # do final sort on manual places then manual bunch entries
-    def sortvbunch(self, x, y):
-        # aux cols: ind, bib, in, place, vbunch, comment
-        #             0    1   2      3       4        5
-        if x[2] != y[2]:		# in the race?
-            if x[2]:
-                return -1
-            else:
-                return 1
-        else:
-            if x[2]:			# in the race...
-                if x[3] != y[3]:		# places not same?
-                    if y[3] == '':
-                        return -1
-                    elif x[3] == '':
-                        return 1
-                    if int(x[3]) < int(y[3]):
-                        return -1
-                    else:
-                        return 1
-                else:
-                    if x[4] == y[4]:	# same time?
-                        return 0
-                    else:
-                        if y[4] is None:
-                            return -1
-                        elif x[4] is None:
-                            return 1
-                        elif x[4] < y[4]:
-                            return -1
-                        else:
-                            return 1
-            else:			# not in the race
-                if x[5] == y[5]:	# same 'comment'
-                    return sort_bib(x, y)	# sort on bib !! BREAK
-                else:
-                    return cmp(x[5], y[5])	# sort comment !!BREAK!
-        return 0
-
     # sort riders according to result rules
     # inrace -> bunch -> place -> rftime
     def sortauxtbl(self, x, y):
@@ -1285,88 +1230,44 @@ class rms(object):
         return True
 
     def recalculate(self):
-        # pass one: clear off old places
-        self.resetplaces()
-
-        # pass two: assign places
-        placeset = set()
-        idx = 0
-        #placestr = self.ctrl_places.get_text()
-        placestr = self.places
-        for placegroup in placestr.split():
-            curplace = idx + 1
-            for bib in placegroup.split('-'):
-                if bib not in placeset:
-                    placeset.add(bib)
-                    r = self.getrider(bib)
-                    if r is None:
-                        self.addrider(bib)
-                        r = self.getrider(bib)
-                    idx += 1
-                    r[COL_PLACE] = str(curplace)
-                else:
-                    self.log.warn('Duplicate no. = ' + str(bib) + ' in places.')
+        """Update places, bunch times and result order in the model."""
+        # pass one: add placed riders missing from the model
+        bibs = set([r[COL_BIB] for r in self.riders])
+        for bib in self.places.replace('-', ' ').split():
+            if bib not in bibs:
+                bibs.add(bib)
+                self.addrider(bib)
 
-        # pass three: do rough sort on in, place, rftime -> existing
-        auxtbl = []
-        idx = 0
-        for r in self.riders:
-            # aux cols: ind, bib, in, place, rftime, laps
-            auxtbl.append([idx, r[COL_BIB], r[COL_INRACE], r[COL_PLACE],
-                           r[COL_RFTIME], r[COL_LAPS]])
-            idx += 1
-        if len(auxtbl) > 1:
-            auxtbl.sort(self.sortrough)
-            self.riders.reorder([a[0] for a in auxtbl])
-
-        # pass four: compute cbunch values on auto time gaps and manual inputs
-        #            At this point all riders are assumed to be in finish order
-        ft = None	# the finish or first bunch time
-        lt = None	# the rftime of last competitor across line
-        bt = None	# the 'current' bunch time
-        if self.start is not None:
-            for r in self.riders:
-                if r[COL_INRACE]:
-                    if r[COL_MBUNCH] is not None:
-                        bt = r[COL_MBUNCH]	# override with manual bunch
-                        r[COL_CBUNCH] = bt
-                    elif r[COL_RFTIME] is not None:
-                        # establish elapsed, but allow subsequent override
-                        et = r[COL_RFTIME] - self.start
-    
-                        # establish bunch time
-                        if ft is None:
-                            ft = et.truncate(0)	# compute first time
-                            bt = ft
-                        else:
-                            if et < lt or et - lt < tod.tod('1.12'): #NTG!
-                                # same time
-                                pass
-                            else:
-                                bt = et.truncate(0)
+        # pass two: snapshot rider vectors in model order
+        iters = []
+        aux = []
+        i = self.riders.get_iter_first()
+        while i is not None:
+            iters.append(i)
+            aux.append(self.riders.get(i, COL_BIB, COL_INRACE, COL_PLACE,
+                                          COL_RFTIME, COL_LAPS, COL_MBUNCH,
+                                          COL_CBUNCH, COL_COMMENT))
+            i = self.riders.iter_next(i)
 
-                        # assign and continue
-                        r[COL_CBUNCH] = bt
-                        lt = et
-                    else:
-                        # empty rftime with non-empty rank implies no time gap
-                        if r[COL_PLACE] != '':
-                            r[COL_CBUNCH] = bt	# use current bunch time
-                        else: r[COL_CBUNCH] = None
-                
-        # pass five: resort on in,vbunch (todo -> check if place cmp reqd)
-        #            at this point all riders will have valid bunch time
-        auxtbl = []
-        idx = 0
-        for r in self.riders:
-            # aux cols: ind, bib, in, place, vbunch
-            auxtbl.append([idx, r[COL_BIB], r[COL_INRACE], r[COL_PLACE],
-                           self.vbunch(r[COL_CBUNCH], r[COL_MBUNCH]),
-                           r[COL_COMMENT]])
-            idx += 1
-        if len(auxtbl) > 1:
-            auxtbl.sort(self.sortvbunch)
-            self.riders.reorder([a[0] for a in auxtbl])
+        # pass three: update places and bunch times from first change
+        (updates, order, dups) = self.engine.recalculate(aux, self.places,
+                                                          self.start)
+        for bib in dups:
+            self.log.warn('Duplicate no. = ' + str(bib) + ' in places.')
+        for (idx, place, cbunch) in updates:
+            self.riders.set(iters[idx], COL_PLACE, place, COL_CBUNCH, cbunch)
+
+        # pass four: move rows into result order
+        if order is not None:
+            moves = placing.rowmoves(order)
+            if len(moves) > placing.MOVE_LIMIT * len(order):
+                self.riders.reorder(order)
+            else:
+                for (row, after) in moves:
+                    ai = None
+                    if after is not None:
+                        ai = iters[after]
+                    self.riders.move_after(iters[row], ai)
         return False	# allow idle add
 
     def __init__(self, meet, event, ui=True):
@@ -1393,6 +1294,8 @@ class rms(object):
         self.places = ''
         self.comment = []
         self.ridermark = None
+        self.engine = placing.placing()
+        self.journal = journal.journal()	# opened in loadconfig
 
         # Scratch pad status variables - check if needed?
         self.last_scratch = None
@@ -1417,6 +1320,7 @@ class rms(object):
                                     gobject.TYPE_PYOBJECT, # CBUNCH = 8
                                     gobject.TYPE_PYOBJECT, # MBUNCH = 9
                                     gobject.TYPE_PYOBJECT) # RFSEEN = 10
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
         self.undomod = gtk.ListStore(gobject.TYPE_STRING, # BIB = 0
                                     gobject.TYPE_STRING, # NAMESTR = 1
                                     gobject.TYPE_STRING, # CAT = 2
@@ -28,7 +28,6 @@ import os
 import sys
 import csv
 import logging
-import ConfigParser
 import random
 
 import scbdo
@@ -38,6 +37,8 @@ from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import wheeltime
 from scbdo import timy
+from scbdo import journal
+from scbdo import snapshot
 from scbdo import uscbsrv
 from scbdo import unt4
 from scbdo import strops
@@ -46,6 +47,8 @@ from scbdo import printops
 from scbdo import uiutil
 
 LOGHANDLER_LEVEL = logging.DEBUG
+RFID_LATENCY_LOG = 60	# seconds between rfid latency log entries
+JOURNALFILE = 'timing.jnl'	# raw timer and rfid journal
 ROADRACE_TYPES = {'irtt':'Road Time Trial',
                   'rms':'Road Race',
                   'rhcp':'Handicap',
@@ -472,6 +475,19 @@ class roadmeet:
         self.scratch_log('--- PC ToD: ' + self.clock_label.get_text() + ' ---')
         self.log.debug('Menubar clock click.')
 
+    ## RFID wakeup callback - deliver tag reads as they arrive
+    def rfidwake(self, source, condition):
+        """Drain the RFID response queue when signalled by the rfu."""
+        if not self.running:
+            return False
+        self.rfu.ack()
+        if self.curevent is not None:
+            self.curevent.timeout()
+        else:
+            while self.rfu.response() is not None:
+                pass
+        return True
+
     ## 'Slow' Timer callback - this is the main event poll routine
     def timeout(self):
         """Update status buttons and time of day clock button."""
@@ -479,8 +495,22 @@ class roadmeet:
             return False
         else:
             # update pc ToD label
-            self.clock_label.set_text(
-                  tod.tod('now').rawtime(places=0,zeros=True))
+            nt = tod.tod('now').rawtime(places=0,zeros=True)
+            if nt != self.clock_label.get_text():
+                self.clock_label.set_text(nt)
+
+            # flush any raw timing records waiting on sync
+            self.journal.poll()
+
+            # periodically log rfid delivery latency
+            self.rfu_latcount += 1
+            if self.rfu_latcount >= RFID_LATENCY_LOG:
+                self.rfu_latcount = 0
+                (cnt, mean, mx) = self.rfu.latency()
+                if cnt > 0:
+                    self.log.debug('RFID latency: ' + str(cnt)
+                           + ' reads, mean {0:0.1f} ms, max {1:0.1f} ms'.format(
+                                 1000.0 * mean, 1000.0 * mx))
 
             # call into race timeout handler
             if self.curevent is not None:
@@ -596,6 +626,7 @@ class roadmeet:
         self.scb.exit(msg)
         self.timer.exit(msg)
         self.timer.join()	# Wait on closure of main timer thread
+        self.journal.close()
         self.started = False
 
     def start(self):
@@ -612,7 +643,7 @@ class roadmeet:
         """Save current meet data to disk."""
         if self.curevent is not None and self.curevent.winopen:
             self.curevent.saveconfig()
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('meet')
         cw.set('meet', 'maintimer', self.timer_port)
         cw.set('meet', 'rfunit', self.rfu_addr)
@@ -632,8 +663,7 @@ class roadmeet:
         cw.set('meet', 'docindex', str(self.docindex))
         cwfilename = os.path.join(self.configpath, 'config')
         self.log.debug('Saving meet config to ' + repr(cwfilename))
-        with open(cwfilename , 'wb') as f:
-            cw.write(f)
+        cw.save(cwfilename, text=True)
         self.rdb.save(os.path.join(self.configpath, 'riders.csv'))
         self.edb.save(os.path.join(self.configpath, 'events.csv'))
         # save out print settings
@@ -647,19 +677,19 @@ class roadmeet:
 	  #-> default timy port should be ''
 
         """Load meet config from disk."""
-        cr = ConfigParser.ConfigParser({'maintimer':'',
-                                        'rfunit':wheeltime.WHEELIP,
-                                        'resultcats':'No',
-					'resultbibs':'Yes',
-                                        'distance':'1.0',
-                                        'docindex':'0',
-                                        'line1':'',
-                                        'line2':'',
-                                        'line3':'',
-                                        'uscbsrv':'',
-                                        'uscbchan':'#announce',
-                                        'uscbopt':'No',
-                                        'logos':''})
+        cr = snapshot.config({'maintimer':'',
+                              'rfunit':wheeltime.WHEELIP,
+                              'resultcats':'No',
+                              'resultbibs':'Yes',
+                              'distance':'1.0',
+                              'docindex':'0',
+                              'line1':'',
+                              'line2':'',
+                              'line3':'',
+                              'uscbsrv':'',
+                              'uscbchan':'#announce',
+                              'uscbopt':'No',
+                              'logos':''})
         cr.add_section('meet')
         cwfilename = os.path.join(self.configpath, 'config')
 
@@ -675,6 +705,9 @@ class roadmeet:
                        '%(asctime)s %(levelname)s:%(name)s: %(message)s'))
         self.log.addHandler(self.loghandler)
 
+        # re-open raw timing journal
+        self.journal.open(os.path.join(self.configpath, JOURNALFILE))
+
         # setup scratchpad? for later thought with load/save/prev/next
         self.find_next_scratchfile()
         self.log.info('Initialised scratchpad #' + str(self.scratch_idx))
@@ -772,6 +805,9 @@ class roadmeet:
         self.timer_port = ''
         self.rfu = wheeltime.wheeltime()
         self.rfu_addr = ''
+        self.journal = journal.journal()	# opened in loadconfig
+        self.timer.setjournal(self.journal)
+        self.rfu.setjournal(self.journal)
         self.scb = uscbsrv.uscbsrv()
 
         b = gtk.Builder()
@@ -804,6 +840,7 @@ class roadmeet:
         self.curevent = None
         self.rfustat = False
         self.rfid_cb = None
+        self.rfu_latcount = 0
 
         # format and connect status and log handlers
         f = logging.Formatter('%(levelname)s:%(name)s: %(message)s')
@@ -834,8 +871,9 @@ class roadmeet:
         # get event db -> loadconfig makes event if not already made
         self.edb = eventdb.eventdb([])
 
-        # start timer
+        # start timer and watch for rfid events
         glib.timeout_add_seconds(1, self.timeout)
+        glib.io_add_watch(self.rfu.wakefd, glib.IO_IN, self.rfidwake)
 
 def main(etype='rms'):
     """Run the road meet application."""
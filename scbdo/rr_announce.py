@@ -37,17 +37,25 @@ from scbdo import unt4
 from scbdo import tod
 from scbdo import uiutil
 from scbdo import strops
+from scbdo import uscbnet
 
 # Global Defaults
 USCBSRV_HOST='localhost'
 USCBSRV_PORT=6667
 USCBSRV_CHANNEL='#announce'
 USCBSRV_SRVNICK='uscbsrv'
+USCBSRV_TRANSPORT='irc'	# or 'relay' for a uscbnet relay server
+USCBSRV_MCAST=''	# optional relay multicast group addr:port
 USCBSRV_CLTNICK='roan_'+str(random.randint(100,999))
 TIMETICK=12	# pixels per second
 FONTSIZE=20	# font size in pixels
 MOTD=''		# Message of the day
 
+# Keepalive ping interval, reconnect and channel rejoin delays in seconds
+PING_INTERVAL=30.0
+RECONNECT_WAIT=2.0
+REJOIN_WAIT=2.0
+
 # Config filename
 CONFIGFILE='road_announce.ini'
 
@@ -101,9 +109,11 @@ class uscbio(threading.Thread):
         self.cb = None
         self.ih = irclib.IRC()
         self.ic = self.ih.server()
-        self.np = tod.tod('now')+tod.tod('30')
-        self.hasconnnected = False
-        self.rdbuf = ''
+        self.il = irclib
+        self.np = time.time() + PING_INTERVAL
+        self.nj = 0.0	# earliest time for next channel join
+        self.rdbuf = unt4.unt4buf()
+        self.batch = []	# messages received in the current wakeup
         self.doreconnect = False
         self.chanstatus = False
         self.host = USCBSRV_HOST
@@ -111,15 +121,37 @@ class uscbio(threading.Thread):
         self.channel = USCBSRV_CHANNEL
         self.cltnick = USCBSRV_CLTNICK
         self.srvnick = USCBSRV_SRVNICK
-        self._curpace = 0.0
+
+    def set_transport(self, transport='irc', mcast=''):
+        """Select the irc or relay transport, call before start()."""
+        if transport == 'relay':
+            group = None
+            if mcast != '':
+                group = uscbnet.mkmcast(mcast)
+            self.ih = uscbnet.netirc('sub', group)
+            self.il = uscbnet
+        else:
+            self.ih = irclib.IRC()
+            self.il = irclib
+        self.ic = self.ih.server()
 
     def setcb(self, cb):
-        """Register the message callback function."""
+        """Register the message callback function.
+
+        The callback is called in the main thread with a list of
+        all the unt4 messages received in one wakeup of the io thread.
+
+        """
         self.cb = cb
 
     def exit(self, msg=None):
         """Request thread termination."""
         self.running = False
+        try:
+            if self.ic.is_connected():
+                self.ic.ping(self.cltnick)	# reply wakes io thread
+        except Exception:
+            pass
 
     def irc_event_cb(self, c, e):
         """Collect and log all IRC events (debug)."""
@@ -145,18 +177,17 @@ class uscbio(threading.Thread):
 
     def unt_msg_cb(self, c, e):
         """Handle a message packet."""
-        su = irclib.nm_to_n(e.source()).lower()
+        su = self.il.nm_to_n(e.source()).lower()
         tg = e.target().lower()
         if su == self.srvnick and tg == self.channel:
-            self._pacing(0.0)
             # Have a 'broadcast' packet ... append and then search
-            self.rdbuf += unt4.decode(''.join(e.arguments()))
-            idx = self.rdbuf.find(chr(unt4.EOT))
-            if idx >= 0:
-                msgtxt = self.rdbuf[0:idx+1]
-                self.rdbuf = self.rdbuf[idx+1:]
-                if self.cb is not None:
-                    glib.idle_add(self.cb, unt4.unt4(unt4str=msgtxt))
+            self.rdbuf.feed(unt4.decode(''.join(e.arguments())))
+            self.batch.extend(self.rdbuf.messages())
+
+    def welcome_cb(self, c, e):
+        """Join channel once the server has accepted the connection."""
+        self.nj = 0.0
+        self._rejoin()
 
     def set_port(self, host=None, port=None, channel=None,
                        cltnick=None, srvnick=None):
@@ -186,17 +217,10 @@ class uscbio(threading.Thread):
         return self.chanstatus
 
     def _rejoin(self):
-        self.ic.join(self.channel)
-
-    def _pacing(self, delay=None):
-        """Adjust internal pacing delay."""
-        if delay is None:
-            self._curpace += 0.1
-            if self._curpace > 1.5:
-                self._curpace = 1.5
-        else:
-            self._curpace = delay
-        return self._curpace
+        now = time.time()
+        if now >= self.nj:
+            self.nj = now + REJOIN_WAIT
+            self.ic.join(self.channel)
 
     def run(self):
         """Called via threading.Thread.start()."""
@@ -207,36 +231,33 @@ class uscbio(threading.Thread):
         self.ic.add_global_handler('part', self.channel_part_cb, -10)
         self.ic.add_global_handler('kick', self.channel_part_cb, -10)
         self.ic.add_global_handler('nicknameinuse', self.nicknameinuse_cb, -10)
+        self.ic.add_global_handler('welcome', self.welcome_cb, -10)
         #self.ic.add_global_handler('all_events', self.irc_event_cb, 0)
         while self.running:
             try:
-                self.ih.process_once(0)
                 if not self.ic.is_connected() or self.doreconnect:
                     self.doreconnect = False
                     self.chanstatus = False
-                    time.sleep(2)
+                    self.rdbuf = unt4.unt4buf()
+                    time.sleep(RECONNECT_WAIT)
                     self._reconnect()
-                    # skip over preliminary connect chatter ready to 
-                    # poll channel status - avoids double channel join
-                    if self.hasconnnected:
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(0)
-                        self.ih.process_once(1)
-                    else:
-                        self.hasconnnected = True
-                if not self.in_channel():
-                    time.sleep(2)
+                    self.nj = time.time() + REJOIN_WAIT
+                elif not self.in_channel():
                     self._rejoin()
-                now = tod.tod('now')
+
+                # block on the server socket until data or next ping
+                now = time.time()
                 if now > self.np:
-                    self.ic.ctcp('PING', self.cltnick, str(int(time.time())))
-                    self.np = now + tod.tod('30')
-                time.sleep(self._pacing())
+                    self.ic.ctcp('PING', self.cltnick, str(int(now)))
+                    self.np = now + PING_INTERVAL
+                wait = self.np - now
+                if not self.in_channel():
+                    wait = min(wait, max(self.nj - now, 0.0) + 0.1)
+                self.ih.process_once(wait)
+                if len(self.batch) > 0:
+                    if self.cb is not None:
+                        glib.idle_add(self.cb, self.batch)
+                    self.batch = []
             except Exception as e:
                 # TODO : FIX HERE?
                 print ('Exception from uscbio: ' + str(e))
@@ -375,7 +396,7 @@ class rr_announce(object):
         self.map_redraw()		# update src map
         self.map_area.queue_draw()	# queue copy to screen
         
-    def append_rider(self, msg):
+    def append_rider(self, msg, redraw=True):
         sr = msg.split(chr(unt4.US))
         if len(sr) == 5:
             rftime = tod.str2tod(sr[4])
@@ -392,7 +413,7 @@ class rr_announce(object):
                         self.cur_bunchcnt,
                         COLOURMAP[self.cur_bunchid][0],
                         rftime]
-                elif rftime < self.last_time or rftime - self.last_time < tod.tod('1.12'):
+                elif rftime < self.last_time or rftime - self.last_time < tod.const('1.12'):
                     # Case 2: Same bunch
                     self.last_time = rftime
                     self.cur_bunchcnt += 1
@@ -418,8 +439,23 @@ class rr_announce(object):
                         '', '', '#fefefe',None]
                 
             self.riders.append(nr)
+            if redraw:
+                self.map_redraw()		# update src map
+                self.map_area.queue_draw()	# queue copy to screen
+
+    def msgs_cb(self, msgs):
+        """Handle a batch of message packets in main thread."""
+        redraw = False
+        for m in msgs:
+            if m.header == 'rider':
+                self.append_rider(m.text, False)
+                redraw = True
+            else:
+                self.msg_cb(m)
+        if redraw:
             self.map_redraw()		# update src map
             self.map_area.queue_draw()	# queue copy to screen
+        return False
 
     def msg_cb(self, m):
         """Handle message packet in main thread."""
@@ -443,6 +479,8 @@ class rr_announce(object):
                                         'channel':USCBSRV_CHANNEL,
                                         'srvnick':USCBSRV_SRVNICK,
                                         'cltnick':USCBSRV_CLTNICK,
+                                        'transport':USCBSRV_TRANSPORT,
+                                        'mcast':USCBSRV_MCAST,
                                         'timetick':str(TIMETICK),
                                         'fontsize':str(FONTSIZE),
                                         'fullscreen':'Yes',
@@ -472,6 +510,8 @@ class rr_announce(object):
         ncltnick =cr.get('uscbsrv', 'cltnick')
         nsrvnick = cr.get('uscbsrv', 'srvnick')
         self.io.set_port(nhost, nport, nchannel, ncltnick, nsrvnick)
+        self.io.set_transport(cr.get('uscbsrv', 'transport'),
+                              cr.get('uscbsrv', 'mcast'))
 
         fnszstr = str(self.fontsize)+'px'
         self.lbl_header.modify_font(pango.FontDescription('bold '+fnszstr))
@@ -482,7 +522,7 @@ class rr_announce(object):
 
     def __init__(self):
         self.io = uscbio()
-        self.io.setcb(self.msg_cb)
+        self.io.setcb(self.msgs_cb)
         self.started = False
         self.running = True
 
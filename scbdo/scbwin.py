@@ -615,3 +615,39 @@ class scbtable(scbwin):
         self.loadrows(coldesc, rows)
 
 # TODO: Tests for all window types.
+
+if __name__ == "__main__":
+    """Replay scbtable page cycles and report DHI packet counts."""
+    rows = []
+    for i in range(1, 23):
+        rows.append([str(i), 'Rider ' + str(i) + ' Name', 'CLUB',
+                     str(60 - 2 * i)])
+    coldesc = [(3, 'r'), ' ', (14, 'l'), ' ', (4, 'l'), ' ', (3, 'r')]
+    scb = sender.sender()	# not started, packets are left on the queue
+
+    def replay(shadow=True, cycles=2):
+        """Run table through cycles, return packets, bytes, suppressed."""
+        while not scb.queue.empty():
+            scb.queue.get_nowait()
+        scb.pktsuppressed = 0
+        scb.invalidate()
+        tab = scbtable(scb, 'Points Race Result', coldesc, rows,
+                       timepfx='Average:', timestr='52.345 km/h')
+        tab.reset()
+        for i in range(cycles * (PAGE_INIT + 2 * tab.delay * tab.nrpages)):
+            if not shadow:
+                scb.invalidate()	# forget DHI state: legacy behaviour
+            tab.update()
+        cnt = 0
+        nb = 0
+        while not scb.queue.empty():
+            nb += len(scb.queue.get_nowait()[1])
+            cnt += 1
+        return (cnt, nb, scb.pktsuppressed)
+
+    (lc, lb, ls) = replay(False)
+    (sc, sb, ss) = replay(True)
+    print('scbtable: ' + str(len(rows)) + ' rows, 2 page cycles')
+    print('  legacy: {0:6d} packets, {1:7d} bytes'.format(lc, lb))
+    print('  shadow: {0:6d} packets, {1:7d} bytes, {2:6d} suppressed'.format(
+                 sc, sb, ss))
@@ -23,7 +23,20 @@ the DHI. A calling application should use the sender methods
 for all low-level scb drawing.
 
 SCB messages are stored in a Queue object and written out to
-the DHI using blocking I/O.
+one or more DHI ports. Packets that are queued together are
+collected into a batch, packed once and appended to the backlog
+of every port. Ports are connected and written with non-blocking
+I/O so that a slow or dead scoreboard does not hold up the others.
+
+The sender thread also keeps the latest content of each DHI line.
+A port that has been disconnected, or has fallen too far behind,
+is sent that state in one burst instead of its stale backlog. The
+same state is redrawn on each connected port every REFRESH_WAIT
+seconds.
+
+The sender keeps a shadow copy of the DHI database lines so that
+text drawing primitives only emit packets for the parts of a line
+that have actually changed.
 
 """
 
@@ -31,6 +44,11 @@ import threading
 import Queue
 import logging
 import socket
+import time
+import errno
+import os
+import select
+import collections
 
 from scbdo import unt4
 from scbdo import strops
@@ -38,46 +56,230 @@ from scbdo import strops
 # dispatch thread queue commands
 TCMDS = ('EXIT', 'PORT', 'MSG')
 
+# Write batching: stop collecting packets after BATCH_BYTES or when
+# the queue has been idle for BATCH_WAIT seconds
+BATCH_BYTES = 1400
+BATCH_WAIT = 0.005
+
+# Set True if the DHI accepts several UNT4 packets in one UDP datagram
+DGRAM_CONCAT = False
+
+# Longest wait on busy ports before checking the queue again
+SELECT_WAIT = 0.01
+
+# Port connection states
+PORT_DOWN = 0
+PORT_CONNECTING = 1
+PORT_UP = 2
+
+# Reconnect delay limits and connect timeout in seconds
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# Longest time in seconds to write out port backlogs on exit
+EXIT_WAIT = 2.0
+
+# Unsent bytes on a connected port above which its backlog is replaced
+# by a resync of the current DHI state
+MAXBACKLOG = 16384
+
+# Seconds between redraws of the current DHI state on connected ports,
+# recovers lost datagrams and a restarted DHI
+REFRESH_WAIT = 5.0
+
+# DHI database dimensions
+DHI_LINES = 20
+
+# Unchanged gap below which adjacent changed spans are merged, about
+# the overhead of a positioned text packet <SOH><STX><DLE>xxyy<EOT>
+SPAN_MERGE = 8
+
+def diffspans(old, new, start=0, end=None, gap=SPAN_MERGE):
+    """Return a list of (start, end) spans where new differs from old.
+
+    Only positions start to end are compared. Changed runs separated
+    by fewer than gap unchanged characters are merged into one span.
+
+    """
+    if end is None:
+        end = len(new)
+    ret = []
+    st = None	# start of current span
+    et = None	# end of current span
+    for i in range(start, end):
+        if old[i] != new[i]:
+            if st is None:
+                st = i
+            elif i - et >= gap:
+                ret.append((st, et))
+                st = i
+            et = i + 1
+    if st is not None:
+        ret.append((st, et))
+    return ret
+
 class scbport(object):
-    """Scoreboard communication port object."""
-    def __init__(self, addr, protocol):
+    """Scoreboard communication port object.
+
+    The port connects with a non-blocking socket. Data for the
+    port is appended to a backlog with push() and written out with
+    non-blocking sends by flush(). After an error the port is
+    closed, its backlog is dropped and a new connection is attempted
+    after a delay which doubles on each failure up to RECONNECT_MAX.
+    The resync flag is then set to request the current DHI state
+    be sent once the port is up again.
+
+    """
+    def __init__(self, addr, protocol, name=None):
         """Constructor.
 
         Parameters:
 
           addr -- socket style 2-tuple (host, port)
           protocol -- one of socket.SOCK_STREAM or socket.SOCK_DGRAM
+          name -- label for the port in log messages and status
 
         """
-        self.__s = socket.socket(socket.AF_INET, protocol)
-        self.__s.connect(addr)
-        if protocol is socket.SOCK_STREAM:
+        self.addr = addr
+        self.protocol = protocol
+        self.concat = True
+        if protocol is not socket.SOCK_STREAM:
+            self.concat = DGRAM_CONCAT
+        self.name = name
+        if self.name is None:
+            self.name = ':'.join([str(a) for a in addr])
+        self.__s = None
+        self.state = PORT_DOWN
+        self.started = 0.0	# time of last connect attempt
+        self.retry = 0.0	# time of next connect attempt
+        self.backoff = RECONNECT_MIN
+        self.resync = False	# send full DHI state once connected
+        self.refresh = False	# redraw DHI state once backlog is empty
+        self.backlog = collections.deque()	# (buf, queue time)
+        self.boft = 0		# bytes of first backlog buf already sent
+        self.depth = 0		# bytes in backlog not yet sent
+        self.running = True
+
+    def fileno(self):
+        """Return socket file descriptor for select."""
+        return self.__s.fileno()
+
+    def connected(self):
+        """Return True if the port is connected."""
+        return self.state == PORT_UP
+
+    def connect(self, now=None):
+        """Start a non-blocking connect to the port address."""
+        if now is None:
+            now = time.time()
+        self.started = now
+        self.__s = socket.socket(socket.AF_INET, self.protocol)
+        if self.protocol is socket.SOCK_STREAM:
             # set the TCP 'no delay' option
             self.__s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         else:	# assume Datagram (UDP)
             # set all scb packets to look like 'EF' VoIP packets
             self.__s.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0xB8)
+        self.__s.setblocking(0)
         self.send = self.__s.send  # local cache the send() method
-        self.running = True
-
-    def sendall(self, buf):
-        """Send all of buf to port."""
-        msglen = len(buf)
-        sent = 0
-        while sent < msglen:
-            out = self.send(buf[sent:])
+        err = self.__s.connect_ex(self.addr)
+        if err in (0, errno.EISCONN):
+            self.connectdone()
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.state = PORT_CONNECTING
+        else:
+            raise socket.error(err, os.strerror(err))
+
+    def connectdone(self):
+        """Complete a connect once the socket is writable."""
+        err = self.__s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, os.strerror(err))
+        self.state = PORT_UP
+        self.backoff = RECONNECT_MIN
+
+    def fail(self, now=None):
+        """Close the socket, drop the backlog and schedule a reconnect."""
+        if now is None:
+            now = time.time()
+        self.shutdown()
+        self.drop()
+        self.retry = now + self.backoff
+        self.backoff = min(2.0 * self.backoff, RECONNECT_MAX)
+
+    def drop(self):
+        """Discard unsent backlog and request a resync."""
+        if self.boft > 0 and self.state == PORT_UP:
+            # keep the rest of a partly written buf to preserve framing
+            (buf, qt) = self.backlog.popleft()
+            self.backlog.clear()
+            self.backlog.append((buf, qt))
+            self.depth = len(buf) - self.boft
+        else:
+            self.backlog.clear()
+            self.boft = 0
+            self.depth = 0
+        self.resync = True
+
+    def push(self, bufs, qtime):
+        """Append the list of bufs queued at qtime to the backlog."""
+        for buf in bufs:
+            self.backlog.append((buf, qtime))
+            self.depth += len(buf)
+
+    def pending(self):
+        """Return True if there is unsent data in the backlog."""
+        return len(self.backlog) > 0
+
+    def lag(self, now=None):
+        """Return age in seconds of the oldest unsent data."""
+        ret = 0.0
+        try:
+            if now is None:
+                now = time.time()
+            ret = now - self.backlog[0][1]
+        except IndexError:
+            pass
+        return ret
+
+    def flush(self):
+        """Write as much backlog as possible, return count of writes."""
+        ret = 0
+        while len(self.backlog) > 0:
+            buf = self.backlog[0][0]
+            try:
+                out = self.send(buffer(buf, self.boft))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    break	# port is busy, try again later
+                raise
             if out == 0:
                 raise socket.error("DHI command socket broken")
-            sent += out
-        pass
+            ret += 1
+            self.depth -= out
+            self.boft += out
+            if self.boft < len(buf):
+                break		# partial write, socket buffer is full
+            self.backlog.popleft()
+            self.boft = 0
+        return ret
+
+    def shutdown(self):
+        """Shutdown the socket, leaving the port ready to reconnect."""
+        if self.__s is not None:
+            try:
+                self.__s.shutdown(socket.SHUT_RDWR)
+            except:
+                pass	# error here should not leak out
+            self.__s.close()
+            self.__s = None
+        self.state = PORT_DOWN
 
     def close(self):
         """Shutdown socket object."""
         self.running = False
-        try:
-            self.__s.shutdown(socket.SHUT_RDWR)
-        except:
-            pass	# error here should not leak out
+        self.shutdown()
 
 def mkport(port):
     """Create a new scbport socket object.
@@ -95,6 +297,7 @@ def mkport(port):
     The default protocol is UDP and the default port 5060.
 
     """
+    name = port
     nprot = socket.SOCK_DGRAM	# default is UDP
     naddr = 'localhost'		# default is localhost
     nport = 5060		# default is 'sip' scbport
@@ -138,7 +341,7 @@ def mkport(port):
             nport = socket.getservbyname(vels[2])
     
     ## split port string into [PROTOCOL:]ADDR[:PORT]
-    return scbport((naddr, nport), nprot)
+    return scbport((naddr, nport), nprot, name)
 
 class sender(threading.Thread):
     """Galactica DHI sender thread.
@@ -157,44 +360,98 @@ class sender(threading.Thread):
 
     def clrall(self):
         """Clear all lines in DHI database."""
-        self.sendmsg(unt4.GENERAL_CLEARING)
+        self.sendpack(unt4.GENERAL_CLEARING.pack(), ('C',))
+        self.shadow = [self.blank] * DHI_LINES
 
     def clrline(self, line):
         """Clear the specified line in DHI database."""
-        self.sendmsg(unt4.unt4(xx=0,yy=int(line),erl=True))
+        line = int(line)
+        if 0 <= line < DHI_LINES and self.shadow[line] == self.blank:
+            self.pktsuppressed += 1
+        else:
+            if 0 <= line < DHI_LINES:
+                self.sendpack(unt4.packmsg(xx=0,yy=line,erl=True),
+                              ('L', line, self.blank))
+                self.shadow[line] = self.blank
+            else:
+                self.sendpack(unt4.packmsg(xx=0,yy=line,erl=True))
 
     def setline(self, line, msg):
         """Set the specified DHI database line to msg."""
         msg = msg[0:self.linelen].ljust(self.linelen)
         msg = msg + ' ' * (self.linelen - len(msg))
-        self.sendmsg(unt4.unt4(xx=0,yy=int(line),text=msg))
+        self.puttxt(int(line), 0, msg)
 
     def linefill(self, line, char='_'):
         """Use char to fill the specified line."""
         msg = char * self.linelen
-        self.sendmsg(unt4.unt4(xx=0,yy=int(line),text=msg))
+        self.puttxt(int(line), 0, msg)
 
     def postxt(self, line, oft, msg):
         """Position msg at oft on line in DHI database."""
         assert oft >= 0, 'Offset should be >= 0'
         if oft < self.linelen:
             msg = msg[0:(self.linelen-oft)]
-            self.sendmsg(unt4.unt4(xx=int(oft),yy=int(line),text=msg))
+            self.puttxt(int(line), int(oft), msg)
+
+    def puttxt(self, line, oft, msg):
+        """Send the changed parts of msg at oft on line to the DHI."""
+        if line < 0 or line >= DHI_LINES:
+            self.sendpack(unt4.packmsg(xx=oft,yy=line,text=msg))
+            return
+        cur = self.shadow[line]
+        end = oft + len(msg)
+        if cur is None:
+            # line content unknown, send all and keep only a full line
+            buf = unt4.packmsg(xx=oft,yy=line,text=msg)
+            if oft == 0 and end == self.linelen:
+                self.sendpack(buf, ('L', line, msg))
+                self.shadow[line] = msg
+            else:
+                self.sendpack(buf, ('P', line, oft, buf))
+        else:
+            new = cur[0:oft] + msg + cur[end:]
+            spans = diffspans(cur, new, oft, end)
+            if len(spans) == 0:
+                self.pktsuppressed += 1
+            for (st, et) in spans:
+                self.sendpack(unt4.packmsg(xx=st,yy=line,text=new[st:et]),
+                              ('L', line, new))
+            self.shadow[line] = new
+
+    def invalidate(self):
+        """Forget the shadow DHI database so all lines are re-sent."""
+        self.shadow = [None] * DHI_LINES
 
     def setoverlay(self, newov):
         """Request overlay newov to be displayed on the scoreboard."""
         if self.curov != newov:
-            self.sendmsg(newov)
+            buf = newov.pack()
+            self.sendpack(buf, ('O', buf))
             self.curov = newov
 
     def __init__(self, port=None, linelen=32):
         """Constructor."""
         threading.Thread.__init__(self) 
         self.name = 'sender'
-        self.port = None
+        self.ports = []
         self.linelen = int(linelen)
+        self.blank = ' ' * self.linelen
+        self.shadow = [None] * DHI_LINES
+        self.pktsent = 0		# packets queued for the DHI
+        self.pktsuppressed = 0		# draw calls with nothing to send
         self.ignore = False
         self.curov = None
+        self.batchlen = BATCH_BYTES	# 0 to write each packet on its own
+        self.msgsent = 0		# packets written to the DHI
+        self.wiresent = 0		# socket writes to the DHI
+        self.resyncs = 0		# full state bursts sent to ports
+        self.refreshes = 0		# periodic redraws sent to ports
+        self.nextrefresh = 0.0		# time of next periodic redraw
+        self.dhilines = [None] * DHI_LINES	# thread copy of DHI state
+        self.dhipart = {}		# (line, oft) -> buf on unknown lines
+        self.dhiclear = False		# true if state follows a clrall
+        self.dhioverlay = None
         self.queue = Queue.Queue()
         self.log = logging.getLogger('scbdo.sender')
         self.log.setLevel(logging.DEBUG)
@@ -204,11 +461,26 @@ class sender(threading.Thread):
 
     def sendmsg(self, unt4msg=None):
         """Pack and send a unt4 message to the DHI."""
-        self.queue.put_nowait(('MSG', unt4msg.pack()))
+        self.sendpack(unt4msg.pack())
+
+    def sendpack(self, buf, state=None):
+        """Send the packed unt4 message buf to the DHI.
+
+        state describes the DHI content after buf is applied:
+
+          ('L', line, text) -- line now holds text
+          ('P', line, oft, buf) -- buf was written at oft on a line
+				   of unknown content
+          ('O', buf) -- buf selected the current overlay
+          ('C',) -- all lines were cleared
+
+        """
+        self.pktsent += 1
+        self.queue.put_nowait(('MSG', buf, state))
 
     def write(self, msg=None):
         """Send the provided msg to the DHI."""
-        self.queue.put_nowait(('MSG', msg))
+        self.queue.put_nowait(('MSG', msg, None))
 
     def exit(self, msg=None):
         """Request thread termination."""
@@ -220,7 +492,7 @@ class sender(threading.Thread):
         self.queue.join()
 
     def setport(self, port=None):
-        """Dump command queue content and (re)open DHI port.
+        """Dump command queue content and (re)open DHI ports.
 
         Specify hostname and port for TCP connection as follows:
 
@@ -231,6 +503,11 @@ class sender(threading.Thread):
 		SCBDO -- TCP:scb.disc:2004
 		DEBUG -- UDP:localhost:5060
 
+        Several DHI ports may be given, separated by commas or
+        spaces, and all of them receive the same packets:
+
+            SCBDO, udp:infield:5060, tcp:overlay:2004
+
         """
         try:
             while True:
@@ -238,6 +515,7 @@ class sender(threading.Thread):
                 self.queue.task_done()
         except Queue.Empty:
             pass 
+        self.invalidate()
         self.queue.put_nowait(('PORT', port))
 
     def set_ignore(self, ignval=False):
@@ -247,49 +525,330 @@ class sender(threading.Thread):
         no packets will be sent to the DHI.
 
         """
+        if self.ignore != bool(ignval):
+            self.invalidate()
         self.ignore = bool(ignval)
 
     def connected(self):
         """Return true if SCB connected."""
-        return self.port is not None and self.port.running
+        for p in list(self.ports):
+            if p.connected():
+                return True
+        return False
+
+    def destinations(self):
+        """Return a list of (name, connected, packets, bytes, lag).
+
+        packets and bytes give the depth of the port's unsent backlog
+        and lag is the age in seconds of the oldest unsent data.
+
+        """
+        ret = []
+        now = time.time()
+        for p in list(self.ports):
+            ret.append((p.name, p.connected(), len(p.backlog), p.depth,
+                        p.lag(now)))
+        return ret
+
+    def waittime(self):
+        """Return time the thread may block on the queue.
+
+        Returns 0 if a port is waiting on connect or write, the time
+        to the next reconnect attempt if a port is down, or None if
+        there is nothing to do but wait for commands.
+
+        """
+        ret = None
+        now = time.time()
+        for p in self.ports:
+            w = None
+            if p.state == PORT_DOWN:
+                w = max(p.retry - now, 0.0)
+            elif (p.state == PORT_CONNECTING or p.pending()
+                  or ((p.resync or p.refresh) and not self.ignore)):
+                return 0
+            elif not self.ignore:
+                w = max(self.nextrefresh - now, 0.0)
+            if w is not None and (ret is None or w < ret):
+                ret = w
+        return ret
+
+    def refresh(self, now):
+        """Request a redraw of the DHI state on all connected ports."""
+        if not self.ignore:
+            for p in self.ports:
+                if p.state == PORT_UP:
+                    p.refresh = True
+        self.nextrefresh = now + REFRESH_WAIT
+
+    def mirror(self, state):
+        """Update the thread copy of DHI state from a message state."""
+        if state is None:
+            pass
+        elif state[0] == 'L':
+            self.dhilines[state[1]] = state[2]
+            for k in [k for k in self.dhipart if k[0] == state[1]]:
+                del self.dhipart[k]
+        elif state[0] == 'P':
+            self.dhipart[(state[1], state[2])] = state[3]
+        elif state[0] == 'O':
+            self.dhioverlay = state[1]
+        elif state[0] == 'C':
+            self.dhilines = [self.blank] * DHI_LINES
+            self.dhipart = {}
+            self.dhiclear = True
+
+    def burst(self, resync=True):
+        """Return a list of packets that redraw the current DHI state.
+
+        With resync False only the lines are repainted: a known clear
+        is not repeated, blank lines are written instead so the board
+        does not flash, and the overlay is not sent again.
+
+        """
+        ret = []
+        clear = resync and self.dhiclear
+        if clear:
+            ret.append(unt4.GENERAL_CLEARING.pack())
+        for (line, text) in enumerate(self.dhilines):
+            if text is not None and not (clear and text == self.blank):
+                ret.append(unt4.packmsg(xx=0,yy=line,text=text))
+        for k in sorted(self.dhipart):
+            ret.append(self.dhipart[k])
+        if resync and self.dhioverlay is not None:
+            ret.append(self.dhioverlay)
+        return ret
+
+    def portfail(self, p, err):
+        """Log a port error and schedule a reconnect."""
+        self.log.error('Port ' + str(p.name) + ' error: '
+                         + str(type(err)) + str(err)
+                         + ', retry in {0:0.1f} s'.format(p.backoff))
+        p.fail()
+
+    def service(self, timeout=0):
+        """Connect and write out ports, waiting up to timeout."""
+        now = time.time()
+        if now >= self.nextrefresh:
+            self.refresh(now)
+        wait = []
+        for p in self.ports:
+            if p.state == PORT_DOWN:
+                if now >= p.retry:
+                    try:
+                        p.connect(now)
+                    except socket.error as e:
+                        self.portfail(p, e)
+                if p.state == PORT_DOWN:
+                    continue
+            if p.state == PORT_CONNECTING:
+                if now - p.started > CONNECT_TIMEOUT:
+                    self.portfail(p, socket.timeout('connect timed out'))
+                    continue
+                wait.append(p)
+            elif p.pending() or ((p.resync or p.refresh)
+                                 and not self.ignore):
+                wait.append(p)
+        if len(wait) > 0:
+            select.select([], wait, [], timeout)
+        for p in wait:
+            try:
+                if p.state == PORT_CONNECTING:
+                    if len(select.select([], [p], [], 0)[1]) == 0:
+                        continue
+                    p.connectdone()
+                    self.log.debug('Port ' + str(p.name) + ' connected.')
+                if p.resync and not p.pending() and not self.ignore:
+                    # catch up in one burst from the current state
+                    p.resync = False
+                    p.refresh = False
+                    p.push(self.burst(), time.time())
+                    self.resyncs += 1
+                elif p.refresh and not p.pending() and not self.ignore:
+                    p.refresh = False
+                    p.push(self.burst(False), time.time())
+                    self.refreshes += 1
+                self.wiresent += p.flush()
+            except (socket.error, IOError) as e:
+                self.portfail(p, e)
+
+    def busy(self):
+        """Return True if a port is connecting or has data to write."""
+        for p in self.ports:
+            if p.state == PORT_CONNECTING:
+                return True
+            elif p.state == PORT_UP and (p.pending()
+                       or (p.resync and not self.ignore)):
+                return True
+        return False
+
+    def drain(self):
+        """Write out port backlogs for up to EXIT_WAIT seconds."""
+        dl = time.time() + EXIT_WAIT
+        self.nextrefresh = dl	# no periodic redraw while closing
+        try:
+            while self.busy() and time.time() < dl:
+                self.service(SELECT_WAIT)
+        except Exception as e:
+            self.log.error('Exception: ' + str(type(e)) + str(e))
+
+    def fanout(self, batch):
+        """Pack batch once and push it onto every live port."""
+        joined = None
+        now = time.time()
+        for p in self.ports:
+            if p.state != PORT_DOWN and not p.resync:
+                if p.depth > MAXBACKLOG:
+                    p.drop()	# too far behind, resync instead
+                    continue
+                if p.concat:
+                    if joined is None:
+                        joined = ''.join(batch)
+                    p.push([joined], now)
+                else:
+                    p.push(batch, now)
+        self.msgsent += len(batch)
+        self.service()
+
+    def openports(self, port=None):
+        """Close current ports and open all ports listed in port."""
+        for p in self.ports:
+            p.close()
+        self.ports = []
+        self.curov = None
+        if port is not None and port != '' and port != 'NULL':
+            for spec in port.replace(',', ' ').split():
+                self.log.debug('Re-Connect port: ' + repr(spec))
+                try:
+                    p = mkport(spec)
+                except Exception as e:
+                    self.log.error('Port ' + repr(spec) + ' error: '
+                                     + str(type(e)) + str(e))
+                    continue
+                self.ports.append(p)
+                try:
+                    p.connect()
+                except socket.error as e:
+                    self.portfail(p, e)
+        if len(self.ports) == 0:
+            self.log.debug('Not connected.')
+
+    def collect(self, msg):
+        """Collect a batch of queued packets following msg.
+
+        Returns a tuple (batch, next) where batch is a list of packets
+        and next is a non-MSG command read from the queue while
+        collecting, or None. The DHI state of each message is applied
+        to the thread copy as it is collected.
+
+        """
+        self.mirror(msg[2])
+        batch = [msg[1]]
+        nb = len(msg[1])
+        nm = None
+        if self.batchlen > 0:
+            dl = time.time() + BATCH_WAIT
+            while nb < self.batchlen:
+                try:
+                    m = self.queue.get(True, max(dl - time.time(), 0))
+                    self.queue.task_done()
+                except Queue.Empty:
+                    break
+                if m[0] != 'MSG':
+                    nm = m	# handled after this batch is written
+                    break
+                self.mirror(m[2])
+                batch.append(m[1])
+                nb += len(m[1])
+        return (batch, nm)
 
     def run(self):
         """Called via threading.Thread.start()."""
         self.running = True
         self.log.debug('Starting')
+        nm = None
         while self.running:
-            m = self.queue.get()
-            self.queue.task_done()
             try:
-                if m[0] == 'MSG' and not self.ignore and self.port:
-                    self.port.sendall(m[1])
+                if nm is not None:
+                    m = nm
+                    nm = None
+                else:
+                    # keep ports connected and moving while waiting
+                    m = None
+                    while m is None:
+                        try:
+                            w = self.waittime()
+                            if w == 0:
+                                m = self.queue.get_nowait()
+                            else:
+                                m = self.queue.get(True, w)
+                            self.queue.task_done()
+                        except Queue.Empty:
+                            self.service(SELECT_WAIT)
+                if m[0] == 'MSG':
+                    (batch, nm) = self.collect(m)
+                    if not self.ignore:
+                        self.fanout(batch)
                 elif m[0] == 'EXIT':
                     self.log.debug('Request to close : ' + str(m[1]))
                     self.running = False
                 elif m[0] == 'PORT':
-                    if self.port is not None:
-                        self.port.close()
-                        self.port = None
-                    if m[1] is not None and m[1] != '' and m[1] != 'NULL':
-                        self.log.debug('Re-Connect port: ' + str(m[1]))
-                        self.port = mkport(m[1])
-                        self.curov = None
-                    else:
-                        self.log.debug('Not connected.')
-
-            except IOError as e:
-                self.log.error('IO Error: ' + str(type(e)) + str(e))
-                if self.port is not None:
-                    self.port.close()
-                self.port = None
+                    self.openports(m[1])
             except Exception as e:
                 self.log.error('Exception: ' + str(type(e)) + str(e))
-        if self.port is not None:
-            self.port.close()
+        self.drain()
+        for p in self.ports:
+            p.close()
         self.log.info('Exiting')
 
 if __name__ == "__main__":
     """Simple 'Hello World' example with logging."""
+    import sys
+
+    # Wire packet counts for table redraws with and without batching
+    if len(sys.argv) == 2 and sys.argv[1] == '-b':
+        redraws = 200
+        l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        l.bind(('localhost', 0))
+        l.listen(1)
+        lport = l.getsockname()[1]
+
+        def sink(l, res):
+            """Accept one connection and count received bytes."""
+            c = l.accept()[0]
+            nb = 0
+            buf = c.recv(4096)
+            while buf != '':
+                nb += len(buf)
+                buf = c.recv(4096)
+            res.append(nb)
+
+        for blen in (0, BATCH_BYTES):
+            res = []
+            t = threading.Thread(target=sink, args=(l, res))
+            t.start()
+            s = sender('TCP:localhost:' + str(lport), linelen=24)
+            s.batchlen = blen
+            s.start()
+            st = time.time()
+            for i in range(redraws):
+                s.invalidate()
+                s.setline(10, 'Points Race Result')
+                for j in range(11, 18):
+                    s.clrline(j)
+                s.sendmsg(unt4.OVERLAY_T1P5)
+                for j in range(11, 18):
+                    s.setline(j, '{0:3d} Rider {1} Name'.format(j, i))
+                s.wait()
+            s.exit('bench done.')
+            s.join()
+            t.join()
+            print('batch {0:4d}: {1:5d} packets, {2:5d} writes, '
+                  '{3:6d} bytes, {4:0.3f} s'.format(blen, s.msgsent,
+                       s.wiresent, res[0], time.time() - st))
+        l.close()
+        sys.exit(0)
+
     h = logging.StreamHandler()
     h.setLevel(logging.DEBUG)
     s = sender('DEBUG')
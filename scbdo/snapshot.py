@@ -0,0 +1,313 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Atomic config snapshots.
+
+This module provides a class 'config' which stands in for the subset
+of ConfigParser used by event and meet handlers. Values are held as
+strings, and rider rows may be stored as lists with setrow() and
+recovered with getrow(), avoiding a csv parse per rider on load.
+
+A config is saved with a single write to a temporary file which is
+then renamed over the target, so an interrupted save leaves the
+previous snapshot intact. A save is skipped when the content is the
+same as the last save or load of that file and the file has not been
+modified since.
+
+Snapshots are written in a marshalled binary format by default, or
+as ConfigParser compatible text with save(path, text=True). Either
+format is accepted by read(), so existing text configs still load.
+
+"""
+
+import os
+import csv
+import marshal
+import hashlib
+import ConfigParser
+import StringIO
+
+# Binary snapshot file header
+MAGIC = 'SCBdo-snapshot-1\n'
+
+# Path -> (digest, size, mtime) of last save or load
+_saved = {}
+
+def rowstr(row):
+    """Return the legacy config text for a rider row."""
+    return ','.join(map(lambda i: str(i).replace(',', '\\,'), row))
+
+def _filestat(path):
+    """Return (size, mtime) for path or None."""
+    try:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+    except OSError:
+        return None
+
+def _mark(path, digest):
+    """Record digest as the current content of path."""
+    st = _filestat(path)
+    if st is not None:
+        _saved[os.path.abspath(path)] = (digest,) + st
+
+def unchanged(path, digest):
+    """Return True if path was last saved or loaded with digest."""
+    st = _filestat(path)
+    return (st is not None
+            and _saved.get(os.path.abspath(path)) == (digest,) + st)
+
+def writefile(path, buf):
+    """Replace path with buf atomically, return False if unchanged."""
+    digest = hashlib.sha1(buf).digest()
+    if unchanged(path, digest):
+        return False
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpfile, path)
+    _mark(path, digest)
+    return True
+
+class config(object):
+    """ConfigParser work-alike with row values and atomic save."""
+
+    def __init__(self, defaults=None):
+        """Constructor.
+
+        Parameters:
+
+          defaults -- dict of default option values, as ConfigParser
+
+        """
+        self.__defaults = {}
+        if defaults is not None:
+            for (o, v) in defaults.iteritems():
+                self.__defaults[o.lower()] = v
+        self.__sections = {}	# section -> {option: value}
+        self.__order = []	# (section, option list) in insert order
+
+    def add_section(self, section):
+        """Add a new empty section."""
+        if section in self.__sections:
+            raise ConfigParser.DuplicateSectionError(section)
+        self.__sections[section] = {}
+        self.__order.append((section, []))
+
+    def has_section(self, section):
+        """Return True if section exists."""
+        return section in self.__sections
+
+    def sections(self):
+        """Return a list of section names in insert order."""
+        return [s for (s, opts) in self.__order]
+
+    def options(self, section):
+        """Return a list of options in section."""
+        return [o for (s, opts) in self.__order if s == section
+                  for o in opts]
+
+    def has_option(self, section, option):
+        """Return True if option is set in section."""
+        return (section in self.__sections
+                and option.lower() in self.__sections[section])
+
+    def __section(self, section):
+        """Return the option dict for section."""
+        if section not in self.__sections:
+            raise ConfigParser.NoSectionError(section)
+        return self.__sections[section]
+
+    def __store(self, section, option, value):
+        """Store value into section, keeping option order."""
+        sec = self.__section(section)
+        option = option.lower()
+        if option not in sec:
+            for (s, opts) in self.__order:
+                if s == section:
+                    opts.append(option)
+                    break
+        sec[option] = value
+
+    def set(self, section, option, value):
+        """Set option in section to the string value."""
+        self.__store(section, option, str(value))
+
+    def setrow(self, section, option, row):
+        """Set option in section to a list of row values."""
+        self.__store(section, option, [str(i) for i in row])
+
+    def get(self, section, option):
+        """Return the string value of option in section or default."""
+        sec = self.__section(section)
+        option = option.lower()
+        if option in sec:
+            ret = sec[option]
+            if type(ret) is list:
+                ret = rowstr(ret)
+            return ret
+        elif option in self.__defaults:
+            return self.__defaults[option]
+        raise ConfigParser.NoOptionError(option, section)
+
+    def getrow(self, section, option):
+        """Return the list of row values for option in section."""
+        ret = self.__section(section).get(option.lower())
+        if ret is None:
+            raise ConfigParser.NoOptionError(option, section)
+        if type(ret) is not list:	# text config
+            ret = csv.reader([ret]).next()
+        return ret
+
+    def items(self, section):
+        """Return a list of (option, value) in section and defaults."""
+        sec = self.__section(section)
+        ret = [(o, v) for (o, v) in self.__defaults.iteritems()
+                 if o not in sec]
+        ret.extend([(o, self.get(section, o)) for o in self.options(section)])
+        return ret
+
+    def __merge(self, order):
+        """Merge a list of (section, [(option, value), ...])."""
+        for (section, items) in order:
+            if section not in self.__sections:
+                self.add_section(section)
+            sec = self.__sections[section]
+            for (o, v) in items:
+                if o not in sec:
+                    self.__store(section, o, v)
+                else:
+                    sec[o] = v
+
+    def read(self, path):
+        """Read path into config and return a list of files read."""
+        try:
+            with open(path, 'rb') as f:
+                buf = f.read()
+        except IOError:
+            return []
+        if buf.startswith(MAGIC):
+            self.__merge(marshal.loads(buf[len(MAGIC):]))
+        else:
+            cp = ConfigParser.RawConfigParser()
+            cp.readfp(StringIO.StringIO(buf), path)
+            self.__merge([(s, cp.items(s)) for s in cp.sections()])
+        _mark(path, hashlib.sha1(buf).digest())
+        return [path]
+
+    def dumps(self, text=False):
+        """Return the file content of the config."""
+        if text:
+            ret = []
+            for (section, opts) in self.__order:
+                sec = self.__sections[section]
+                ret.append('[' + section + ']\n')
+                for o in opts:
+                    v = sec[o]
+                    if type(v) is list:
+                        v = rowstr(v)
+                    ret.append(o + ' = ' + v.replace('\n', '\n\t') + '\n')
+                ret.append('\n')
+            return ''.join(ret)
+        else:
+            return MAGIC + marshal.dumps(
+                      [(s, [(o, self.__sections[s][o]) for o in opts])
+                        for (s, opts) in self.__order])
+
+    def save(self, path, text=False):
+        """Write config to path, return False if there was no change."""
+        return writefile(path, self.dumps(text))
+
+if __name__ == "__main__":
+    """Compare save and load times against ConfigParser."""
+    import sys
+    import time
+    import tempfile
+    count = 300
+    loops = 50
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    rows = []
+    for i in range(1, count + 1):
+        rows.append((str(i), ['dnf, crash', 'True', '12',
+                     '10:{0:02d}:{1:02d}.34'.format(i // 60 % 60, i % 60),
+                     ''] + ['10:{0:02d}:00.12'.format(l)
+                              for l in range(12)]))
+    startlist = ' '.join([b for (b, r) in rows])
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'event_1')
+
+    def legacy_save(i):
+        cw = ConfigParser.ConfigParser()
+        cw.add_section('event')
+        cw.set('event', 'startlist', startlist)
+        cw.set('event', 'count', str(i))
+        cw.add_section('riders')
+        for (b, r) in rows:
+            cw.set('riders', b, rowstr(r))
+        with open(path, 'wb') as f:
+            cw.write(f)
+
+    def legacy_load(i):
+        cr = ConfigParser.ConfigParser({'startlist':''})
+        cr.add_section('event')
+        cr.add_section('riders')
+        cr.read(path)
+        for b in cr.get('event', 'startlist').split():
+            csv.reader([cr.get('riders', b)]).next()
+
+    def snap_save(i):
+        cw = config()
+        cw.add_section('event')
+        cw.set('event', 'startlist', startlist)
+        cw.set('event', 'count', str(i))
+        cw.add_section('riders')
+        for (b, r) in rows:
+            cw.setrow('riders', b, r)
+        cw.save(path)
+
+    def snap_load(i):
+        cr = config({'startlist':''})
+        cr.add_section('event')
+        cr.add_section('riders')
+        cr.read(path)
+        for b in cr.get('event', 'startlist').split():
+            cr.getrow('riders', b)
+
+    def timed(fn, change=True):
+        st = time.time()
+        for i in range(loops):
+            fn(change and i or 0)
+        return 1000.0 * (time.time() - st) / loops
+
+    # existing text configs must still load
+    legacy_save(0)
+    cr = config()
+    cr.read(path)
+    assert cr.getrow('riders', '1')[-12:] == rows[0][1][-12:]
+
+    print('Riders: {0}, mean of {1} runs'.format(count, loops))
+    print('  ConfigParser: {0:6.2f} ms save, {1:6.2f} ms load'.format(
+                  timed(legacy_save), timed(legacy_load)))
+    os.unlink(path)
+    print('      snapshot: {0:6.2f} ms save, {1:6.2f} ms load'.format(
+                  timed(snap_save), timed(snap_load)))
+    print('     unchanged: {0:6.2f} ms save'.format(
+                  timed(snap_save, False)))
+    os.unlink(path)
+    os.rmdir(tmp)
@@ -39,13 +39,13 @@ import os
 import logging
 import csv
 import decimal
-import ConfigParser
 
 import scbdo
 from scbdo import tod
 from scbdo import eventdb
 from scbdo import riderdb
 from scbdo import strops
+from scbdo import snapshot
 from scbdo import printops
 from scbdo import uiutil
 
@@ -94,12 +94,12 @@ class sportif(object):
         """Load race config from disk."""
         self.riders.clear()
         self.resettimer()
-        cr = ConfigParser.ConfigParser({'start':'',
-                                        'lstart':'',
-                                        'id':EVENT_ID,
-                                        'finish':'',
-                                        'finished':'No',
-                                        'startlist':''})
+        cr = snapshot.config({'start':'',
+                              'lstart':'',
+                              'id':EVENT_ID,
+                              'finish':'',
+                              'finished':'No',
+                              'startlist':''})
         cr.add_section('event')
         cr.add_section('riders')
         if os.path.isfile(self.configpath):
@@ -114,7 +114,7 @@ class sportif(object):
             if cr.has_option('riders', r):
                 nr = self.getrider(r)
                 # bib = comment,rftod,rfseen...
-                ril = csv.reader([cr.get('riders', r)]).next()
+                ril = cr.getrow('riders', r)
                 lr = len(ril)
                 if lr > 0:
                     nr[COL_COMMENT] = ril[0]
@@ -155,7 +155,7 @@ class sportif(object):
         if self.readonly:
             self.log.error('Attempt to save readonly ob.')
             return
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('event')
         if self.start is not None:
             cw.set('event', 'start', self.start.rawtime())
@@ -179,12 +179,10 @@ class sportif(object):
             for t in r[COL_RFSEEN]:
                 if t is not None:
                     slice.append(t.rawtime(2))
-            cw.set('riders', r[COL_BIB],
-                    ','.join(map(lambda i: str(i).replace(',', '\\,'), slice)))
+            cw.setrow('riders', r[COL_BIB], slice)
         cw.set('event', 'id', EVENT_ID)
         self.log.debug('Saving config to: ' + self.configpath)
-        with open(self.configpath, 'wb') as f:
-            cw.write(f)
+        cw.save(self.configpath)
 
     def show(self):
         """Show event container."""
@@ -354,21 +352,11 @@ no.   rider                              lap 1   lap 2   lap 3   lap 4')
 
     def getrider(self, bib):
         """Return reference to selected rider no."""
-        ret = None
-        for r in self.riders:
-            if r[COL_BIB] == bib:
-                ret = r
-                break
-        return ret
+        return self.ridx.getrow(bib)
 
     def getiter(self, bib):
         """Return temporary iterator to model row."""
-        i = self.riders.get_iter_first()
-        while i is not None:
-            if self.riders.get_value(i, COL_BIB) == bib:
-                break
-            i = self.riders.iter_next(i)
-        return i
+        return self.ridx.getiter(bib)
 
     def delrider(self, bib=''):
         """Remove the specified rider from the model."""
@@ -620,6 +608,7 @@ no.   rider                              lap 1   lap 2   lap 3   lap 4')
                                     gobject.TYPE_STRING, # COMMENT = 3
                                     gobject.TYPE_PYOBJECT, # RFTIME = 4
                                     gobject.TYPE_PYOBJECT) # RFSEEN = 5
+        self.ridx = uiutil.rowindex(self.riders, COL_BIB)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'sportif.ui'))
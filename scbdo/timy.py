@@ -76,6 +76,7 @@ import decimal
 
 from scbdo import strops
 from scbdo import tod
+from scbdo import journal
 
 # System default timy serial port
 TIMYPORT = '/dev/ttyUSB0'
@@ -134,6 +135,7 @@ class timy(threading.Thread):
         self.errstr = ''
         self.cqueue = Queue.Queue()	# command queue
         self.rqueue = Queue.Queue()	# response queue
+        self.journal = None		# raw impulse journal
         self.log = logging.getLogger(self.name)
         self.log.setLevel(logging.DEBUG)
         if port is not None:
@@ -145,6 +147,10 @@ class timy(threading.Thread):
         self.log.log(TIMER_LOG_LEVEL, lmsg)
         self.cqueue.put_nowait(('MSG', 'DTP' + lmsg + '\r'))
 
+    def setjournal(self, jnl=None):
+        """Record all received impulses to the journal jnl."""
+        self.journal = jnl
+
     def linefeed(self):
         """Advance Timy printer by one line."""
         self.cqueue.put_nowait(('MSG', 'PRILF\r'))
@@ -314,6 +320,8 @@ class timy(threading.Thread):
             st = self.parse_impulse(msg)
             if st is not None:
                 self.log.log(TIMER_LOG_LEVEL, ' ' + str(st))
+                if self.journal is not None:
+                    self.journal.append(st, journal.SRC_TIMY)
                 if len(st.chan) > 1 and st.chan[0] == 'C':
                     channo = int(st.chan[1])
                     if self.arms[channo]:
@@ -365,6 +373,8 @@ class timy(threading.Thread):
                                 t = tod.tod(m[2].timeval, 'FAKE',
                                             'C' + str(m[1]) + 'i')
                                 self.log.log(TIMER_LOG_LEVEL,' ' + str(t))
+                                if self.journal is not None:
+                                    self.journal.append(t, journal.SRC_TIMY)
                                 if self.arms[m[1]]:
                                     self.arms[m[1]] = False
                                     self.rqueue.put_nowait(t)
@@ -21,12 +21,16 @@ This module defines the tod class and some utility functions.
 
 ToD records are used to establish net times
 
-Time of Day quantities are stored as a positive decimal number of
-seconds in the range [0, 86400). The overflow value '24:00:00'
-(equivalent to 86400 seconds) is forbidden and its presence
+Time of Day quantities are stored as a positive integer number of
+ticks (1/100000 s) in the range [0, 8640000000). The overflow value
+'24:00:00' (equivalent to 86400 seconds) is forbidden and its presence
 flags a programming error or an error in the attached timing device.
 All time of day and net time values must be less than 24hrs.
 
+Arithmetic, comparison, truncation and formatting all operate on the
+integer tick count. Decimal values are only constructed at the edges:
+when parsing a string (str2dec) or when the timeval attribute is read.
+
 'rounding' is by truncation toward zero. If a negative value is
 specified by manually setting the timeval attribute, the resulting
 timestring may not be what is expected. Arithmetic will still be
@@ -35,6 +39,7 @@ exact, however a negative result may not display as expected.
 A time of day object includes:
 
    - timeval : decimal tod in seconds (eg 1.2345, 4506.9023, etc)
+   - ticks   : integer tod in 1/100000 s (eg 123450, 450690230, etc)
    - index   : 4 character identifier string (eg '1' to '9999')
    - chan    : 3 character channel string from source (eg 'C0', 'C2M', etc)
    - refid   : string reference id, used for RFID tag events (eg '75ae7f')
@@ -95,6 +100,7 @@ printed, space padded, according to the requested precision.
 
 """
 
+import bisect		# ToD list ordering
 import decimal		# ToD internal representation
 import re		# used to scan ToD string: HH:MM:SS.dcmz 
 import time
@@ -110,6 +116,9 @@ QUANT = [QUANT_0PLACES, QUANT_1PLACE, QUANT_2PLACES,
 QUANT_FW = [2, 4, 5, 6, 7, 8]
 QUANT_TWID = [8, 10, 11, 12, 13, 14]
 QUANT_PAD = ['     ', '   ', '  ', ' ', '', '']
+TICKS = 100000				# integer ticks per second
+TICKQ = [100000, 10000, 1000, 100, 10, 1]	# ticks per unit at places
+MAXTICKS = 86400 * TICKS		# overflow value '24:00:00'
 TOD_RE=re.compile(r'^(?:(?:(\d{1,2})[h:-])?(\d{1,2})[:-])?(\d{1,2}(?:\.\d+)?)$')
 
 
@@ -201,8 +210,58 @@ def str2dec(timestr=''):
             dectod = decimal.Decimal(timestr)
     return dectod.quantize(QUANT[4], rounding=decimal.ROUND_FLOOR)
 
+def dec2ticks(dectod=None):
+    """Return integer tick count for given decimal seconds value.
+
+    Values are truncated toward zero to the nearest tick.
+
+    """
+    return int(dectod.quantize(QUANT[5], rounding=decimal.ROUND_FLOOR)
+                   * TICKS)
+
+def ticks2dec(ticks=0):
+    """Return exact decimal seconds value for given tick count."""
+    return decimal.Decimal(ticks).scaleb(-5)
+
+def ticks2str(ticks=0, places=4, zeros=False):
+    """Return formatted string for given tod tick count.
+
+    Integer equivalent of dec2str, output is identical for all
+    non-negative tick counts. Negative counts are passed through
+    to dec2str.
+
+    """
+    assert places >= 0 and places <= 5, 'places not in range [0, 5]'
+    if ticks < 0:
+        return dec2str(ticks2dec(ticks), places, zeros)
+    secs, frac = divmod(ticks, TICKS)
+    if places > 0:
+        ss = '.{0:0{1}d}'.format(frac // TICKQ[places], places)
+    else:
+        ss = ''
+    if zeros or secs >= 3600:
+        fmt = '{0}h{1:02}:{2:02}{3}'		# 'HHhMM:SS.dcmz'
+        if zeros:
+            fmt = '{0:02}:{1:02}:{2:02}{3}'	# '00h00:0S.dcmz'
+        return fmt.format(secs//3600, (secs%3600)//60, secs%60, ss)
+    elif secs >= 60:				# MM:SS.dcmz
+        return '{0}:{1:02}{2}'.format(secs//60, secs%60, ss)
+    else:					# SS.dcmz
+        return '{0}{1}'.format(secs, ss)
+
+def mktod(ticks=0, index='', chan='', refid=''):
+    """Return a new tod for given tick count without range checks."""
+    ret = tod.__new__(tod)
+    ret.index = index
+    ret.chan = chan
+    ret.refid = refid
+    ret.ticks = ticks
+    return ret
+
 class tod(object):
     """A class for representing time of day and RFID events."""
+    __slots__ = ('index', 'chan', 'refid', 'ticks')
+
     def __init__(self, timeval=0, index='', chan='', refid=''):
         """Construct tod object.
 
@@ -218,12 +277,23 @@ class tod(object):
         self.chan = str(chan)[0:3]
         self.refid = refid
         if type(timeval) is str:
-            self.timeval = str2dec(timeval)
+            self.ticks = dec2ticks(str2dec(timeval))
         elif type(timeval) is tod:
-            self.timeval = timeval.timeval
+            self.ticks = timeval.ticks
+        elif type(timeval) in (int, long):
+            self.ticks = timeval * TICKS
         else:
-            self.timeval = decimal.Decimal(timeval)
-        assert self.timeval >= 0 and self.timeval < 86400, 'timeval not in range [0, 86400)'
+            self.ticks = dec2ticks(decimal.Decimal(timeval))
+        assert self.ticks >= 0 and self.ticks < MAXTICKS, 'timeval not in range [0, 86400)'
+
+    def _get_timeval(self):
+        return ticks2dec(self.ticks)
+
+    def _set_timeval(self, timeval):
+        self.ticks = dec2ticks(decimal.Decimal(timeval))
+
+    timeval = property(_get_timeval, _set_timeval,
+                       doc='Decimal time value in seconds.')
 
     def __str__(self):
         """Return a normalised tod string."""
@@ -247,8 +317,7 @@ class tod(object):
 
     def truncate(self, places=4):
         """Return a new ToD object with a truncated time value."""
-        return tod(timeval=self.timeval.quantize(QUANT[places],
-                rounding=decimal.ROUND_FLOOR), index='', chan='ToD', refid='')
+        return mktod(self.ticks - self.ticks % TICKQ[places], chan='ToD')
 
     def as_hours(self, places=0):
         """Return the tod value in hours, truncated to the desired places."""
@@ -267,56 +336,57 @@ class tod(object):
 
     def timestr(self, places=4, zeros=False):
         """Return time string component of the tod, whitespace padded."""
-        return '{0: >{1}}{2}'.format(dec2str(self.timeval, places, zeros),
+        return '{0: >{1}}{2}'.format(ticks2str(self.ticks, places, zeros),
             QUANT_TWID[places], QUANT_PAD[places])
 
     def rawtime(self, places=4, zeros=False):
         """Return time string component of the tod, without padding."""
-        return dec2str(self.timeval, places, zeros)
+        return ticks2str(self.ticks, places, zeros)
 
     def speedstr(self, dist=200):
         """Return an average speed estimate for the provided distance."""
-        if self.timeval == 0:
+        if self.ticks == 0:
             return '---.--- km/h'
-        return '{0:7.3f} km/h'.format(3.6 * float(dist) / float(self.timeval))
+        return '{0:7.3f} km/h'.format(3.6 * float(dist) * TICKS
+                                          / float(self.ticks))
 
     def copy(self):
         """Return a copy of the supplied tod."""
-        return tod(self.timeval, self.index, self.chan, self.refid)
+        return mktod(self.ticks, self.index, self.chan, self.refid)
 
     def __lt__(self, other):
         if type(other) is tod:
-            return self.timeval < other.timeval
+            return self.ticks < other.ticks
         else:
             return self.timeval < other
 
     def __le__(self, other):
         if type(other) is tod:
-            return self.timeval <= other.timeval
+            return self.ticks <= other.ticks
         else:
             return self.timeval <= other
 
     def __eq__(self, other):
         if type(other) is tod:
-            return self.timeval == other.timeval
+            return self.ticks == other.ticks
         else:
             return self.timeval == other
 
     def __ne__(self, other):
         if type(other) is tod:
-            return self.timeval != other.timeval
+            return self.ticks != other.ticks
         else:
             return self.timeval != other
 
     def __gt__(self, other):
         if type(other) is tod:
-            return self.timeval > other.timeval
+            return self.ticks > other.ticks
         else:
             return self.timeval > other
 
     def __ge__(self, other):
         if type(other) is tod:
-            return self.timeval >= other.timeval
+            return self.ticks >= other.ticks
         else:
             return self.timeval >= other
 
@@ -330,11 +400,11 @@ class tod(object):
         """
         if type(other) is tod:
             oft = None
-            if self.timeval >= other.timeval:
-                oft = self.timeval - other.timeval
+            if self.ticks >= other.ticks:
+                oft = self.ticks - other.ticks
             else:
-                oft = 86400 - other.timeval + self.timeval
-            return tod(timeval=oft, index='', chan='NET', refid='')
+                oft = MAXTICKS - other.ticks + self.ticks
+            return mktod(oft, chan='NET')
         else:
             raise TypeError('Cannot subtract {0} from tod.'.format(
                                 str(type(other).__name__)))
@@ -347,13 +417,31 @@ class tod(object):
 
         """
         if type(other) is tod:
-            oft = (self.timeval + other.timeval) % 86400
-            return tod(timeval=oft, index='', chan='ToD', refid='')
+            oft = (self.ticks + other.ticks) % MAXTICKS
+            return mktod(oft, chan='ToD')
         else:
             raise TypeError('Cannot add {0} to tod.'.format(
                                 str(type(other).__name__)))
 
 
+# Interned constant pool
+CONSTPOOL = {}
+
+def const(timeval=0):
+    """Return a shared tod for the given constant time value.
+
+    Interned tods are used as operands in hot loops (eg bunch gap
+    checks) to avoid re-parsing the same literal on every call. They
+    are shared by all callers and must never be modified or stored
+    in a model.
+
+    """
+    ret = CONSTPOOL.get(timeval)
+    if ret is None:
+        ret = tod(timeval)
+        CONSTPOOL[timeval] = ret
+    return ret
+
 # ToD 'constants'
 ZERO = tod()
 MAX = tod('23h59:59.9999')
@@ -374,10 +462,22 @@ for c in ['caught', 'abort', 'dsq', 'dnf', 'dns']:
     cof += extra
 
 class todlist():
-    """ToD list helper class for managing splits and ranks."""
+    """ToD list helper class for managing splits and ranks.
+
+    Entries are kept in time order with a parallel list of integer
+    tick keys so that insert, remove and rank can locate entries
+    by bisection. A set of distinct keys provides the rank of a time
+    with dead heats sharing the same rank, and an index from
+    (bib, series) to entries locates existing results for removal.
+
+    """
     def __init__(self, lbl=''):
         self.__label = lbl
         self.__store = []
+        self.__keys = []
+        self.__distinct = []
+        self.__count = {}
+        self.__index = {}
 
     def __iter__(self):
         return self.__store.__iter__()
@@ -391,28 +491,34 @@ class todlist():
     def rank(self, bib, series=''):
         """Return current 0-based rank for given bib."""
         ret = None
-        i = 0
-        last = None
-        for lt in self.__store:
-            if last is not None:
-                if lt != last:
-                    i += 1
-            if lt.refid == bib and lt.index == series:
-                ret = i
-                break
-            last = lt
+        el = self.__index.get((bib, series))
+        if el:
+            k = min(el).ticks
+            ret = bisect.bisect_left(self.__distinct, k)
         return ret
 
     def clear(self):
         self.__store = []
+        self.__keys = []
+        self.__distinct = []
+        self.__count = {}
+        self.__index = {}
 
     def remove(self, bib, series=''):
-        i = 0
-        while i < len(self.__store):
-            if self.__store[i].refid == bib and self.__store[i].index == series:
+        el = self.__index.pop((bib, series), None)
+        if el is not None:
+            for rt in el:
+                k = rt.ticks
+                i = bisect.bisect_left(self.__keys, k)
+                while self.__store[i] is not rt:
+                    i += 1
                 del self.__store[i]
-            else:
-                i += 1
+                del self.__keys[i]
+                self.__count[k] -= 1
+                if self.__count[k] == 0:
+                    del self.__count[k]
+                    del self.__distinct[bisect.bisect_left(
+                                               self.__distinct, k)]
 
     def insert(self, t, bib=None, series=''):
         """Insert t into ordered list."""
@@ -423,19 +529,24 @@ class todlist():
         if type(t) is tod:
             if bib is None:
                 bib = t.index
-            rt = tod(timeval=t.timeval, chan=self.__label,
+            rt = tod(timeval=t, chan=self.__label,
                        refid=bib, index=series)
-            last = None
-            i = 0
-            found = False
-            for lt in self.__store:
-                if rt < lt:
-                    self.__store.insert(i, rt)
-                    found = True
-                    break
-                i += 1
-            if not found:
-                self.__store.append(rt)
+            k = rt.ticks
+            i = bisect.bisect_right(self.__keys, k)
+            self.__store.insert(i, rt)
+            self.__keys.insert(i, k)
+            if k in self.__count:
+                self.__count[k] += 1
+            else:
+                self.__count[k] = 1
+                bisect.insort(self.__distinct, k)
+            # Note: index is keyed on the stored values, which may
+            #       differ from the supplied bib and series.
+            ik = (rt.refid, rt.index)
+            if ik in self.__index:
+                self.__index[ik].append(rt)
+            else:
+                self.__index[ik] = [rt]
            
 if __name__ == "__main__":
     srcs = ['1:23:45.6789', '1:23-45.6789', '1-23-45.6789',
@@ -479,3 +590,83 @@ if __name__ == "__main__":
     print ('\t     c: '+ str(c))
     print ('\t   avg: '+ (b-a).speedstr())
 
+    print ('4: Backend Micro-benchmark')
+    import timeit
+    def dec_bunch(a, b, gap):
+        """Bunch gap check using the reference decimal backend."""
+        if a >= b:
+            et = a - b
+        else:
+            et = 86400 - b + a
+        et = decimal.Decimal(et)
+        assert et >= 0 and et < 86400
+        same = et < gap
+        ct = decimal.Decimal(et.quantize(QUANT[0],
+                                         rounding=decimal.ROUND_FLOOR))
+        return dec2str(ct, 1)
+    def tick_bunch(a, b, gap):
+        """Bunch gap check using integer tick tods."""
+        et = a - b
+        same = et < gap
+        ct = et.truncate(0)
+        return ct.rawtime(1)
+    count = 50000
+    da = str2dec('1h12:34.5678')
+    db = str2dec('10:01.2345')
+    dg = str2dec('1.12')
+    dt = min(timeit.repeat(lambda: dec_bunch(da, db, dg),
+                           repeat=3, number=count))
+    ta = tod(da)
+    tb = tod(db)
+    tg = tod(dg)
+    tt = min(timeit.repeat(lambda: tick_bunch(ta, tb, tg),
+                           repeat=3, number=count))
+    print ('\t  decimal: {0:8.2f} us/op'.format(1e6 * dt / count))
+    print ('\t    ticks: {0:8.2f} us/op'.format(1e6 * tt / count))
+    print ('\t  speedup: {0:8.2f}x'.format(dt / tt))
+
+    print ('5: Sighting Memory Footprint')
+    import sys
+    class dicttod(object):
+        """Reference unslotted layout with a decimal timeval."""
+        def __init__(self, timeval, index='', chan='', refid=''):
+            self.index = index
+            self.chan = chan
+            self.refid = refid
+            self.timeval = timeval
+    def sizeof(o):
+        ret = sys.getsizeof(o)
+        if hasattr(o, '__dict__'):
+            ret += sys.getsizeof(o.__dict__)
+            ret += sys.getsizeof(o.timeval)
+        else:
+            ret += sys.getsizeof(o.ticks)
+        return ret
+    e = tod('1h12:34.5678', '', 'RF', '75ae7f')
+    bs = sizeof(dicttod(e.timeval, e.index, e.chan, e.refid))
+    ss = sizeof(e)
+    print ('\t   before: {0:5d} bytes/sighting'.format(bs))
+    print ('\t    after: {0:5d} bytes/sighting'.format(ss))
+    print ('\t   saving: {0:5.1f} MB per 100k sightings'.format(
+                                   (bs - ss) * 100000 / 1048576.0))
+
+    print ('6: ToD List Insert Benchmark')
+    import random
+    count = 5000
+    fins = [(str(i), mktod(random.randint(3600, 7200) * TICKS
+                             + random.randint(0, 9999) * 10))
+              for i in range(1, count + 1)]
+    tl = todlist('FIN')
+    st = time.time()
+    for bib, ft in fins:
+        tl.remove(bib)
+        tl.insert(ft, bib)
+        tl.rank(bib)
+    et = time.time() - st
+    last = None
+    for t in tl:
+        assert last is None or last <= t, 'todlist out of order'
+        last = t
+    print ('\t  entries: {0:8d}'.format(len(tl)))
+    print ('\t    total: {0:8.3f} s'.format(et))
+    print ('\t   finish: {0:8.2f} us/op'.format(1e6 * et / count))
@@ -28,7 +28,6 @@ import os
 import sys
 import csv
 import logging
-import ConfigParser
 
 import scbdo
 
@@ -39,6 +38,11 @@ from scbdo import scbwin
 from scbdo import sender
 from scbdo import uscbsrv
 from scbdo import timy
+from scbdo import journal
+from scbdo import snapshot
+from scbdo import resultcache
+from scbdo import eventmodel
+from scbdo import export
 from scbdo import unt4
 from scbdo import strops
 from scbdo import loghandler
@@ -50,10 +54,25 @@ from scbdo import omnium
 LOGHANDLER_LEVEL = logging.DEBUG
 DEFANNOUNCE_PORT = ''
 CONFIGFILE = 'config.ini'
+JOURNALFILE = 'timing.jnl'	# raw timer journal
+EXPORT_WAIT = 5.0		# seconds to wait for export on exit
 TRACKMEET_ID = 'trackmeet_1.3'	# configuration versioning
 
 def mkrace(meet, event, ui=True):
-    """Return a race object of the correct type."""
+    """Return a race object of the correct type.
+
+    With ui False, a headless event model is returned instead.
+
+    """
+    if not ui:
+        evno = meet.edb.getvalue(event, eventdb.COL_EVNO)
+        return eventmodel.mkevent(meet.event_configpath(evno), evno,
+                         meet.edb.getvalue(event, eventdb.COL_TYPE),
+                         meet.edb.getvalue(event, eventdb.COL_SERIES), meet)
+    return mkhandler(meet, event, ui)
+
+def mkhandler(meet, event, ui=True):
+    """Return an interactive race handler of the correct type."""
     ret = None
     etype = meet.edb.getvalue(event, eventdb.COL_TYPE)
     if etype in ['flying 200', 'flying lap', 'indiv tt',
@@ -339,20 +358,54 @@ class trackmeet:
         pass
 
     def menu_data_export_activate_cb(self, menuitem, data=None):
-        """Open rider export dialog."""
-        self.log.warn('TODO :: Export proc...')
-        # New style:
-        #   if not working (or return)
-        #   set a working flag
-        #   in a thread:
-        #       create export dir if required
-        #       [opt]create html export
-            #       for each event:
-            #           write the event analysis file
-            #       create the meet summary (aka index)
-        #       [opt]create pdf export
-        #       [opt]create xls export
-        #       clear working flag
+        """Export meet results in a background thread."""
+        if self.exporter is not None and self.exporter.is_alive():
+            self.log.warn('Export already in progress.')
+            return
+        self.saveconfig()	# export reads the saved event configs
+        events = []
+        for e in self.edb:
+            evno = self.edb.getvalue(e, eventdb.COL_EVNO)
+            events.append((evno,
+                           self.edb.getvalue(e, eventdb.COL_PREFIX),
+                           self.edb.getvalue(e, eventdb.COL_INFO),
+                           self.edb.getvalue(e, eventdb.COL_TYPE),
+                           self.edb.getvalue(e, eventdb.COL_SERIES),
+                           self.event_configpath(evno)))
+        riders = {}
+        for r in self.rdb:
+            riders[(self.rdb.getvalue(r, riderdb.COL_BIB),
+                    self.rdb.getvalue(r, riderdb.COL_SERIES))] = (
+                         self.rdb.getvalue(r, riderdb.COL_FIRST),
+                         self.rdb.getvalue(r, riderdb.COL_LAST),
+                         self.rdb.getvalue(r, riderdb.COL_CLUB))
+        self.exporter = export.exporter(
+                          os.path.join(self.configpath, export.EXPORTDIR),
+                          events, self.get_distance,
+                          progress=self.export_progress_cb,
+                          done=self.export_done_cb, riders=riders)
+        self.log.info('Exporting ' + str(len(events)) + ' events.')
+        self.exporter.start()
+
+    def export_progress_cb(self, count, total, evno, status):
+        """Queue export progress into the main loop."""
+        glib.idle_add(self.export_progress, count, total, evno, status)
+
+    def export_progress(self, count, total, evno, status):
+        """Show export progress in the status bar."""
+        self.status.pop(self.context)
+        self.status.push(self.context, 'Export: {0}/{1} event {2} {3}'.format(
+                                          count, total, evno, status))
+        return False
+
+    def export_done_cb(self, written, skipped, failed):
+        """Queue export completion into the main loop."""
+        glib.idle_add(self.export_done, written, skipped, failed)
+
+    def export_done(self, written, skipped, failed):
+        """Clear export progress from the status bar."""
+        self.status.pop(self.context)
+        return False
 
     def menu_data_results_cb(self, menuitem, data=None):
         """Export live results to disk."""
@@ -494,6 +547,15 @@ class trackmeet:
         """Return a config filename for the given event no."""
         return os.path.join(self.configpath, 'event_' + str(evno) + '.ini')
 
+    def event_configpath(self, evno):
+        """Return the path of the config saved by event evno, or None."""
+        eh = self.edb.getevent(evno)
+        if eh is None:
+            return None
+        if self.edb.getvalue(eh, eventdb.COL_TYPE) in ['omnium', 'aggregate']:
+            return os.path.join(self.configpath, 'event_' + str(evno))
+        return self.event_configfile(evno)
+
     ## Timer callbacks
     def menu_clock_timeout(self):
         """Update time of day on clock button."""
@@ -502,6 +564,7 @@ class trackmeet:
         else:
             tt = tod.tod('now').rawtime(places=0,zeros=True)
             self.clock_label.set_text(tt)
+            self.journal.poll()
             #self.announce.postxt(0,72,tt)
         return True
 
@@ -617,6 +680,9 @@ class trackmeet:
         self.backup_timer.exit(msg)
         self.timer.join()	# Wait on closure of main timer thread
         self.announce.join()	# Wait on closure of announce thread
+        if self.exporter is not None:
+            self.exporter.join(EXPORT_WAIT)	# Let a running export finish
+        self.journal.close()
         self.started = False
 
     def start(self):
@@ -632,7 +698,7 @@ class trackmeet:
     ## Track meet functions
     def saveconfig(self):
         """Save current meet data to disk."""
-        cw = ConfigParser.ConfigParser()
+        cw = snapshot.config()
         cw.add_section('meet')
         cw.set('meet', 'id', TRACKMEET_ID)
         if self.curevent is not None and self.curevent.winopen:
@@ -662,28 +728,27 @@ class trackmeet:
         cw.set('meet', 'tracklen_d', str(self.tracklen_d))
         cwfilename = os.path.join(self.configpath, CONFIGFILE)
         self.log.debug('Saving meet config to ' + repr(cwfilename))
-        with open(cwfilename , 'wb') as f:
-            cw.write(f)
+        cw.save(cwfilename, text=True)
         self.rdb.save(os.path.join(self.configpath, 'riders.csv'))
         self.edb.save(os.path.join(self.configpath, 'events.csv'))
 
     def loadconfig(self):
         """Load meet config from disk."""
-        cr = ConfigParser.ConfigParser({'maintimer':timy.MAINPORT,
-                                        'backuptimer':timy.BACKUPPORT,
-                                        'racetimer':'main',
-                                        'scbport':'SCBDO',
-                                        'uscbport':DEFANNOUNCE_PORT,
-                                        'showevno':'Yes',
-					'resultbibs':'Yes',
-                                        'tracklen_n':'250',
-                                        'tracklen_d':'1',
-                                        'line1':'',
-                                        'line2':'',
-                                        'line3':'',
-                                        'logos':'',
-                                        'curevent':'',
-                                        'id':''})
+        cr = snapshot.config({'maintimer':timy.MAINPORT,
+                              'backuptimer':timy.BACKUPPORT,
+                              'racetimer':'main',
+                              'scbport':'SCBDO',
+                              'uscbport':DEFANNOUNCE_PORT,
+                              'showevno':'Yes',
+                              'resultbibs':'Yes',
+                              'tracklen_n':'250',
+                              'tracklen_d':'1',
+                              'line1':'',
+                              'line2':'',
+                              'line3':'',
+                              'logos':'',
+                              'curevent':'',
+                              'id':''})
         cr.add_section('meet')
         cwfilename = os.path.join(self.configpath, CONFIGFILE)
 
@@ -699,6 +764,10 @@ class trackmeet:
                        '%(asctime)s %(levelname)s:%(name)s: %(message)s'))
         self.log.addHandler(self.loghandler)
 
+        # re-open raw timing journal
+        self.journal.open(os.path.join(self.configpath, JOURNALFILE))
+        self.results.clear()
+
         # check for config file
         try:
             a = len(cr.read(cwfilename))
@@ -832,6 +901,11 @@ class trackmeet:
         self.backup_timer = timy.timy('', name='bkup')
         self.backup_port = ''
         self.timer = self.main_timer
+        self.journal = journal.journal()	# opened in loadconfig
+        self.results = resultcache.resultcache(self)
+        self.exporter = None	# background export thread
+        self.main_timer.setjournal(self.journal)
+        self.backup_timer.setjournal(self.journal)
 
         b = gtk.Builder()
         b.add_from_file(os.path.join(scbdo.UI_PATH, 'trackmeet.ui'))
@@ -39,6 +39,110 @@ def liststore_inorder(model):
             yield gtk.TreeRowReference(model, model.get_path(i))
             i = model.iter_next(i)
 
+class rowindex(object):
+    """Maintained index from key columns to rows in a list store.
+
+    Rows are held by TreeRowReference so the index survives reorder,
+    swap and move on the model. Appended and edited rows are indexed
+    from the model's row-inserted and row-changed signals. A lookup
+    which finds a removed row, or a row whose key has since changed,
+    rebuilds the index from the model. When keys are duplicated the
+    first row in the model is returned after a rebuild.
+
+    """
+    def __init__(self, model, *cols, **kwargs):
+        """Constructor.
+
+        Parameters:
+
+          model -- the gtk.ListStore to index
+          cols -- model columns that make up the key
+          keyfunc -- optional function applied to key tuples
+
+        """
+        self.model = model
+        self.cols = cols
+        self.keyfunc = kwargs.get('keyfunc')
+        self.__idx = {}
+        self.__handlers = [
+            model.connect('row-inserted', self.__row_changed_cb),
+            model.connect('row-changed', self.__row_changed_cb)]
+        self.reindex()
+
+    def __key(self, vals):
+        """Return the index key for the supplied column values."""
+        if self.keyfunc is not None:
+            return self.keyfunc(vals)
+        return vals
+
+    def __check(self, ref, key):
+        """Return True if ref is valid and its row still matches key."""
+        ret = False
+        if ref.valid():
+            ret = self.__key(self.model.get(
+                      self.model.get_iter(ref.get_path()), *self.cols)) == key
+        return ret
+
+    def getref(self, *key):
+        """Return a TreeRowReference to the row matching key or None."""
+        key = self.__key(key)
+        ret = self.__idx.get(key)
+        if ret is not None and not self.__check(ret, key):
+            self.reindex()
+            ret = self.__idx.get(key)
+        return ret
+
+    def getiter(self, *key):
+        """Return temporary iterator to the row matching key or None."""
+        ret = None
+        ref = self.getref(*key)
+        if ref is not None:
+            ret = self.model.get_iter(ref.get_path())
+        return ret
+
+    def getrow(self, *key):
+        """Return temporary reference to the row matching key or None."""
+        ret = None
+        ref = self.getref(*key)
+        if ref is not None:
+            ret = self.model[ref.get_path()]
+        return ret
+
+    def reindex(self):
+        """Rebuild the index from the model."""
+        self.__idx = {}
+        i = self.model.get_iter_first()
+        while i is not None:
+            vals = self.model.get(i, *self.cols)
+            if vals[0] is not None:
+                key = self.__key(vals)
+                if key not in self.__idx:
+                    self.__idx[key] = gtk.TreeRowReference(self.model,
+                                                  self.model.get_path(i))
+            i = self.model.iter_next(i)
+
+    def block(self):
+        """Suspend index updates, eg for a bulk load."""
+        for h in self.__handlers:
+            self.model.handler_block(h)
+
+    def unblock(self):
+        """Resume index updates and rebuild the index."""
+        for h in self.__handlers:
+            self.model.handler_unblock(h)
+        self.reindex()
+
+    def __row_changed_cb(self, model, path, iter, data=None):
+        """Index a new or edited row."""
+        vals = model.get(iter, *self.cols)
+        if vals[0] is None:	# row inserted but not yet filled
+            return
+        key = self.__key(vals)
+        oref = self.__idx.get(key)
+        if oref is None or (oref.get_path() != path
+                            and not self.__check(oref, key)):
+            self.__idx[key] = gtk.TreeRowReference(model, path)
+
 def hvscroller(child):
     """Return a new scrolled window packed with the supplied child."""
     vs = gtk.ScrolledWindow()
@@ -24,15 +24,21 @@ Note: Normal program code will not use this library directly
       scoreboard communication should go via the sender or
       scbwin classes.
 
+Packed messages are kept in a small cache keyed on the message
+fields, so repeated draws of the same text and the pre-defined
+overlay messages are only packed once.
+
 Needs work:
 
   - pack() method should validate parameters for set
-  - input strings should be scanned _once_ only, not twice
   - is I/O buffer part of this module?
     or does it belong in caller?
 
 """
 
+import re
+import collections
+
 # mode 1 constants
 SOH = 0x01
 STX = 0x02
@@ -70,21 +76,88 @@ ENCMAP = {
    chr(RS):'<R>',
    chr(US):'<U>'}
   
+# Reverse map, where two keys share an escape the first key wins
+DECMAP = {}
+for key in ENCMAP:
+    DECMAP.setdefault(ENCMAP[key], key)
+
+# Single pass escape and unescape patterns
+ENCRE = re.compile('[' + re.escape(''.join(ENCMAP.keys())) + ']')
+DECRE = re.compile('|'.join([re.escape(k) for k in DECMAP]))
+
 # Encoding for text -> use 1 byte for compatibility
 CHAR_ENCODE = 'latin_1'
 
+# Prefix characters removed from a packet header
+PREFIXCHARS = chr(DC2) + chr(DC3) + chr(DC4)
+
+# Pre-computed <DLE>xxyy position prefixes for the first POSROWS rows
+POSROWS = 20
+POSPFX = [chr(DLE) + '{0:02d}{1:02d}'.format(xx, yy)
+            for yy in range(POSROWS) for xx in range(100)]
+
+# Packed message cache size, per generation
+PACKCACHE = 512
+
 def encode(unt4buf=''):
     """Encode the unt4 buffer for use with IRC."""
-    for key in ENCMAP:
-        unt4buf = unt4buf.replace(key, ENCMAP[key])
-    return unt4buf
+    return ENCRE.sub(lambda m: ENCMAP[m.group(0)], unt4buf)
 
 def decode(ircbuf=''):
     """Decode the irc buffer to unt4msg pack."""
     ircbuf = ircbuf.replace('<00>','')
-    for key in ENCMAP:
-        ircbuf = ircbuf.replace(ENCMAP[key], key)
-    return ircbuf
+    return DECRE.sub(lambda m: DECMAP[m.group(0)], ircbuf)
+
+def pospfx(xx, yy):
+    """Return the <DLE>xxyy position prefix for column xx and row yy."""
+    if 0 <= yy < POSROWS and 0 <= xx < 100:
+        return POSPFX[yy * 100 + xx]
+    return chr(DLE) + '{0:02d}{1:02d}'.format(xx, yy)
+
+def packmsg(prefix=None, header='', erp=False, erl=False,
+            xx=None, yy=None, text=''):
+    """Return a UNT4 string packet for the supplied message fields.
+
+    Packets are cached in two generations: a hit in the old
+    generation is promoted to the new one and the old generation
+    is dropped each time the new one fills, which keeps the most
+    recently used packets without any per-lookup bookkeeping.
+
+    """
+    key = (prefix, header, erp, erl, xx, yy, text)
+    ret = packmsg.new.get(key)
+    if ret is None:
+        ret = packmsg.old.get(key)
+        if ret is None:
+            head = ''
+            body = ''
+            if erp:	# overrides any other message content
+                body = chr(STX) + chr(ERP)
+            else:
+                head = header
+                if prefix is not None:
+                    head = chr(prefix) + head
+                if xx is not None and yy is not None:
+                    body = pospfx(xx, yy)
+                body += text
+                if erl:
+                    body += chr(ERL)
+                if len(body) > 0:
+                    body = chr(STX) + body
+            ret = chr(SOH) + head + body + chr(EOT)
+        if len(packmsg.new) >= PACKCACHE:
+            packmsg.old = packmsg.new
+            packmsg.new = {}
+        packmsg.new[key] = ret
+    return ret
+packmsg.new = {}
+packmsg.old = {}
+
+# Complete packet: the last <SOH> before an <EOT>
+PACKRE = re.compile(chr(SOH) + '[^' + chr(SOH) + chr(EOT) + ']*' + chr(EOT))
+
+# Read size for port input
+RDCHUNK = 4096
 
 class unt4buf(object):
     """UNT4 input buffer object.
@@ -93,66 +166,51 @@ class unt4buf(object):
     and return as string. None is returned at end of file or
     stream closure.
 
+    Input may also be pushed in arbitrary chunks with feed(), after
+    which packets() returns the complete packet strings and
+    messages() the unpacked unt4 objects. A packet split across
+    chunks is kept in the buffer until its <EOT> arrives. Bytes
+    outside <SOH>..<EOT> are discarded, and a packet interrupted
+    by a new <SOH> is dropped in favour of the new one.
+
     """
     def __init__(self, port=None):
         """Constructor."""
         self.port = port
-        self.buf = ''
-        #self.buf = b''		# Python3
-        self.bpos = 0
-        self.pack = ''
-        #self.pack = b''	# Python3
-        self.state = None
+        self.buf = bytearray()
+        self.pending = collections.deque()
+
+    def feed(self, chunk=''):
+        """Append chunk to the input buffer."""
+        self.buf.extend(chunk)
+
+    def packets(self):
+        """Remove and return a list of all complete packets in buffer."""
+        buf = self.buf
+        ret = []
+        end = 0
+        for m in PACKRE.finditer(buf):
+            ret.append(str(m.group(0)))
+            end = m.end()
+        tail = buf.rfind(chr(SOH), end)
+        if tail < 0:
+            tail = len(buf)
+        del buf[0:tail]
+        return ret
+
+    def messages(self):
+        """Remove and return a list of unt4 objects for complete packets."""
+        return [unt4(unt4str=p) for p in self.packets()]
 
     def fetch(self):
         """Return next complete UNT4 packet or None at EOF."""
-        if self.state is EOT:
-            self.state = None
-            self.pack = ''
-            #self.pack = b''	# Python3
-        while True:
-            if self.bpos >= len(self.buf):
-                # does this need to be recv ?
-                self.buf = self.port.read(1024)
-                self.bpos = 0
-                if len(self.buf) is 0:
-                    break	# no more input -> indicates EOF
-
-            npos = self.buf.find(chr(SOH), self.bpos)
-            #npos = self.buf.find(bytes([SOH]), self.bpos)
-            fpos = self.buf.find(chr(EOT), self.bpos)
-            #fpos = self.buf.find(bytes([EOT]), self.bpos)
-            if npos < 0:     ## <SOH> not found in buf
-                if self.state == SOH:
-                    if fpos < 0:
-                        self.pack += self.buf[self.bpos:]
-                        self.bpos = len(self.buf)  # save all bytes in buf
-                    else:
-                        self.state = EOT
-                        self.pack += self.buf[self.bpos:fpos+1]
-                        self.bpos = fpos + 1  # save bytes to <EOT>
-                        break		      # finish packet and break out
-                else:
-                    self.bpos = len(self.buf) # discard to end of buf
-            elif fpos < 0:   ## <SOH> found, <EOT> not found in buf
-                self.state = SOH   # flip mode identifier
-                self.pack = chr(SOH)
-                #self.pack = bytes([SOH])
-                self.bpos = npos + 1  # advance to packet data
-            else:            ## <SOH> and <EOT> found in buf
-                if npos > fpos and self.state == SOH:
-                    self.state = EOT
-                    self.pack += self.buf[self.bpos:fpos+1]
-                    self.bpos = fpos + 1  # save bytes to <EOT>
-                    break		      # finish packet and break out
-                else:
-                    self.state = SOH   # flip mode identifier
-                    self.pack = chr(SOH)
-                    #self.pack = bytes([SOH])
-                    self.bpos = npos + 1  # advance to packet data
-        if self.state is EOT:
-            return self.pack
-        return None
+        while len(self.pending) == 0:
+            chunk = self.port.read(RDCHUNK)
+            if len(chunk) == 0:
+                return None	# no more input -> indicates EOF
+            self.feed(chunk)
+            self.pending.extend(self.packets())
+        return self.pending.popleft()
 
 # UNT4 Packet class
 class unt4(object):
@@ -186,7 +244,47 @@ class unt4(object):
             self.unpack(unt4str)
 
     def unpack(self, unt4str=''):
-        """Unpack the UNT4 string into this object."""
+        """Unpack the UNT4 string into this object.
+
+        Well formed packets with at most one leading position are
+        unpacked with one slice per field, anything else is walked
+        one character at a time.
+
+        """
+        if len(unt4str) > 2 and unt4str[0] == chr(SOH) \
+                            and unt4str[-1] == chr(EOT):
+            sx = unt4str.find(chr(STX))
+            if sx < 0:
+                head = unt4str[1:-1]
+                text = ''
+            else:
+                head = unt4str[1:sx]
+                text = unt4str[sx+1:-1]
+            dx = text.find(chr(DLE))
+            if (type(unt4str) is str and text.find(chr(STX)) < 0
+                  and (dx < 0 or (dx == 0 and len(text) >= 5
+                                  and text.find(chr(DLE), 1) < 0
+                                  and text[1:5].isdigit()))):
+                self.prefix = None
+                pi = max([head.rfind(c) for c in PREFIXCHARS])
+                if pi >= 0:	# last prefix in header is kept
+                    self.prefix = ord(head[pi])
+                    head = head.translate(None, PREFIXCHARS)
+                if dx == 0:
+                    self.xx = int(text[1:3])
+                    self.yy = int(text[3:5])
+                    text = text[5:]
+                self.erl = chr(ERL) in text
+                self.erp = chr(ERP) in text
+                if self.erl or self.erp:
+                    text = text.translate(None, chr(ERL) + chr(ERP))
+                self.header = head
+                self.text = text
+            else:
+                self.__unpackchars(unt4str)
+
+    def __unpackchars(self, unt4str=''):
+        """Unpack the UNT4 string one character at a time."""
         if len(unt4str) > 2 and unt4str[0] is chr(SOH) \
                             and unt4str[-1] is chr(EOT):
             self.prefix = None
@@ -232,22 +330,8 @@ class unt4(object):
 
     def pack(self):
         """Return UNT4 string packet."""
-        head = ''
-        text = ''
-        if self.erp:	# overrides any other message content
-            text = chr(STX) + chr(ERP)
-        else:
-            head = self.header
-            if self.prefix is not None:
-                head = chr(self.prefix) + head
-            if self.xx is not None and self.yy is not None:
-                text += chr(DLE) + '{0:02d}{1:02d}'.format(self.xx, self.yy)
-            text += self.text
-            if self.erl:
-                text += chr(ERL)
-            if len(text) > 0:
-                text = chr(STX) + text
-        return chr(SOH) + head + text + chr(EOT)
+        return packmsg(self.prefix, self.header, self.erp, self.erl,
+                       self.xx, self.yy, self.text)
 	## DANGER - Deliberately damage packets for testing.
         ##msg = chr(SOH) + head + text + chr(EOT)
         ##if random.randint(0,10) == 0:
@@ -277,3 +361,101 @@ OVERLAY_IMAGE = unt4(header='OVERLAY 13')
 OVERLAY_BLANK = unt4(header='OVERLAY 14')
 
 # Todo: Tests
+
+if __name__ == "__main__":
+    """Compare legacy and cached pack, and legacy and one pass encode."""
+    import random
+    import time
+
+    def oldpack(m):
+        """Return packet built as by the original pack method."""
+        head = ''
+        text = ''
+        if m.erp:
+            text = chr(STX) + chr(ERP)
+        else:
+            head = m.header
+            if m.prefix is not None:
+                head = chr(m.prefix) + head
+            if m.xx is not None and m.yy is not None:
+                text += chr(DLE) + '{0:02d}{1:02d}'.format(m.xx, m.yy)
+            text += m.text
+            if m.erl:
+                text += chr(ERL)
+            if len(text) > 0:
+                text = chr(STX) + text
+        return chr(SOH) + head + text + chr(EOT)
+
+    def oldencode(buf):
+        for key in ENCMAP:
+            buf = buf.replace(key, ENCMAP[key])
+        return buf
+
+    def olddecode(buf):
+        buf = buf.replace('<00>','')
+        for key in ENCMAP:
+            buf = buf.replace(ENCMAP[key], key)
+        return buf
+
+    # a scoreboard 'frame': 20 lines of which a few change each time
+    random.seed(1)
+    msgs = []
+    for i in range(20000):
+        yy = random.randint(0, 19)
+        if i % 3 == 0:
+            text = 'Rider {0:3d} {1:02d}.{2:03d}'.format(yy, i % 60, i % 1000)
+        else:
+            text = 'Rider {0:3d} Standing Line'.format(yy)
+        msgs.append(unt4(xx=0, yy=yy, text=text, erl=(i % 7 == 0)))
+    msgs.extend([OVERLAY_T1P5, GENERAL_CLEARING,
+                 unt4(header='rider', prefix=DC3,
+                      text=chr(US).join(['1', 'Name', 'Club']))])
+    for m in msgs:
+        assert m.pack() == oldpack(m)
+        assert encode(m.pack()) == oldencode(m.pack())
+        assert decode(encode(m.pack())) == olddecode(oldencode(m.pack()))
+
+    count = len(msgs)
+    for (label, fn) in (('old pack', oldpack), ('new pack', unt4.pack)):
+        st = time.time()
+        for m in msgs:
+            fn(m)
+        print('{0}: {1:6.2f} us/msg'.format(label,
+                                    1e6 * (time.time() - st) / count))
+    packs = [m.pack() for m in msgs]
+    for (label, fn) in (('old encode', oldencode), ('new encode', encode)):
+        st = time.time()
+        for p in packs:
+            fn(p)
+        print('{0}: {1:6.2f} us/msg'.format(label,
+                                    1e6 * (time.time() - st) / count))
+    encs = [encode(p) for p in packs]
+    for (label, fn) in (('old decode', olddecode), ('new decode', decode)):
+        st = time.time()
+        for e in encs:
+            fn(e)
+        print('{0}: {1:6.2f} us/msg'.format(label,
+                                    1e6 * (time.time() - st) / count))
+
+    # stream decoder throughput on a synthetic capture
+    import StringIO
+    capture = ''.join(packs * 8)
+    for chunk in (64, 1500, RDCHUNK):
+        ub = unt4buf()
+        cnt = 0
+        st = time.time()
+        for i in range(0, len(capture), chunk):
+            ub.feed(capture[i:i+chunk])
+            cnt += len(ub.messages())
+        et = time.time() - st
+        assert cnt == len(packs) * 8
+        print('stream {0:4d} byte chunks: {1:6.2f} MB/s, {2:7.0f} msg/s'
+                .format(chunk, len(capture) / et / 1e6, cnt / et))
+    ub = unt4buf(StringIO.StringIO(capture))
+    cnt = 0
+    st = time.time()
+    while ub.fetch() is not None:
+        cnt += 1
+    et = time.time() - st
+    print('fetch packets: {0:6.2f} MB/s, {1:7.0f} pkt/s'.format(
+                  len(capture) / et / 1e6, cnt / et))
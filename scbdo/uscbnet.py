@@ -0,0 +1,598 @@
+# SCBdo : DISC Track Racing Management Software
+# Copyright (C) 2010  Nathan Fraser
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""uSCBsrv socket transport and relay server.
+
+This module provides a plain socket alternative to the irc server
+for the live announce stream. The class 'netirc' stands in for the
+irclib server connection used by uscbsrv and the announce clients,
+and the thread object 'relay' is a small publish/subscribe server
+which forwards the stream from one uSCBsrv publisher to any number
+of announce subscribers.
+
+All messages are framed with a 9 byte header:
+
+	kind	1 byte	H: hello, D: data, S: snapshot,
+			I: ping, O: pong
+	seq	4 bytes	data sequence number, network order
+	length	4 bytes	payload length, network order
+
+Payloads carry the same irc encoded UNT4 text as a channel message.
+The relay numbers each data frame and keeps the latest state of the
+stream in a uscbsrv relay queue. A subscriber is sent a snapshot of
+that state when it joins, followed by the live data frames. When a
+multicast group is configured the relay also sends each data frame
+to the group and multicast subscribers take only the snapshot over
+TCP. A subscriber which sees a gap in the sequence numbers asks for
+a new snapshot.
+
+Running this module or bin/uscb_relay starts a relay server:
+
+	uscb_relay [port [group:port]]
+
+"""
+
+import threading
+import logging
+import socket
+import select
+import struct
+import errno
+import time
+
+from scbdo import unt4
+from scbdo import uscbsrv
+
+# Global Defaults
+NET_PORT = uscbsrv.USCBSRV_RELAYPORT
+NET_LINELEN = 80	# announce line length used to key full line writes
+MCAST_TTL = 1
+
+# Frame header
+FRAMEHDR = struct.Struct('!cII')
+HELLO = 'H'
+DATA = 'D'
+SNAPSHOT = 'S'
+PING = 'I'
+PONG = 'O'
+
+# Socket read size, connect timeout and relay poll interval
+RDBUFLEN = 65536
+CONNECT_TIMEOUT = 5.0
+RELAY_POLL = 0.5
+
+# Unsent bytes allowed for a subscriber before it is dropped
+RELAY_BACKLOG = 262144
+
+def frame(kind, seq=0, payload=''):
+    """Return a framed message."""
+    return FRAMEHDR.pack(kind, seq, len(payload)) + payload
+
+def nm_to_n(source):
+    """Return the nick part of a nick!user@host source string."""
+    return source.split('!', 1)[0]
+
+def mkmcast(group):
+    """Return an (addr, port) tuple for the group string addr:port."""
+    ar = group.split(':')
+    port = NET_PORT + 1
+    if len(ar) > 1 and ar[1].isdigit():
+        port = int(ar[1])
+    return (ar[0], port)
+
+class framebuf(object):
+    """Frame stream decoder."""
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, chunk=''):
+        """Append chunk to the input buffer."""
+        self.buf.extend(chunk)
+
+    def frames(self):
+        """Remove and return a list of (kind, seq, payload) frames."""
+        ret = []
+        buf = self.buf
+        oft = 0
+        hl = FRAMEHDR.size
+        while len(buf) - oft >= hl:
+            (kind, seq, plen) = FRAMEHDR.unpack_from(buffer(buf), oft)
+            if len(buf) - oft - hl < plen:
+                break
+            ret.append((kind, seq, str(buf[oft+hl:oft+hl+plen])))
+            oft += hl + plen
+        del buf[0:oft]
+        return ret
+
+class event(object):
+    """An irclib style event passed to transport handlers."""
+    def __init__(self, eventtype, source, target, arguments):
+        self._eventtype = eventtype
+        self._source = source
+        self._target = target
+        self._arguments = arguments
+
+    def eventtype(self):
+        return self._eventtype
+
+    def source(self):
+        return self._source
+
+    def target(self):
+        return self._target
+
+    def arguments(self):
+        return self._arguments
+
+class netirc(object):
+    """Socket transport with the irclib methods used by SCBdo.
+
+    role is 'pub' for the uSCBsrv side and 'sub' for an announce
+    client. If mcast is an (addr, port) tuple, a subscriber receives
+    data frames from that multicast group.
+
+    Handlers are called for the irclib events 'welcome', 'join',
+    'pubmsg', 'pong' and 'disconnect'.
+
+    """
+    def __init__(self, role='sub', mcast=None):
+        self.role = role
+        self.mcast = mcast
+        self.sock = None
+        self.msock = None
+        self.rdbuf = framebuf()
+        self.handlers = {}
+        self.host = None
+        self.nick = ''
+        self.channel = ''
+        self.srvnick = ''
+        self.seq = None		# last data sequence, None until snapshot
+        self.gaps = 0		# count of sequence gaps detected
+        self.log = logging.getLogger('scbdo.uscbnet')
+
+    def server(self):
+        return self
+
+    def add_global_handler(self, sig=None, cb=None, arg=None, data=None):
+        """Register the event handler cb for sig."""
+        self.handlers.setdefault(sig, []).append(cb)
+
+    def dispatch(self, etype, source, target, arguments=[]):
+        """Call all the handlers for event type etype."""
+        e = event(etype, source, target, arguments)
+        for cb in self.handlers.get(etype, []):
+            cb(self, e)
+
+    def connect(self, host=None, port=None, nick=None, data=None):
+        """Connect to the relay server at host:port."""
+        self.close()
+        self.host = host
+        self.nick = nick
+        self.seq = None
+        self.rdbuf = framebuf()
+        self.sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.mcast is not None and self.role == 'sub':
+            self.msock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.msock.setsockopt(socket.SOL_SOCKET,
+                                  socket.SO_REUSEADDR, 1)
+            self.msock.bind(('', self.mcast[1]))
+            mreq = struct.pack('4sl', socket.inet_aton(self.mcast[0]),
+                               socket.INADDR_ANY)
+            self.msock.setsockopt(socket.IPPROTO_IP,
+                                  socket.IP_ADD_MEMBERSHIP, mreq)
+        self.dispatch('welcome', host, nick)
+
+    def is_connected(self):
+        return self.sock is not None
+
+    def send(self, kind, payload=''):
+        """Write a frame to the relay server."""
+        if self.sock is None:
+            raise IOError('Not connected to relay.')
+        self.sock.sendall(frame(kind, 0, payload))
+
+    def join(self, chan=None, data=None):
+        """Subscribe or publish to the named channel."""
+        self.channel = chan
+        mode = self.role
+        if self.msock is not None:
+            mode = 'mcast'
+        self.send(HELLO, ' '.join([mode, chan, self.nick]))
+
+    def privmsg(self, chan=None, msg=None, data=None):
+        """Publish the encoded text msg."""
+        self.send(DATA, msg)
+
+    def ping(self, target=None, target2=None, data=None):
+        """Send a ping to the relay server."""
+        self.send(PING, target)
+
+    def resync(self):
+        """Discard stream position and request a new snapshot."""
+        self.seq = None
+        self.join(self.channel)
+
+    def process_once(self, timeout=0):
+        """Wait up to timeout for frames and dispatch them."""
+        if self.sock is None:
+            if timeout:
+                time.sleep(timeout)
+            return
+        socks = [self.sock]
+        if self.msock is not None:
+            socks.append(self.msock)
+        try:
+            (rl, wl, xl) = select.select(socks, [], [], timeout)
+            if self.msock in rl:
+                mb = framebuf()
+                mb.feed(self.msock.recv(RDBUFLEN))
+                for f in mb.frames():
+                    self.frame(f)
+            if self.sock in rl:
+                buf = self.sock.recv(RDBUFLEN)
+                if buf == '':
+                    raise IOError('Relay closed connection.')
+                self.rdbuf.feed(buf)
+                for f in self.rdbuf.frames():
+                    self.frame(f)
+        except (socket.error, IOError) as e:
+            self.log.debug('Relay connection error: ' + str(e))
+            self.disconnect()
+
+    def frame(self, f):
+        """Handle a single frame from the relay."""
+        (kind, seq, payload) = f
+        if kind == DATA:
+            if self.seq is None or seq <= self.seq:
+                return		# awaiting snapshot or duplicate
+            if seq != self.seq + 1:
+                self.gaps += 1
+                self.log.debug('Sequence gap ' + str(self.seq)
+                                  + ' -> ' + str(seq))
+                self.resync()
+                return
+            self.seq = seq
+            self.dispatch('pubmsg', self.srvnick, self.channel, [payload])
+        elif kind == SNAPSHOT:
+            self.seq = seq
+            self.dispatch('pubmsg', self.srvnick, self.channel, [payload])
+        elif kind == HELLO:
+            ar = payload.split()
+            if len(ar) > 1:
+                self.srvnick = ar[1]
+            source = self.nick + '!' + self.nick + '@' + str(self.host)
+            self.dispatch('join', source, self.channel)
+        elif kind == PONG:
+            self.dispatch('pong', self.host, self.host, [payload])
+
+    def disconnect(self, msg=None, data=None):
+        """Close the connection and signal a disconnect event."""
+        if self.sock is not None:
+            self.close()
+            self.dispatch('disconnect', self.host, self.nick)
+
+    def close(self, data=None):
+        """Close the relay sockets."""
+        for s in (self.sock, self.msock):
+            if s is not None:
+                try:
+                    s.close()
+                except:
+                    pass
+        self.sock = None
+        self.msock = None
+
+    def ctcp(self, cmd=None, nick=None, ts=None, data=None):
+        pass
+
+    def oper(self, user=None, pword=None, data=None):
+        pass
+
+    def mode(self, chan=None, mode=None, data=None):
+        pass
+
+    def topic(self, chan=None, topic=None, data=None):
+        pass
+
+class relayclient(object):
+    """Relay server connection state."""
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rdbuf = framebuf()
+        self.out = bytearray()
+        self.mode = None	# 'pub', 'sub' or 'mcast' after hello
+        self.nick = ''
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class relay(threading.Thread):
+    """uSCBsrv relay server thread.
+
+    Data frames from publishers are numbered, applied to the relay
+    state and forwarded to every subscriber. Subscribers which fall
+    more than RELAY_BACKLOG bytes behind are dropped and will receive
+    a fresh snapshot when they reconnect.
+
+    """
+    def __init__(self, addr=('', NET_PORT), mcast=None,
+                       linelen=NET_LINELEN):
+        """Constructor.
+
+        Parameters:
+
+          addr -- (host, port) to listen on, port 0 picks a free port
+          mcast -- optional (group, port) for multicast data frames
+          linelen -- announce line length
+
+        """
+        threading.Thread.__init__(self)
+        self.name = 'uSCBrelay'
+        self.daemon = True
+        self.running = False
+        self.linelen = linelen
+        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.lsock.bind(addr)
+        self.lsock.listen(5)
+        self.addr = self.lsock.getsockname()
+        self.mcast = mcast
+        self.msock = None
+        if mcast is not None:
+            self.msock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.msock.setsockopt(socket.IPPROTO_IP,
+                                  socket.IP_MULTICAST_TTL, MCAST_TTL)
+        self.clients = []
+        self.state = uscbsrv.relayq()
+        self.ubuf = unt4.unt4buf()
+        self.seq = 0
+        self.pubnick = ''
+        self.framesin = 0
+        self.framesout = 0
+        self.log = logging.getLogger('scbdo.uscbnet')
+        self.log.setLevel(logging.DEBUG)
+
+    def exit(self, msg=None):
+        """Request thread termination."""
+        self.running = False
+
+    def snapshot(self):
+        """Return a snapshot frame of the current stream state.
+
+        The state keeps the latest race start and overlay across
+        screen clears, see uscbsrv.CLEARKEEP.
+
+        """
+        text = unt4.encode(unt4.GENERAL_CLEARING.pack())
+        return frame(SNAPSHOT, self.seq, text + self.state.snapshot())
+
+    def hello(self, c, payload):
+        """Register a client hello."""
+        ar = payload.split()
+        c.mode = 'sub'
+        if len(ar) > 0 and ar[0] in ('pub', 'sub', 'mcast'):
+            c.mode = ar[0]
+        if len(ar) > 2:
+            c.nick = ar[2]
+        if c.mode == 'pub':
+            self.pubnick = c.nick
+            self.log.debug('Publisher ' + repr(c.nick) + ' from '
+                             + str(c.addr))
+        ack = frame(HELLO, self.seq, ' '.join([c.mode, self.pubnick
+                                                           or '-']))
+        c.out.extend(ack)
+        if c.mode != 'pub':
+            c.out.extend(self.snapshot())
+
+    def publish(self, payload):
+        """Number, store and forward the published text payload."""
+        self.seq += 1
+        self.ubuf.feed(unt4.decode(payload))
+        for p in self.ubuf.packets():
+            self.state.add(p, uscbsrv.msgkey(unt4.unt4(unt4str=p),
+                                             self.linelen))
+        f = frame(DATA, self.seq, payload)
+        for c in self.clients:
+            if c.mode == 'sub':
+                c.out.extend(f)
+                self.framesout += 1
+        if self.msock is not None:
+            self.msock.sendto(f, self.mcast)
+            self.framesout += 1
+
+    def read(self, c):
+        """Read and handle frames from client c."""
+        buf = c.sock.recv(RDBUFLEN)
+        if buf == '':
+            raise IOError('Connection closed.')
+        c.rdbuf.feed(buf)
+        for (kind, seq, payload) in c.rdbuf.frames():
+            self.framesin += 1
+            if kind == DATA and c.mode == 'pub':
+                self.publish(payload)
+            elif kind == HELLO:
+                self.hello(c, payload)
+            elif kind == PING:
+                c.out.extend(frame(PONG, 0, payload))
+
+    def write(self, c):
+        """Write pending output to client c."""
+        try:
+            cnt = c.sock.send(c.out)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        del c.out[0:cnt]
+
+    def drop(self, c, reason=''):
+        """Close and forget client c."""
+        self.log.debug('Client ' + str(c.addr) + ' closed: ' + str(reason))
+        try:
+            c.sock.close()
+        except:
+            pass
+        if c in self.clients:
+            self.clients.remove(c)
+
+    def run(self):
+        """Called via threading.Thread.start()."""
+        self.running = True
+        self.log.debug('Listening on ' + str(self.addr))
+        while self.running:
+            try:
+                wl = [c for c in self.clients if len(c.out) > 0]
+                (rl, wl, xl) = select.select([self.lsock] + self.clients,
+                                             wl, [], RELAY_POLL)
+                if self.lsock in rl:
+                    (s, a) = self.lsock.accept()
+                    s.setblocking(0)
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.clients.append(relayclient(s, a))
+                for c in rl:
+                    if c is not self.lsock:
+                        try:
+                            self.read(c)
+                        except (socket.error, IOError) as e:
+                            self.drop(c, e)
+                for c in self.clients:
+                    if len(c.out) > 0:
+                        try:
+                            self.write(c)
+                        except (socket.error, IOError) as e:
+                            self.drop(c, e)
+                            continue
+                        if len(c.out) > RELAY_BACKLOG:
+                            self.drop(c, 'backlog')
+            except Exception as e:
+                self.log.error('Exception: ' + str(type(e)) + str(e))
+        for c in list(self.clients):
+            self.drop(c, 'exit')
+        self.lsock.close()
+        self.log.info('Exiting')
+
+def main():
+    """Run a relay server from the command line."""
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    addr = ('', NET_PORT)
+    mcast = None
+    if len(sys.argv) > 1:
+        addr = ('', int(sys.argv[1]))
+    if len(sys.argv) > 2:
+        mcast = mkmcast(sys.argv[2])
+    r = relay(addr, mcast)
+    r.start()
+    try:
+        while r.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        r.exit()
+        r.join()
+
+if __name__ == '__main__':
+    import sys
+
+    # Relay throughput and latency with several subscribers
+    if len(sys.argv) == 2 and sys.argv[1] == '-b':
+        count = 5000
+        paced = 200
+        nsub = 4
+        r = relay(('localhost', 0))
+        r.start()
+        (host, port) = r.addr
+
+        def subscriber(res, stop):
+            """Count messages and sum latency of paced title messages."""
+            ub = unt4.unt4buf()
+            s = netirc('sub')
+            def msg_cb(c, e):
+                ub.feed(unt4.decode(e.arguments()[0]))
+                now = time.time()
+                for p in ub.packets():
+                    m = unt4.unt4(unt4str=p)
+                    if m.header == 'time':
+                        res[0] += 1
+                    elif m.header == 'title':
+                        res[1] += now - float(m.text)
+            s.add_global_handler('pubmsg', msg_cb)
+            s.connect(host, port, 'sub')
+            s.join('#announce')
+            while not stop:
+                s.process_once(0.05)
+            res.append(s.gaps)
+            s.close()
+
+        subs = []
+        stop = []
+        for i in range(nsub):
+            res = [0, 0.0]
+            t = threading.Thread(target=subscriber, args=(res, stop))
+            t.start()
+            subs.append((t, res))
+        pub = netirc('pub')
+        pub.connect(host, port, 'uSCBsrv')
+        pub.join('#announce')
+        time.sleep(0.2)
+        st = time.time()
+        for i in range(count):
+            m = unt4.unt4(header='time', text=repr(time.time()))
+            pub.privmsg('#announce', unt4.encode(m.pack()))
+        while (min([res[0] for (t, res) in subs]) < count
+               and time.time() - st < 30):
+            time.sleep(0.01)
+        et = time.time() - st
+        start = unt4.unt4(header='start', text='10:00:00.0000')
+        pub.privmsg('#announce', unt4.encode(start.pack()))
+        pub.privmsg('#announce', unt4.encode(unt4.GENERAL_CLEARING.pack()))
+        for i in range(paced):
+            m = unt4.unt4(header='title', text=repr(time.time()))
+            pub.privmsg('#announce', unt4.encode(m.pack()))
+            time.sleep(0.002)
+        time.sleep(0.2)
+
+        # a late subscriber is sent the current state on join
+        late = []
+        s = netirc('sub')
+        s.add_global_handler('pubmsg', lambda c, e: late.append(
+                                                    e.arguments()[0]))
+        s.connect(host, port, 'late')
+        s.join('#announce')
+        while len(late) == 0:
+            s.process_once(0.1)
+        s.close()
+        stop.append(True)
+        for (t, res) in subs:
+            t.join()
+        r.exit()
+        r.join()
+        b = unt4.unt4buf()
+        b.feed(unt4.decode(late[0]))
+        lp = [unt4.unt4(unt4str=p) for p in b.packets()]
+        assert lp[-1].text == m.text
+        assert start.text in [p.text for p in lp if p.header == 'start']
+        for (t, res) in subs:
+            assert res[0] == count and res[2] == 0
+        lat = sum([res[1] for (t, res) in subs]) / (nsub * paced)
+        print('Messages: {0:6d}, subscribers: {1:2d}'.format(count, nsub))
+        print('  {0:8.0f} msg/s, mean latency {1:0.3f} ms'.format(
+                  count / et, 1000.0 * lat))
+        sys.exit(0)
+
+    main()
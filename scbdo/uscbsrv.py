@@ -21,8 +21,16 @@ This module provides a thread object which maintains a persistent
 uSCBsrv server connection to the configured irc server. Announce
 messages are broadcast to the announcer.
 
-Live announce messages are stored in a Queue object and written out
-to the irc server using blocking I/O.
+The connection is made either to an irc server through irclib, or
+to a uSCBsrv relay server with the socket transport in uscbnet when
+the port string is prefixed with 'relay:'.
+
+Live announce messages are stored in a Queue object and collected
+by the thread into a relay queue which keeps only the newest title,
+time, start, overlay and line content while preserving the order of
+rider appends. Pending packets are packed several to a line and
+written out to the irc server using blocking I/O, paced by the
+measured server lag.
 
 TODO: IRC connect and error handling is VERY messy - some more
       thought is required to cleanly handle all init and error
@@ -36,6 +44,7 @@ import logging
 import socket
 import random
 import time
+import collections
 
 from scbdo import unt4
 from scbdo import tod
@@ -46,16 +55,50 @@ USCBSRV_HOST=''		# default is "not present"
 USCBSRV_PORT=6667
 USCBSRV_CHANNEL='#announce'
 USCBSRV_SRVNICK='uSCBsrv'
+USCBSRV_RELAYPORT=6668
+USCBSRV_TRANSPORT='irc'
 
 # dispatch thread queue commands
 TCMDS = ('EXIT', 'PORT', 'MSG')
 
+# Longest encoded packet text sent in a single irc message
+IRC_LINELEN = 450
+
+# Pacing limits in seconds between irc messages
+PACE_MIN = 0.0
+PACE_MAX = 1.5
+PACE_STEP = 0.1		# additive decrease once the server keeps up
+
+# Server lag thresholds in seconds, measured by PING/PONG
+LAG_LOW = 0.3
+LAG_HIGH = 1.0
+LAG_PROBE = 2.0		# ping interval while sending
+LAG_POLL = 0.05		# irc poll interval while a probe is outstanding
+
+# Longest wait on the queue when idle, irc events are polled between
+IRC_POLL = 0.5
+
+# Headers which replace any earlier unsent message with the same header
+SUPERSEDE = ('title', 'time', 'start')
+
+# Relay keys kept across a screen clear, the client keeps their state
+CLEARKEEP = ('start', 'O')
+
+# Superseded relay queue entries allowed before the queue is compacted
+RELAY_COMPACT = 256
+
 
 def parse_portstr(portstr=''):
-    """Read a port string and split into defaults."""
+    """Read a port string and split into defaults.
+
+    Port strings have the form [nick@][relay:]host[:port] and are
+    returned as a tuple (host, port, nick, transport).
+
+    """
     port = USCBSRV_PORT
     host = ''
     nick = USCBSRV_SRVNICK
+    transport = USCBSRV_TRANSPORT
 
     # strip off nickname
     ar = portstr.rsplit('@', 1)
@@ -65,6 +108,12 @@ def parse_portstr(portstr=''):
     else:
         portstr = ar[0]
 
+    # strip off transport
+    if portstr.lower().startswith('relay:'):
+        transport = 'relay'
+        port = USCBSRV_RELAYPORT
+        portstr = portstr[6:]
+
     # read host:port
     ar = portstr.split(':')
     if len(ar) > 1:
@@ -74,7 +123,164 @@ def parse_portstr(portstr=''):
     else:
         host = ar[0]
 
-    return (host, port, nick)
+    return (host, port, nick, transport)
+
+def msgkey(msg, linelen):
+    """Return the relay queue key for the unt4 message msg.
+
+    Keys are:
+
+      'C' -- clears the announce screen
+      'R' -- ordered rider append
+      'O' -- overlay selection
+      header -- one of SUPERSEDE
+      ('L', yy) -- full content of line yy
+      ('P', yy) -- partial write to line yy
+      None -- raw message, always sent in order
+
+    """
+    if msg.erp:
+        return 'C'
+    elif msg.header == 'rider':
+        return 'R'
+    elif msg.header in SUPERSEDE:
+        return msg.header
+    elif msg.header.startswith('OVERLAY'):
+        return 'O'
+    elif msg.yy is not None:
+        if msg.xx == 0 and (msg.erl or len(msg.text) >= linelen):
+            return ('L', msg.yy)
+        return ('P', msg.yy)
+    return None
+
+def ircsplit(ebuf, limit=IRC_LINELEN):
+    """Return an offset <= limit to split ebuf without breaking escapes."""
+    cut = min(limit, len(ebuf))
+    for b in (1, 2):
+        m = unt4.DECRE.match(ebuf, cut - b)
+        if m is not None and m.end() > cut:
+            return cut - b
+    return cut
+
+class relayq(object):
+    """Coalescing queue of packed announce messages.
+
+    Messages are appended with add() and taken out as encoded irc
+    message text by line(). A message with a keyed value replaces the
+    unsent message with the same key in place, a full line write
+    drops unsent partial writes to that line and a screen clear drops
+    every unsent message before it except raw messages, the race start
+    and the overlay. Rider appends are never coalesced.
+
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Discard all pending messages."""
+        self.pend = collections.deque()	# [key, encoded buf]
+        self.keyed = {}			# key -> pending entry
+        self.partial = {}		# line -> list of partial entries
+        self.count = 0			# live entries
+        self.added = 0
+        self.dropped = 0
+        self.head = ''			# remainder of a split message
+
+    def __len__(self):
+        return self.count
+
+    def pending(self):
+        """Return True if there is text waiting to be sent."""
+        return self.count > 0 or self.head != ''
+
+    def kill(self, ent):
+        """Mark entry ent as superseded."""
+        if ent[1] is not None:
+            ent[1] = None
+            self.count -= 1
+            self.dropped += 1
+
+    def compact(self):
+        """Remove superseded entries from the pending queue."""
+        self.pend = collections.deque([e for e in self.pend
+                                             if e[1] is not None])
+
+    def snapshot(self):
+        """Return all pending message text without removing it."""
+        return self.head + ''.join([e[1] for e in self.pend
+                                           if e[1] is not None])
+
+    def add(self, buf, key=None):
+        """Add the packed message buf with relay key key."""
+        self.added += 1
+        if len(self.pend) > self.count + RELAY_COMPACT:
+            self.compact()
+        ebuf = unt4.encode(buf)
+        if key == 'C':
+            for ent in self.pend:
+                if ent[0] is not None and ent[0] not in CLEARKEEP:
+                    self.kill(ent)
+            self.keyed = dict([(k, e) for (k, e) in self.keyed.iteritems()
+                                 if k in CLEARKEEP])
+            self.partial = {}
+        elif key is not None and key != 'R':
+            if key[0] == 'L':
+                for ent in self.partial.pop(key[1], []):
+                    self.kill(ent)
+            elif key[0] == 'P':
+                ent = [key, ebuf]
+                self.partial.setdefault(key[1], []).append(ent)
+                self.pend.append(ent)
+                self.count += 1
+                return
+            ent = self.keyed.get(key)
+            if ent is not None and ent[1] is not None:
+                ent[1] = ebuf	# replace value, keep queue position
+                self.dropped += 1
+                return
+            ent = [key, ebuf]
+            self.keyed[key] = ent
+            self.pend.append(ent)
+            self.count += 1
+            return
+        self.pend.append([key, ebuf])
+        self.count += 1
+
+    def line(self, limit=IRC_LINELEN):
+        """Remove and return up to limit chars of pending message text."""
+        ret = []
+        rlen = 0
+        if self.head != '':
+            cut = ircsplit(self.head, limit)
+            ret.append(self.head[0:cut])
+            rlen = cut
+            self.head = self.head[cut:]
+        while self.count > 0 and self.head == '':
+            ent = self.pend[0]
+            ebuf = ent[1]
+            if ebuf is not None:
+                if rlen + len(ebuf) > limit:
+                    if rlen > 0:
+                        break		# send with the next line
+                    # message too long for one line, send in pieces
+                    cut = ircsplit(ebuf, limit)
+                    self.head = ebuf[cut:]
+                    ebuf = ebuf[0:cut]
+                ret.append(ebuf)
+                rlen += len(ebuf)
+                self.count -= 1
+            self.pend.popleft()
+            k = ent[0]
+            if k is not None and k != 'R':
+                if k[0] == 'P':
+                    pl = self.partial.get(k[1])
+                    if pl and pl[0] is ent:
+                        del pl[0]
+                elif self.keyed.get(k) is ent:
+                    del self.keyed[k]
+        if self.count == 0 and self.head == '':
+            self.pend.clear()
+        return ''.join(ret)
 
 class uscbsrv(threading.Thread):
     """uSCBsrv server thread.
@@ -148,11 +354,12 @@ class uscbsrv(threading.Thread):
 
     def sendmsg(self, unt4msg=None):
         """Pack and send a unt4 message to the live announce stream."""
-        self.queue.put_nowait(('MSG', unt4msg.pack()))
+        self.queue.put_nowait(('MSG', unt4msg.pack(),
+                               msgkey(unt4msg, self.linelen)))
 
     def write(self, msg=None):
         """Send the provided raw text msg to the live announce stream."""
-        self.queue.put_nowait(('MSG', msg))
+        self.queue.put_nowait(('MSG', msg, None))
 
     def exit(self, msg=None):
         """Request thread termination."""
@@ -193,6 +400,17 @@ class uscbsrv(threading.Thread):
             self.chanstatus = False
             self.log.debug('Left channel ' + str(e.target()))
 
+    def pong_cb(self, c, e):
+        """Measure server lag from the reply to a lag probe."""
+        if self.pingsent is not None:
+            args = e.arguments()
+            token = e.target()
+            if len(args) > 0:
+                token = args[-1]
+            if token == self.pingtoken:
+                self._pacing(time.time() - self.pingsent)
+                self.pingsent = None
+
     def privmsg_cb(self, c, e):
         """Handle private message."""
 ####
@@ -206,16 +424,19 @@ class uscbsrv(threading.Thread):
         """Constructor."""
         threading.Thread.__init__(self) 
         self.running = False
-        self._curpace = 0.1
+        self._curpace = PACE_MIN
         self.il = None
-
-        try:
-            import irclib
-            self.ih = irclib.IRC()
-            self.il = irclib
-        except ImportError:
-            self.ih = fakeirc()
-        self.ic = self.ih.server()
+        self.relay = relayq()
+        self.nextsend = 0.0	# earliest time for next irc message
+        self.lag = 0.0		# last measured server lag
+        self.pingsent = None	# time of the outstanding lag probe
+        self.pingtoken = None
+        self.nextprobe = 0.0
+        self.linesent = 0
+
+        self.transport = USCBSRV_TRANSPORT
+        self.curtransport = None
+        self._mktransport()
 
         self.np = tod.tod('now')+tod.tod('30')	# self ping timeeout
 
@@ -240,12 +461,15 @@ class uscbsrv(threading.Thread):
 
     def set_portstr(self, portstr='', channel='#announce'):
         """Set irc connection by a port string."""
-        (host, port, nick) = parse_portstr(portstr)
-        self.set_port(host, port, channel, nick)
+        (host, port, nick, transport) = parse_portstr(portstr)
+        self.set_port(host, port, channel, nick, transport=transport)
 
     def set_port(self, host=None, port=None, channel=None,
-                       srvnick=None, reconnect=False):
+                       srvnick=None, reconnect=False, transport=None):
         """Request change in irc connection."""
+        if transport is not None and transport != self.transport:
+            self.transport = transport
+            reconnect = True
         if host is not None and host != self.host:
             self.host = host
             if self.host == '' and self.ic.is_connected():
@@ -275,6 +499,32 @@ class uscbsrv(threading.Thread):
         """Return true if connected and in channel."""
         return self.ic.is_connected() and self.chanstatus
 
+    def _mktransport(self):
+        """Create the connection object for the selected transport."""
+        if self.curtransport is not None:
+            self.ic.close()
+        self.il = None
+        if self.transport == 'relay':
+            from scbdo import uscbnet
+            self.ih = uscbnet.netirc('pub')
+            self.il = uscbnet
+        else:
+            try:
+                import irclib
+                self.ih = irclib.IRC()
+                self.il = irclib
+            except ImportError:
+                self.ih = fakeirc()
+        self.ic = self.ih.server()
+        self.ic.add_global_handler('privmsg', self.privmsg_cb, -10)
+        self.ic.add_global_handler('join', self.channel_join_cb, -10)
+        self.ic.add_global_handler('part', self.channel_part_cb, -10)
+        self.ic.add_global_handler('kick', self.channel_part_cb, -10)
+        self.ic.add_global_handler('pong', self.pong_cb, -10)
+        ##self.ic.add_global_handler('all_events', self.irc_event_cb, 0)
+        self.curtransport = self.transport
+        self.chanstatus = False
+
     def _reconnect(self):
         if not self.connect_pending:
             self.connect_pending = True
@@ -284,34 +534,60 @@ class uscbsrv(threading.Thread):
             self.ic.mode(self.channel, '+tn')
             self.ic.topic(self.channel, 'uSCBsrv Live Result Feed')
 
-    def _pacing(self, delay=None):
-        """Adjust internal pacing delay."""
-        if delay is None:
-            self._curpace += 0.1
-            if self._curpace > 1.5:
-                self._curpace = 1.5
-        else:
-            self._curpace = delay
+    def _pacing(self, lag=None):
+        """Adjust pacing delay from a measured server lag.
+
+        The delay is doubled while the server lags by more than
+        LAG_HIGH and reduced by PACE_STEP once it is back under
+        LAG_LOW. With no argument the current delay is returned.
+
+        """
+        if lag is not None:
+            self.lag = lag
+            if lag > LAG_HIGH:
+                self._curpace = min(max(2.0 * self._curpace, PACE_STEP),
+                                    PACE_MAX)
+            elif lag < LAG_LOW:
+                self._curpace = max(self._curpace - PACE_STEP, PACE_MIN)
         return self._curpace
 
+    def _probe(self, now):
+        """Send a lag probe if none is outstanding."""
+        if self.pingsent is None or now - self.pingsent > PACE_MAX * 4:
+            if self.pingsent is not None:
+                self._pacing(now - self.pingsent)	# lost or very late
+            self.pingtoken = 'scbdo' + str(int(now * 1000))
+            self.pingsent = now
+            self.ic.ping(self.pingtoken)
+        self.nextprobe = now + LAG_PROBE
+
+    def _relay(self):
+        """Write one irc message of pending announce text if due."""
+        now = time.time()
+        if self.relay.pending() and now >= self.nextsend:
+            self.ic.privmsg(self.channel, self.relay.line())
+            self.linesent += 1
+            self.nextsend = now + self._curpace
+            if now >= self.nextprobe:
+                self._probe(now)
+
     def run(self):
         """Called via threading.Thread.start()."""
         self.running = True
         self.log.debug('Starting')
-        self.ic.add_global_handler('privmsg', self.privmsg_cb, -10)
-        self.ic.add_global_handler('join', self.channel_join_cb, -10)
-        self.ic.add_global_handler('part', self.channel_part_cb, -10)
-        self.ic.add_global_handler('kick', self.channel_part_cb, -10)
-        ##self.ic.add_global_handler('all_events', self.irc_event_cb, 0)
         while self.running:
             try:
                 self.ih.process_once(0)
                 if self.host != '':
                     # irc process phase
+                    if self.transport != self.curtransport:
+                        self._mktransport()
+                        self.connect_pending = False
                     if not self.connected() or self.doreconnect:
                         self.doreconnect = False
                         if not self.connect_pending:
                             self.chanstatus = False
+                            self.relay.clear()
                             self._reconnect()    
 
                     # keepalive ping
@@ -323,23 +599,28 @@ class uscbsrv(threading.Thread):
                 else:
                     time.sleep(5)
 
-                # queue process phase - queue empty exception breaks loop
+                # queue process phase - wait for messages or next send
+                wait = IRC_POLL
+                if self.relay.pending() and self.connected():
+                    wait = max(self.nextsend - time.time(), 0.0)
+                if self.pingsent is not None:
+                    wait = min(wait, LAG_POLL)
+                m = self.queue.get(wait > 0, wait)
                 while True:
-                    m = self.queue.get_nowait()
                     self.queue.task_done()
                     if m[0] == 'MSG' and self.host != '':
-                        ## TODO : split message > 450 ?
-                        self.ic.privmsg(self.channel, unt4.encode(m[1]))
+                        self.relay.add(m[1], m[2])
                     elif m[0] == 'EXIT':
                         self.log.debug('Request to close : ' + str(m[1]))
                         self.running = False
                     elif m[0] == 'PORT':
                         if not self.connect_pending:
                             self.doreconnect = True
-                    self._pacing(0.0)
+                    m = self.queue.get_nowait()
 
             except Queue.Empty:
-                time.sleep(self._pacing())	# pacing
+                if self.connected():
+                    self._relay()
             except Exception as e:
                 self.log.error('Exception: ' + str(type(e)) + str(e))
                 self.connect_pending = False
@@ -390,10 +671,59 @@ class fakeirc(object):
     def ctcp(self, cmd=None, nick=None, ts=None, data=None):
         pass
 
+    def ping(self, target=None, target2=None, data=None):
+        pass
+
     def privmsg(self, chan=None, msg=None, data=None):
         pass
     
 if __name__ == '__main__':
+    import sys
+
+    # Relay a sprint finish: irc messages sent with and without coalescing
+    if len(sys.argv) == 2 and sys.argv[1] == '-b':
+        random.seed(1)
+        msgs = []
+        ann = uscbsrv(linelen=80)
+        ann.sendmsg = lambda m: msgs.append(
+                                  (m.pack(), msgkey(m, ann.linelen)))
+        ann.clrall()
+        ann.set_start(tod.tod('10:00:00'))
+        ann.clrall()	# start is kept across the clear
+        ann.set_title('Stage 3 - Sprint finish')
+        for i in range(200):
+            ann.set_time(tod.tod(3600 + i).rawtime(1))
+            ann.setline(1, 'Leaders ' + str(i))
+            if i % 2 == 0:
+                ann.add_rider([str(i // 2 + 1) + '.', str(random.randint(1,
+                               199)), 'Rider Name', 'TEAM', '4:01:22'])
+        r = relayq()
+        st = time.time()
+        for (buf, key) in msgs:
+            r.add(buf, key)
+        lines = []
+        while r.pending():
+            lines.append(r.line())
+        et = time.time() - st
+        b = unt4.unt4buf()
+        b.feed(unt4.decode(''.join(lines)))
+        out = list(b.packets())
+        state = {}
+        for (m, k) in msgs:
+            state.setdefault(k, []).append(m)
+        final = {}
+        for m in out:
+            final.setdefault(msgkey(unt4.unt4(unt4str=m),
+                                    ann.linelen), []).append(m)
+        assert final['R'] == state['R']
+        for k in state:
+            assert final[k][-1] == state[k][-1]
+        assert max([len(l) for l in lines]) <= IRC_LINELEN
+        print('Messages: {0:5d}, legacy irc lines: {0:5d}'.format(len(msgs)))
+        print('Relayed:  {0:5d}, irc lines: {1:5d}, {2:0.4f} s'.format(
+                   len(out), len(lines), et))
+        sys.exit(0)
+
     h = logging.StreamHandler()
     h.setLevel(logging.DEBUG)
     ann = uscbsrv()
@@ -23,10 +23,15 @@ collect RFID events from the wheeltime and deliver them to a calling
 thread via a response queue.
 
 A calling thread creates a wheeltime thread and then polls for 
-new RFIDs with the wheeltime.response() method.
+new RFIDs with the wheeltime.response() method. A main loop may
+instead watch the file descriptor wheeltime.wakefd, which becomes
+readable whenever new RFIDs are queued, then call wheeltime.ack()
+and drain the response queue.
 
 TCP/IP communicaton with an attached wheeltime unit is handled
-by blocking I/O in a sub thread.
+by blocking I/O in a sub thread. Commands are written to the unit
+over a persistent connection which is re-opened with an increasing
+delay after a failure.
 
 """
 
@@ -36,8 +41,13 @@ import logging
 import decimal
 import socket
 import time
+import os
+import fcntl
+import select
+import collections
 
 from scbdo import tod
+from scbdo import journal
 
 # System defaults
 #WHEELIP = 'localhost'		# Testing address
@@ -47,19 +57,66 @@ WHEELRAWPORT = 10000		# Port for raw tag stream
 WHEELFSPORT = 10200		# Port for FS/LS filtered stream
 WHEELCMDPORT = 9999		# Wheeltime command port
 
+# Command channel defaults
+CMDTIMEOUT = 0.5		# command socket connect and send timeout
+CMDQUEUELEN = 64		# maximum number of unsent commands
+CMDBACKOFF = 0.5		# initial reconnect delay in seconds
+CMDBACKOFFMAX = 30.0		# maximum reconnect delay in seconds
+
 # thread queue commands -> private to timy thread
-TCMDS = ('RFID', 'EXIT', 'ADDR', 'MSG')
+TCMDS = ('RFID', 'RFIDS', 'EXIT', 'ADDR', 'MSG')
 
 # Logging defaults
 RFID_LOG_LEVEL = 16	# lower so not in status and on-screen logger.
 logging.addLevelName(RFID_LOG_LEVEL, 'RFID')
 
+# Read buffer length, must hold at least one complete frame
+RDBUFLEN = 8192
+
+# Whitespace stripped from either end of a frame
+FRAMESPACE = frozenset(bytearray(' \t\n\r\x0b\x0c'))
+
+# Hex digit values by byte, invalid digits map out of byte range
+HEXVAL = [0x1000] * 256
+for (i, c) in enumerate('0123456789abcdef'):
+    HEXVAL[ord(c)] = i
+    HEXVAL[ord(c.upper())] = i
+
+TAGPREFIX = bytearray('058001')		# 'shortform' tag id prefix
+TRIGPREFIX = bytearray('ab010a2c')	# trigger frame header
+
 adder = lambda sum, ch: sum + ord(ch)
 
 def ipico_lrc(ipxstr='', el=34):
     """Return the so-called 'LRC' character sum from IPX module."""
     return reduce(adder, ipxstr[2:el], 0) & 0xff
 
+def ipico_lrcbuf(buf, st=0, el=34):
+    """Return the 'LRC' sum for the frame at st in bytearray buf."""
+    return sum(buf[st+2:st+el]) & 0xff
+
+def ipico_hex(buf, i):
+    """Return the value of the two hex digits at i in bytearray buf."""
+    return HEXVAL[buf[i]] << 4 | HEXVAL[buf[i+1]]
+
+def ipico_ticks(buf, i):
+    """Return tick count of the hhmmssff time field at i in buf.
+
+    The fraction field is a hex byte that the IPX module reports as
+    hundredths, values over 99 are read as thousandths to match the
+    string format used by earlier versions.
+
+    """
+    ret = ((((buf[i] - 48) * 10 + buf[i+1] - 48) * 3600
+           + ((buf[i+2] - 48) * 10 + buf[i+3] - 48) * 60
+           + (buf[i+4] - 48) * 10 + buf[i+5] - 48) * tod.TICKS)
+    frac = ipico_hex(buf, i+6)
+    if frac < 100:
+        ret += frac * (tod.TICKS // 100)
+    else:
+        ret += frac * (tod.TICKS // 1000)
+    return ret
+
 def sendall(s, buf):
     """Send all of buf to socket s."""
     msglen = len(buf)
@@ -78,6 +135,11 @@ class wtio(threading.Thread):
     parsed Time of Day event objects back to a wheeltime
     thread object through the command queue.
 
+    Frames are received directly into a fixed bytearray and every
+    complete frame in the buffer is parsed in place after each read.
+    The resulting tods are delivered to the wheeltime thread as a
+    single 'RFIDS' batch.
+
     """
     def __init__(self, addr=None, cqueue=None, log=None):
         """Construct wheeltime I/O thread.
@@ -94,69 +156,91 @@ class wtio(threading.Thread):
         self.cqueue = cqueue
         self.log = log
         self.addr = addr
-        self.rdbuf = ''
+        self.rdbuf = bytearray(RDBUFLEN)
+        self.rdview = memoryview(self.rdbuf)
+        self.rdlen = 0
         self.running = False
 
     def close(self):
         """Signal thread for termination."""
         self.running = False
 
-    def readline(self, s=None):
-        """Return newline delimited lines from socket.
+    def read(self, s=None):
+        """Read from socket and return a list of the tods received.
 
-        This function works on an input buffer, returning one complete
-        line per call or None if one is not yet fully received.
+        Data is appended to the read buffer, then all complete
+        frames are parsed and removed. A trailing partial frame is
+        moved to the start of the buffer for the next read.
 
         """
-        ret = None
-        idx = self.rdbuf.find('\n')
-        if idx < 0:
-            inb = s.recv(2048)
-            if inb == '':
-                self.log.info('Wheeltime I/O connection broken')
-                self.close()
-            else:
-                self.rdbuf += inb
-            idx = self.rdbuf.find('\n')
-        if idx >= 0:
-            ret = self.rdbuf[0:idx+1]
-            self.rdbuf = self.rdbuf[idx+1:]
+        ret = []
+        cnt = s.recv_into(self.rdview[self.rdlen:])
+        if cnt == 0:
+            self.log.info('Wheeltime I/O connection broken')
+            self.close()
+        else:
+            self.rdlen += cnt
+            ret = self.procbuf()
+        return ret
+
+    def procbuf(self):
+        """Parse and remove all complete frames from the read buffer."""
+        ret = []
+        buf = self.rdbuf
+        st = 0
+        idx = buf.find('\n', 0, self.rdlen)
+        while idx >= 0:
+            t = self.procframe(buf, st, idx)
+            if t is not None:
+                ret.append(t)
+            st = idx + 1
+            idx = buf.find('\n', st, self.rdlen)
+        if st > 0:
+            rem = self.rdlen - st
+            if rem > 0:
+                buf[0:rem] = self.rdview[st:self.rdlen]
+            self.rdlen = rem
+        elif self.rdlen == len(buf):
+            self.log.warn('Read buffer overflow, '
+                           + str(self.rdlen) + ' bytes discarded')
+            self.rdlen = 0
         return ret
 
-    def procmsg(self, msg):
-        """Read IPX wheeltime event and insert as tod into command queue."""
-        s = msg.strip()
-        if (len(s) == 36 or len(s) == 38) and s[1] == 'a':
-            sum = ipico_lrc(s)
-            lrc = int(s[34:36], 16)
+    def procframe(self, buf, st, et):
+        """Return a tod for the IPX frame at buf[st:et] or None."""
+        ret = None
+        while st < et and buf[st] in FRAMESPACE:
+            st += 1
+        while et > st and buf[et-1] in FRAMESPACE:
+            et -= 1
+        flen = et - st
+        if (flen == 36 or flen == 38) and buf[st+1] == 0x61:	# 'a'
+            sum = ipico_lrcbuf(buf, st)
+            lrc = ipico_hex(buf, st+34)
             if sum == lrc:
-                #tagid=s[4:16]	## NOTE: Using 'shortform' tag ids
-                if s[4:10] == '058001':	# match id prefix
-                    tagid=(s[10:16]).lower()
-                    timestr = '{0}:{1}:{2}.{3:02}'.format(s[26:28], s[28:30],
-                                   s[30:32], int(s[32:34], 16))
-                    self.cqueue.put_nowait(('RFID',
-                          tod.tod(timestr, 'RFID', '', tagid)))
+                #tagid=buf[st+4:st+16]	## NOTE: Using 'shortform' tag ids
+                if buf[st+4:st+10] == TAGPREFIX:	# match id prefix
+                    tagid = str(buf[st+10:st+16]).lower()
+                    ret = tod.mktod(ipico_ticks(buf, st+26),
+                                    'RFID', '', tagid)
                 else:
-                    self.log.warn('Spurious tag id: ' + s[4:10] + ' :: ' 
-                                    + s[10:16])
+                    self.log.warn('Spurious tag id: '
+                                    + str(buf[st+4:st+10]) + ' :: '
+                                    + str(buf[st+10:st+16]))
             else:
                 self.log.warn('Incorrect char sum message skipped: ' 
                                + hex(sum) + ' != ' + hex(lrc))
-        elif len(s) == 30 and s[0:8] == 'ab010a2c':
-            sum = ipico_lrc(s, 28)
-            lrc = int(s[28:30], 16)
+        elif flen == 30 and buf[st:st+8] == TRIGPREFIX:
+            sum = ipico_lrcbuf(buf, st, 28)
+            lrc = ipico_hex(buf, st+28)
             if sum == lrc:
-                timestr = '{0}:{1}:{2}.{3:02}'.format(s[16:18], s[18:20],
-                               s[20:22], int(s[22:24], 16))
-                self.cqueue.put_nowait(('RFID',
-                      tod.tod(timestr, 'RFID', '', 'trig')))
-                #self.log.debug('TRIG MSG: ' + repr(s))
+                ret = tod.mktod(ipico_ticks(buf, st+16), 'RFID', '', 'trig')
             else:
                 self.log.warn('Incorrect char sum message skipped: ' 
                                + hex(sum) + ' != ' + hex(lrc))
         else:
-            self.log.debug('Non RFID message: ' + repr(msg))
+            self.log.debug('Non RFID message: ' + repr(str(buf[st:et])))
+        return ret
 
     def run(self):
         """Called via threading.Thread.start()."""
@@ -167,9 +251,9 @@ class wtio(threading.Thread):
             s.connect((self.addr, WHEELFSPORT))
             while self.running:
                 try:
-                    m = self.readline(s)
-                    if m is not None:
-                        self.procmsg(m)
+                    b = self.read(s)
+                    if len(b) > 0:
+                        self.cqueue.put_nowait(('RFIDS', b, time.time()))
                 except socket.timeout:
                     pass
             s.shutdown(socket.SHUT_RDWR)
@@ -200,20 +284,32 @@ class wheeltime(threading.Thread):
         self.armed = False
         self.cqueue = Queue.Queue()	# command queue
         self.rqueue = Queue.Queue()	# response queue
+        self.journal = None		# raw rfid journal
         self.log = logging.getLogger(self.name)
         self.log.setLevel(logging.DEBUG)
         self.io = None
         self.running = False
+        (self.wakefd, self.__wakewr) = os.pipe()
+        for fd in (self.wakefd, self.__wakewr):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.__latency = [0, 0.0, 0.0]	# count, total, max
+        self.cmdq = collections.deque()	# unsent (command, queue time)
+        self.cmdsock = None
+        self.cmdbackoff = CMDBACKOFF
+        self.cmdretry = 0.0
+        self.__cmdlatency = [0, 0.0, 0.0]	# count, total, max
         if addr is not None:
             self.setaddr(addr)
 
     def clrmem(self):
         """Clear wheeltime memory."""
-        self.cqueue.put_nowait(('MSG', 'clear_history\n'))
+        self.cqueue.put_nowait(('MSG', 'clear_history\n', time.time()))
 
     def write(self, msg=None):
         """Queue a raw command string."""
-        self.cqueue.put_nowait(('MSG', str(msg).rstrip() + '\n'))
+        self.cqueue.put_nowait(('MSG', str(msg).rstrip() + '\n',
+                                time.time()))
 
     def exit(self, msg=None):
         """Flag control thread termination."""
@@ -239,37 +335,135 @@ class wheeltime(threading.Thread):
         t = time.localtime()
         datestr = '{0}{1:02}{2:02}00{3:02}{4:02}{5:02}00'.format(
                      str(t[0])[2:], t[1], t[2], t[3], t[4], t[5])
-        self.cqueue.put_nowait(('MSG', 'ab000701' + datestr + '\n'))
+        self.cqueue.put_nowait(('MSG', 'ab000701' + datestr + '\n',
+                                time.time()))
+
+    def setjournal(self, jnl=None):
+        """Record all received rfid events to the journal jnl."""
+        self.journal = jnl
 
     def trig(self, refid=None):
         """Insert a fake rfid event into response queue."""
         t = tod.tod('now', 'FAKE')
         if refid is not None:
             t.refid = str(refid)
-        self.cqueue.put_nowait(('RFID', t))
+        self.cqueue.put_nowait(('RFID', t, time.time()))
 
     def response(self):
         """Check for RFID events in response queue."""
         r = None
         try:
-            r = self.rqueue.get_nowait()
+            (r, rt) = self.rqueue.get_nowait()
             self.rqueue.task_done()
+            lt = time.time() - rt
+            self.__latency[0] += 1
+            self.__latency[1] += lt
+            if lt > self.__latency[2]:
+                self.__latency[2] = lt
         except Queue.Empty:
             r = None
         return r
 
+    def ack(self):
+        """Clear wakeup signal, call before draining the response queue."""
+        try:
+            while len(os.read(self.wakefd, 512)) == 512:
+                pass
+        except OSError:
+            pass	# nothing pending
+
+    def latency(self):
+        """Return and reset (count, mean, max) receive to response delay."""
+        (cnt, tot, mx) = self.__latency
+        self.__latency = [0, 0.0, 0.0]
+        mean = 0.0
+        if cnt > 0:
+            mean = tot / cnt
+        return (cnt, mean, mx)
+
+    def __wake(self):
+        """Signal the calling thread that responses are waiting."""
+        try:
+            os.write(self.__wakewr, 'r')
+        except OSError:
+            pass	# pipe full, calling thread is already signalled
+
     def wait(self):		# NOTE: Do not call from cmd thread
         """Suspend calling thread until cqueue is empty."""
         self.cqueue.join()
 
-    def command(self, command):		# NOTE: Lazy!
-        """Connect to serv and dump a command."""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(0.5)
-        s.connect((self.addr, WHEELCMDPORT))
-        sendall(s, command.encode('latin_1'))
-        s.shutdown(socket.SHUT_RDWR)
-        s.close()
+    def command(self, command, qtime=None):
+        """Append a command to the outbound command queue."""
+        if qtime is None:
+            qtime = time.time()
+        if len(self.cmdq) >= CMDQUEUELEN:
+            (c, qt) = self.cmdq.popleft()
+            self.log.warn('Command queue full, dropped: ' + repr(c))
+        self.cmdq.append((command.encode('latin_1'), qtime))
+
+    def cmdconnect(self):
+        """Open the command channel if required, return True if open."""
+        if self.cmdsock is None and time.time() >= self.cmdretry:
+            try:
+                self.cmdsock = socket.create_connection(
+                                   (self.addr, WHEELCMDPORT), CMDTIMEOUT)
+                self.cmdbackoff = CMDBACKOFF
+                self.log.debug('Command channel connected.')
+            except socket.error as e:
+                self.cmdretry = time.time() + self.cmdbackoff
+                self.log.debug('Command connect failed: ' + str(e)
+                                 + ', retry in '
+                                 + '{0:0.1f} s'.format(self.cmdbackoff))
+                self.cmdbackoff = min(2.0 * self.cmdbackoff, CMDBACKOFFMAX)
+        return self.cmdsock is not None
+
+    def cmdclose(self):
+        """Close the command channel."""
+        if self.cmdsock is not None:
+            try:
+                self.cmdsock.shutdown(socket.SHUT_RDWR)
+                self.cmdsock.close()
+            except socket.error:
+                pass
+            self.cmdsock = None
+
+    def cmdcheck(self):
+        """Discard replies on the command channel, close if unit has gone."""
+        while (self.cmdsock is not None
+               and select.select([self.cmdsock], [], [], 0)[0]):
+            if self.cmdsock.recv(4096) == '':
+                self.log.debug('Command channel closed by unit.')
+                self.cmdclose()
+
+    def cmdflush(self):
+        """Write all queued commands to the command channel in one send."""
+        if len(self.cmdq) > 0 and self.addr is not None:
+            try:
+                self.cmdcheck()
+                if not self.cmdconnect():
+                    return
+                sendall(self.cmdsock, ''.join([c for (c, qt) in self.cmdq]))
+                self.cmdcheck()
+                now = time.time()
+                for (c, qt) in self.cmdq:
+                    lt = now - qt
+                    self.__cmdlatency[0] += 1
+                    self.__cmdlatency[1] += lt
+                    if lt > self.__cmdlatency[2]:
+                        self.__cmdlatency[2] = lt
+                self.cmdq.clear()
+            except socket.error as e:
+                self.log.warn('Command channel error: ' + str(e))
+                self.cmdclose()		# commands are re-sent on reconnect
+
+    def cmdlatency(self):
+        """Return and reset (count, mean, max) command queue to send delay."""
+        (cnt, tot, mx) = self.__cmdlatency
+        self.__cmdlatency = [0, 0.0, 0.0]
+        mean = 0.0
+        if cnt > 0:
+            mean = tot / cnt
+        return (cnt, mean, mx)
 
     def connected(self):
         """Return True if wheeltime unit connected."""
@@ -282,26 +476,50 @@ class wheeltime(threading.Thread):
         while self.running:
             try:
                 # Read Phase
-                m = self.cqueue.get()
-                self.cqueue.task_done()
+                timeout = None
+                if len(self.cmdq) > 0:	# wake up for command retry
+                    timeout = max(self.cmdretry - time.time(), 0.05)
+                try:
+                    m = self.cqueue.get(True, timeout)
+                    self.cqueue.task_done()
+                except Queue.Empty:
+                    self.cmdflush()
+                    continue
                 
                 # Write phase
                 if m[0] == 'RFID':
                     assert type(m[1]) is tod.tod
                     self.log.log(RFID_LOG_LEVEL, ' ' + str(m[1]))
+                    if self.journal is not None:
+                        self.journal.append(m[1], journal.SRC_RFID)
                     if self.armed:
-                        self.rqueue.put_nowait(m[1])
+                        self.rqueue.put_nowait((m[1], m[2]))
                         #self.log.debug('Queueing RFID: ' + str(m[1]))
+                        self.__wake()
+                elif m[0] == 'RFIDS':
+                    for t in m[1]:
+                        self.log.log(RFID_LOG_LEVEL, ' ' + str(t))
+                        if self.journal is not None:
+                            self.journal.append(t, journal.SRC_RFID)
+                        if self.armed:
+                            self.rqueue.put_nowait((t, m[2]))
+                    if self.armed:
+                        self.__wake()
                 elif m[0] == 'MSG':
-                    if self.connected():
-                        self.command(m[1])
+                    if self.addr is not None:
+                        self.command(m[1], m[2])
                     else:
                         self.log.warn('Wheeltime not connected.')
                 elif m[0] == 'EXIT':
+                    self.cmdflush()
                     self.running = False
                     self.log.debug('Request to close : ' + str(m[1]))
                 elif m[0] == 'ADDR':
                     self.addr = None
+                    self.cmdclose()
+                    self.cmdq.clear()
+                    self.cmdbackoff = CMDBACKOFF
+                    self.cmdretry = 0.0
                     if self.io is not None:
                         self.io.close()
                         self.io = None
@@ -315,13 +533,126 @@ class wheeltime(threading.Thread):
                         self.log.info('Wheeltime not connected.')
                 else:
                     self.log.warn('Unknown message: ' + repr(m))
+
+                # pipeline all commands queued before an idle point
+                if self.cqueue.empty():
+                    self.cmdflush()
             except Exception as e:
                 self.log.error('Exception: ' + str(type(e)) + str(e))
         if self.io is not None:
             self.io.close()
+        self.cmdclose()
         self.log.info('Exiting')
 
 if __name__ == "__main__":
+    import sys
+
+    # Replay benchmark on captured frame files or a synthetic stream
+    if len(sys.argv) > 1 and sys.argv[1] == '-b':
+        import random
+        if len(sys.argv) > 2:
+            data = ''.join([open(f, 'rb').read() for f in sys.argv[2:]])
+        else:
+            random.seed(1)
+            frames = []
+            t = 10 * 3600 * 100
+            for i in range(50000):
+                t += random.randint(0, 20)
+                (sec, hs) = divmod(t, 100)
+                hms = '{0:02}{1:02}{2:02}{3:02x}'.format(sec // 3600,
+                                    sec // 60 % 60, sec % 60, hs)
+                if i % 500 == 0:
+                    f = 'ab010a2c00000000' + hms + '0000'
+                    f += '{0:02x}'.format(ipico_lrc(f, 28))
+                else:
+                    f = 'aa00058001{0:06x}0000000000'.format(
+                                    random.randint(1, 999)) + hms
+                    f += '{0:02x}'.format(ipico_lrc(f))
+                frames.append(f + '\r\n')
+            data = ''.join(frames)
+
+        class replay(object):
+            """Socket stand-in returning data in recv sized chunks."""
+            def __init__(self, data, chunk=2048):
+                self.data = data
+                self.chunk = chunk
+                self.pos = 0
+            def recv(self, n):
+                ret = self.data[self.pos:self.pos + min(n, self.chunk)]
+                self.pos += len(ret)
+                return ret
+            def recv_into(self, buf):
+                ret = self.recv(len(buf))
+                buf[0:len(ret)] = ret
+                return len(ret)
+
+        def legacy(s):
+            """Return tod for frame s as parsed by the string reader."""
+            s = s.strip()
+            ret = None
+            if (len(s) == 36 or len(s) == 38) and s[1] == 'a':
+                if (ipico_lrc(s) == int(s[34:36], 16)
+                      and s[4:10] == '058001'):
+                    timestr = '{0}:{1}:{2}.{3:02}'.format(s[26:28],
+                                 s[28:30], s[30:32], int(s[32:34], 16))
+                    ret = tod.tod(timestr, 'RFID', '', s[10:16].lower())
+            elif len(s) == 30 and s[0:8] == 'ab010a2c':
+                if ipico_lrc(s, 28) == int(s[28:30], 16):
+                    timestr = '{0}:{1}:{2}.{3:02}'.format(s[16:18],
+                                 s[18:20], s[20:22], int(s[22:24], 16))
+                    ret = tod.tod(timestr, 'RFID', '', 'trig')
+            return ret
+
+        log = logging.getLogger('scbdo.wheeltime.replay')
+        log.addHandler(logging.NullHandler())
+
+        # line at a time string reader, one queue put per frame
+        q = Queue.Queue()
+        src = replay(data)
+        rdbuf = ''
+        st = time.time()
+        while True:
+            idx = rdbuf.find('\n')
+            if idx < 0:
+                inb = src.recv(2048)
+                if inb == '':
+                    break
+                rdbuf += inb
+                continue
+            t = legacy(rdbuf[0:idx+1])
+            rdbuf = rdbuf[idx+1:]
+            if t is not None:
+                q.put_nowait(('RFID', t))
+        lt = time.time() - st
+        ref = []
+        while not q.empty():
+            ref.append(q.get_nowait()[1])
+
+        # batched bytearray reader, one queue put per read
+        q = Queue.Queue()
+        src = replay(data)
+        io = wtio(cqueue=q, log=log)
+        io.running = True
+        st = time.time()
+        while io.running:
+            b = io.read(src)
+            if len(b) > 0:
+                q.put_nowait(('RFIDS', b))
+        bt = time.time() - st
+        res = []
+        puts = 0
+        while not q.empty():
+            res.extend(q.get_nowait()[1])
+            puts += 1
+
+        assert [(t.ticks, t.refid) for t in ref] == [(t.ticks, t.refid)
+                                                      for t in res]
+        print('Replay: ' + str(len(data)) + ' bytes, '
+                + str(len(res)) + ' frames')
+        print('  string: {0:7.3f} s, {1:6d} queue puts'.format(lt, len(ref)))
+        print('   batch: {0:7.3f} s, {1:6d} queue puts'.format(bt, puts))
+        sys.exit(0)
+
     w = wheeltime('localhost')
     lh = logging.StreamHandler()
     lh.setLevel(logging.DEBUG)
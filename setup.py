@@ -42,7 +42,7 @@ setup(name = 'scbdo',
       packages = ['scbdo'],
       package_dir={'scbdo': 'scbdo'},
       package_data={'scbdo': ['ui/*', 'data/gnome/help/SCBdo/C/SCBdo.xml']},
-      scripts = ['bin/wheeltime_test', 'bin/update_namebank', 'bin/trackmeet', 'bin/roadrace', 'bin/sportif', 'bin/track_announce', 'bin/road_announce'],
+      scripts = ['bin/wheeltime_test', 'bin/update_namebank', 'bin/trackmeet', 'bin/roadrace', 'bin/sportif', 'bin/track_announce', 'bin/road_announce', 'bin/uscb_relay'],
       classifiers = ['Development Status :: 3 - Alpha',
               'Environment :: X11 Applications :: GTK',
               'Intended Audience :: Other Audience',